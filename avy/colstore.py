@@ -0,0 +1,442 @@
+"""
+@author: ABerner
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+class ColumnTable(object):
+    '''
+    Append-only, typed columnar table stored as a directory of flat binary
+    column files plus a meta.json describing the schema and row count.
+
+    Numeric and datetime columns are raw little-endian arrays that are
+    memory-mapped on read, so loading a few columns or a slice of rows only
+    touches those bytes. String columns are stored as utf-8 data with an
+    int64 end-offset array and a null mask. The table's index (e.g. the
+    observation time of a station series) is stored as its own column; when
+    it is sorted, read() can slice on it with a binary search.
+
+    meta.json is only rewritten after the column files have been appended
+    to, so an interrupted append leaves the table at its previous row count
+    (the extra bytes are trimmed on the next append).
+
+    tbl = ColumnTable('store/BTAVAL01')
+    tbl.append(df)
+    df = tbl.read(columns=['air_temp_set_1'], start='2016-01-01')
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.meta = None
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta_path):
+            with open(meta_path, 'r') as fin:
+                self.meta = json.load(fin)
+
+    def exists(self):
+        return self.meta is not None
+
+    def __len__(self):
+        return self.meta['nrows'] if self.meta else 0
+
+    @property
+    def columns(self):
+        return [c['name'] for c in self.meta['columns']
+                if c['name'] != self.meta['index']]
+
+    @property
+    def attrs(self):
+        return self.meta['attrs']
+
+    def set_attrs(self, **attrs):
+        self.meta['attrs'].update(attrs)
+        self._write_meta()
+
+    def clear(self):
+        '''
+        Delete all data (and the schema) in the table
+        '''
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+        self.meta = None
+
+    # --- schema ---------------------------------------------------------
+
+    @staticmethod
+    def _col_spec(name, values, i):
+        dtype = values.dtype
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            return {'name': name, 'kind': 'dt', 'file': 'c{0}'.format(i),
+                    'tz': str(dtype.tz)}
+        if pd.api.types.is_datetime64_dtype(dtype):
+            return {'name': name, 'kind': 'dt', 'file': 'c{0}'.format(i),
+                    'tz': None}
+        if (isinstance(dtype, np.dtype) and
+                (pd.api.types.is_bool_dtype(dtype) or
+                 pd.api.types.is_numeric_dtype(dtype))):
+            return {'name': name, 'kind': 'num', 'file': 'c{0}'.format(i),
+                    'dtype': np.dtype(dtype).newbyteorder('<').str}
+        return {'name': name, 'kind': 'str', 'file': 'c{0}'.format(i)}
+
+    def _create(self, df, index_name, attrs):
+        os.makedirs(self.path, exist_ok=True)
+        cols = []
+        if index_name is not None:
+            cols.append(self._col_spec(index_name, df.index, 0))
+        for i, col in enumerate(df.columns):
+            cols.append(self._col_spec(col, df[col], i + 1))
+        self.meta = {'columns': cols,
+                     'index': index_name,
+                     'sorted': True,
+                     'nrows': 0,
+                     'attrs': dict(attrs or {})}
+
+    def _write_meta(self):
+        tmp = os.path.join(self.path, 'meta.json.tmp')
+        with open(tmp, 'w') as fout:
+            json.dump(self.meta, fout)
+        os.replace(tmp, os.path.join(self.path, 'meta.json'))
+
+    def _file(self, spec, ext):
+        return os.path.join(self.path, spec['file'] + ext)
+
+    # --- writing --------------------------------------------------------
+
+    def _trim(self):
+        '''
+        Drop bytes past the committed row count left by an interrupted append
+        '''
+        n = self.meta['nrows']
+        for spec in self.meta['columns']:
+            if spec['kind'] == 'str':
+                ends = self._offsets(spec)
+                sizes = {'.off': 8 * n, '.nul': n,
+                         '.str': int(ends[n - 1]) if n else 0}
+            else:
+                itemsize = 8 if spec['kind'] == 'dt' else \
+                    np.dtype(spec['dtype']).itemsize
+                sizes = {'.bin': itemsize * n}
+            for ext, size in sizes.items():
+                fname = self._file(spec, ext)
+                if os.path.isfile(fname) and os.path.getsize(fname) > size:
+                    with open(fname, 'r+b') as f:
+                        f.truncate(size)
+
+    def _encode(self, spec, values, base=None):
+        if spec['kind'] == 'dt':
+            values = pd.DatetimeIndex(values)
+            if spec['tz'] is not None:
+                values = values.tz_convert('UTC').tz_localize(None)
+            if hasattr(values, 'as_unit'):
+                values = values.as_unit('ns')
+            return {'.bin': values.asi8.astype('<i8').tobytes()}
+        if spec['kind'] == 'num':
+            return {'.bin': np.asarray(values, dtype=spec['dtype']).tobytes()}
+        values = pd.Series(values).astype(object)
+        nul = values.isnull().values
+        encoded = [b'' if n else str(v).encode('utf-8')
+                   for v, n in zip(values.values, nul)]
+        lengths = np.array([len(b) for b in encoded], dtype='<i8')
+        if base is None:
+            base = 0
+            if self.meta['nrows']:
+                base = int(self._offsets(spec)[self.meta['nrows'] - 1])
+        return {'.str': b''.join(encoded),
+                '.off': (base + np.cumsum(lengths)).astype('<i8').tobytes(),
+                '.nul': nul.astype(np.uint8).tobytes()}
+
+    def append(self, df, attrs=None):
+        '''
+        Append the rows of df. The first append fixes the schema (column
+        names and types, and whether df.index is stored); later frames must
+        have the same columns and are cast to the stored types.
+        '''
+        if df.empty and self.meta is not None:
+            return
+        index_name = None
+        if not isinstance(df.index, pd.RangeIndex):
+            index_name = df.index.name or '__index__'
+        if self.meta is None:
+            self._create(df, index_name, attrs)
+        else:
+            if list(df.columns) != self.columns:
+                raise ValueError("columns do not match stored schema: "
+                                 "{0}".format(self.path))
+            self._trim()
+            if attrs:
+                self.meta['attrs'].update(attrs)
+
+        index_spec = None
+        for spec in self.meta['columns']:
+            if spec['name'] == self.meta['index']:
+                values = df.index
+                index_spec = spec
+            else:
+                values = df[spec['name']]
+            for ext, data in self._encode(spec, values).items():
+                with open(self._file(spec, ext), 'ab') as fout:
+                    fout.write(data)
+
+        if index_spec is not None and self.meta['sorted']:
+            idx = self._decode_index(df.index)
+            ok = len(idx) < 2 or bool(np.all(idx[1:] >= idx[:-1]))
+            if ok and self.meta['nrows'] and len(idx):
+                ok = bool(idx[0] >=
+                          self._raw(index_spec)[self.meta['nrows'] - 1])
+            self.meta['sorted'] = ok
+        self.meta['nrows'] += len(df)
+        self._write_meta()
+
+    def truncate(self, nrows):
+        '''
+        Drop all rows from position nrows on
+        '''
+        if nrows >= self.meta['nrows']:
+            return
+        self.meta['nrows'] = nrows
+        self._trim()
+        self._write_meta()
+
+    def sort_by(self, name, key=None):
+        '''
+        Reorder all rows by one column with a single stable argsort. key is
+        an optional vectorized transform of the column values (e.g.
+        pd.to_datetime for dates stored as strings). Columns are written
+        one at a time to new files, so peak memory is about one column, and
+        the table switches to them with a single meta.json update: an
+        interrupted sort leaves the table as it was.
+        '''
+        n = self.meta['nrows']
+        self._trim()
+        self._sweep()
+        values = self._decode(self._spec(name), 0, n)
+        if key is not None:
+            values = key(values)
+        order = np.argsort(np.asarray(values), kind='stable')
+        gen = self.meta.get('generation', 0) + 1
+        old = self.meta['columns']
+        new = []
+        for spec in old:
+            values = self._decode(spec, 0, n)[order]
+            spec = dict(spec, file='{0}.{1}'.format(
+                spec['file'].split('.')[0], gen))
+            for ext, data in self._encode(spec, values, base=0).items():
+                with open(self._file(spec, ext), 'wb') as fout:
+                    fout.write(data)
+            new.append(spec)
+        self.meta['columns'] = new
+        self.meta['generation'] = gen
+        if self.meta['index'] is not None:
+            idx = self._raw(self._spec(self.meta['index']))
+            self.meta['sorted'] = bool(np.all(idx[1:] >= idx[:-1]))
+        self._write_meta()
+        self._sweep()
+
+    def _sweep(self):
+        '''
+        Remove column files meta.json doesn't refer to (replaced by a sort,
+        or left by an interrupted one)
+        '''
+        keep = set(spec['file'] for spec in self.meta['columns'])
+        for entry in os.scandir(self.path):
+            base, ext = os.path.splitext(entry.name)
+            if ext in ('.bin', '.str', '.off', '.nul') and base not in keep:
+                os.remove(entry.path)
+
+    def _decode_index(self, index):
+        spec = [c for c in self.meta['columns']
+                if c['name'] == self.meta['index']][0]
+        if spec['kind'] == 'dt':
+            return np.frombuffer(self._encode(spec, index)['.bin'], '<i8')
+        return np.asarray(index)
+
+    # --- reading --------------------------------------------------------
+
+    def _offsets(self, spec):
+        fname = self._file(spec, '.off')
+        if not os.path.isfile(fname) or os.path.getsize(fname) == 0:
+            return np.zeros(0, dtype='<i8')
+        return np.memmap(fname, dtype='<i8', mode='r')
+
+    def _raw(self, spec):
+        '''
+        Memory-mapped raw values of a numeric/datetime column (no copy)
+        '''
+        dtype = '<i8' if spec['kind'] == 'dt' else spec['dtype']
+        n = self.meta['nrows']
+        if n == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self._file(spec, '.bin'), dtype=dtype, mode='r',
+                         shape=(n,))
+
+    def _spec(self, name):
+        for spec in self.meta['columns']:
+            if spec['name'] == name:
+                return spec
+        raise KeyError(name)
+
+    def column(self, name):
+        '''
+        Zero-copy memory map of a numeric column (datetimes as int64 ns)
+        '''
+        return self._raw(self._spec(name))
+
+    def _decode(self, spec, lo, hi):
+        if spec['kind'] == 'num':
+            return np.array(self._raw(spec)[lo:hi])
+        if spec['kind'] == 'dt':
+            values = pd.DatetimeIndex(
+                np.array(self._raw(spec)[lo:hi]).view('datetime64[ns]'))
+            if spec['tz'] is not None:
+                values = values.tz_localize('UTC').tz_convert(spec['tz'])
+            return values
+        if hi <= lo:
+            return np.empty(0, dtype=object)
+        ends = self._offsets(spec)
+        start = int(ends[lo - 1]) if lo > 0 else 0
+        stop = int(ends[hi - 1]) if hi > lo else start
+        with open(self._file(spec, '.str'), 'rb') as fin:
+            fin.seek(start)
+            data = fin.read(stop - start)
+        nul = np.memmap(self._file(spec, '.nul'), dtype=np.uint8, mode='r',
+                        shape=(self.meta['nrows'],))[lo:hi]
+        bounds = np.concatenate([[start], ends[lo:hi]]) - start
+        return np.array([None if n else data[a:b].decode('utf-8')
+                         for a, b, n in zip(bounds[:-1], bounds[1:], nul)],
+                        dtype=object)
+
+    def row_range(self, start=None, end=None):
+        '''
+        [lo, hi) row positions whose index lies in [start, end]; requires a
+        sorted index
+        '''
+        n = self.meta['nrows']
+        if start is None and end is None:
+            return 0, n
+        if not self.meta['sorted']:
+            raise ValueError("index is not sorted: {0}".format(self.path))
+        spec = self._spec(self.meta['index'])
+        idx = self._raw(spec)
+        lo, hi = 0, n
+        if start is not None:
+            lo = int(np.searchsorted(idx, self._bound(spec, start, 'left'),
+                                         'left'))
+        if end is not None:
+            hi = int(np.searchsorted(idx, self._bound(spec, end, 'right'),
+                                         'right'))
+        return lo, hi
+
+    def _bound(self, spec, value, side):
+        if spec['kind'] != 'dt':
+            return value
+        ts = pd.Timestamp(value)
+        if isinstance(value, str):
+            # partial date strings cover their whole period, as in pandas
+            # ('2017-01' as an end bound means the end of January)
+            try:
+                period = pd.Period(value)
+                ts = period.start_time if side == 'left' else period.end_time
+            except ValueError:
+                pass
+        if spec['tz'] is not None:
+            ts = ts.tz_localize('UTC') if ts.tzinfo is None \
+                else ts.tz_convert('UTC')
+            ts = ts.tz_localize(None)
+        return ts.value
+
+    def read(self, columns=None, start=None, end=None):
+        '''
+        Load the table (or a column projection / index range of it) as a
+        DataFrame
+
+        Parameters:
+        -----------
+        columns (list) columns to load, default all
+        start, end (scalar) inclusive index bounds (e.g. date strings for a
+                            datetime index)
+        '''
+        lo, hi = self.row_range(start, end)
+        columns = self.columns if columns is None else list(columns)
+        data = {}
+        for name in columns:
+            data[name] = self._decode(self._spec(name), lo, hi)
+        index = None
+        if self.meta['index'] is not None:
+            index = self._decode(self._spec(self.meta['index']), lo, hi)
+            name = self.meta['index']
+            index = pd.Index(index, name=None if name == '__index__' else name)
+        return pd.DataFrame(data, index=index, columns=columns)
+
+    def iter_chunks(self, size, columns=None):
+        '''
+        Read the table in order as DataFrames of at most size rows
+        '''
+        columns = self.columns if columns is None else list(columns)
+        name = self.meta['index']
+        for lo in range(0, self.meta['nrows'], size):
+            hi = min(lo + size, self.meta['nrows'])
+            data = {col: self._decode(self._spec(col), lo, hi)
+                    for col in columns}
+            index = None
+            if name is not None:
+                index = pd.Index(self._decode(self._spec(name), lo, hi),
+                                 name=None if name == '__index__' else name)
+            yield pd.DataFrame(data, index=index, columns=columns)
+
+
+class TableWriter(object):
+    '''
+    Buffers row dicts (e.g. parsed XML markers or JSON events) and appends
+    them to a ColumnTable in batches, casting each batch to a declared schema
+    first so the stored columns are typed.
+
+    types maps column name -> float, str or 'datetime'. Keys found in rows but
+    not in types become str columns if they appear in the first batch; any
+    later surprises are kept as json in an '_extra' column rather than
+    dropped.
+    '''
+    def __init__(self, table, types, batch_size=1000):
+        self.table = table
+        self.types = dict(types)
+        self.batch_size = batch_size
+        self.columns = list(table.columns) if table.exists() else None
+        self.rows = []
+        self.n = 0
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.columns is None:
+            extra = sorted(set(k for row in self.rows for k in row) -
+                           set(self.types))
+            for k in extra:
+                self.types[k] = str
+            self.columns = list(self.types) + ['_extra']
+        known = set(self.columns)
+        data = {col: [row.get(col) for row in self.rows]
+                for col in self.columns if col != '_extra'}
+        extras = [{k: v for k, v in row.items() if k not in known}
+                  for row in self.rows]
+        data['_extra'] = [json.dumps(e) if e else None for e in extras]
+        df = pd.DataFrame(data, columns=self.columns)
+        for col in self.columns:
+            kind = self.types.get(col, str)
+            if kind == 'datetime':
+                df[col] = pd.to_datetime(df[col], errors='coerce')
+            elif kind == str:
+                df[col] = df[col].astype(object).where(df[col].notnull(),
+                                                       None)
+            else:
+                df[col] = pd.to_numeric(df[col], errors='coerce').astype(kind)
+        self.table.append(df)
+        self.n += len(self.rows)
+        self.rows = []
@@ -2,12 +2,27 @@
 @author: MPeters, ABerner
 """
 
+import gzip
 import json
-import requests
+import os
+import random
+import re
+import threading
 import time
-import pandas as pd
 
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from email.utils import parsedate_to_datetime
 from gzip import GzipFile
+from urllib.parse import urlsplit
+
+import metrics
+
+mwnet_dict = {'SNOTEL': 25,
+              'NWAC': 37,
+              'BTAVAL': 48}
 
 
 class JsonFile(object):
@@ -42,6 +57,9 @@ class JsonFile(object):
         encoded = '{0}\n'.format(item_as_json)
         self._file.write(encoded)
 
+    def flush(self):
+        self._file.flush()
+
     def __enter__(self):
         self._file = open(*self._args, **self._kwargs)
         self._file.__enter__()
@@ -54,64 +72,727 @@ class JsonFile(object):
 class GzipJsonFile(JsonFile):
     '''
     A gzip compressed JsonFile.  Usage is the same as JsonFile
+
+    With index=True the file is written as a sequence of independently
+    compressed gzip members, one per record, and a sidecar <filename>.idx
+    (see RecordIndex) maps each record's url and date to the byte range of
+    its member. The file is still a plain gzip stream for iteration, but when
+    the index exists a reader can seek straight to a record:
+
+    with GzipJsonFile('advisories.json.gz', 'r') as fin:
+        line = fin.get('http://www.jhavalanche.org/viewTeton?...')
+        for line in fin.range('2017-01-01', '2017-01-31'):
+            pass
+
+    Extra keyword arguments to write() are stored in the index entry. With
+    sync=True each record is fsync'd before it is indexed, so the index never
+    points past durable data.
     '''
+    def __init__(self, *args, index=False, sync=False, **kwargs):
+        super(GzipJsonFile, self).__init__(*args, **kwargs)
+        self._index = index
+        self._sync = sync
+        self._raw = None
+        self._entries = None
+        self.filename = kwargs.get('filename', args[0] if args else None)
+        self.mode = kwargs.get('mode', args[1] if len(args) > 1 else 'rb')
+
     def __enter__(self):
-        self._file = GzipFile(*self._args, **self._kwargs)
+        if self._index and self.mode[0] in 'wa':
+            self._file = open(self.filename, self.mode[0] + 'b')
+            self._idx = RecordIndex(self.filename + '.idx').open(self.mode[0])
+            self._idx.__enter__()
+        else:
+            self._file = GzipFile(*self._args, **self._kwargs)
         self._file.__enter__()
         return self
 
-    def write(self, item):
-        item_as_json = json.dumps(item, ensure_ascii=False)
-        encoded = '{0}\n'.format(item_as_json).encode('utf-8', 'ignore')
-        self._file.write(encoded)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._raw is not None:
+            self._raw.close()
+        if self._index and self.mode[0] in 'wa':
+            self._idx.__exit__(exc_type, exc_val, exc_tb)
+        super(GzipJsonFile, self).__exit__(exc_type, exc_val, exc_tb)
+
+    def write(self, item, **extra):
+        if not self._index:
+            item_as_json = json.dumps(item, ensure_ascii=False)
+            encoded = '{0}\n'.format(item_as_json).encode('utf-8', 'ignore')
+            self._file.write(encoded)
+            return
+        data = gzip_member(item)
+        offset = self._file.tell()
+        self._file.write(data)
+        if self._sync:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        entry = {'url': item.get('url'),
+                 'date': record_date(item),
+                 'offset': offset,
+                 'length': len(data)}
+        entry.update(extra)
+        self._idx.write(entry)
+        if self._sync:
+            self._idx.flush()
+
+    def index(self):
+        '''
+        Index entries sorted by date (None last), loaded on first use
+        '''
+        if self._entries is None:
+            entries = RecordIndex(self.filename + '.idx').load()
+            if not entries:
+                raise IOError("no index found for {0}".format(self.filename))
+            self._entries = sorted(entries,
+                                   key=lambda e: (e['date'] is None,
+                                                  e['date'] or ''))
+            self._dates = [e['date'] for e in self._entries
+                           if e['date'] is not None]
+            self._by_url = {e['url']: e for e in self._entries}
+        return self._entries
+
+    def _read_entry(self, entry):
+        if self._raw is None:
+            self._raw = open(self.filename, 'rb')
+        self._raw.seek(entry['offset'])
+        data = gzip.decompress(self._raw.read(entry['length']))
+        return json.loads(data.decode('utf-8'))
+
+    def read(self, entries):
+        '''
+        Yield the records for the given index entries (e.g. a filtered
+        RecordIndex.load()), in the order given
+        '''
+        for entry in entries:
+            yield self._read_entry(entry)
+
+    def get(self, url):
+        '''
+        Return the record for url without scanning the file, or None
+        '''
+        self.index()
+        entry = self._by_url.get(url)
+        if entry is None:
+            return None
+        return self._read_entry(entry)
+
+    def range(self, start=None, end=None):
+        '''
+        Yield records dated in [start, end] (ISO date strings), in date order
+        '''
+        entries = self.index()
+        lo = bisect_left(self._dates, start) if start else 0
+        hi = bisect_right(self._dates, end) if end else len(self._dates)
+        for entry in entries[lo:hi]:
+            yield self._read_entry(entry)
+
+
+class RecordIndex(object):
+    '''
+    Sidecar index of an indexed GzipJsonFile, stored as a JsonFile at
+    <filename>.idx. Each line holds a record's url, date, and the byte offset
+    and length of its gzip member; DataFetcher also stores the HTTP status,
+    content size and fetch time, which makes the index its resume log.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _scan(self):
+        entries = []
+        good_bytes = 0
+        with open(self.filename, 'rb') as fin:
+            for raw in fin:
+                if not raw.endswith(b'\n'):
+                    break
+                try:
+                    entries.append(json.loads(raw.decode('utf-8')))
+                except ValueError:
+                    break
+                good_bytes += len(raw)
+        return entries, good_bytes
+
+    def load(self):
+        '''
+        Return the index entries. A partially written last line (the process
+        died mid-write) is left out; the file itself is not modified.
+        '''
+        if not os.path.isfile(self.filename):
+            return []
+        return self._scan()[0]
+
+    def repair(self):
+        '''
+        Like load, but also trim a partially written last line from the file
+        so appends stay valid. Only for writers about to append.
+        '''
+        if not os.path.isfile(self.filename):
+            return []
+        entries, good_bytes = self._scan()
+        if good_bytes != os.path.getsize(self.filename):
+            with open(self.filename, 'r+b') as fout:
+                fout.truncate(good_bytes)
+        return entries
+
+    def open(self, mode='a'):
+        return JsonFile(self.filename, mode, encoding='utf-8')
+
+
+def record_date(item):
+    '''
+    Date key for a record: its 'date' field, or the first YYYY-MM-DD found in
+    its url (e.g. the data_date parameter of a BTAC advisory url)
+    '''
+    if item.get('date'):
+        return item['date']
+    match = _date_re.search(item.get('url') or '')
+    if match:
+        return match.group()
+    return None
+
+
+_date_re = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+def gzip_member(item):
+    '''
+    Serialize one record as a self-contained gzip member. Concatenated members
+    form a valid gzip stream, so files built this way read with GzipJsonFile
+    but can be appended to and truncated at record boundaries.
+    '''
+    item_as_json = json.dumps(item, ensure_ascii=False)
+    return gzip.compress('{0}\n'.format(item_as_json).encode('utf-8',
+                                                             'ignore'))
+
+
+def batched(iterable, n):
+    '''
+    Yield successive lists of up to n items from iterable
+    '''
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bounded_map(executor, func, iterable, max_pending, args=()):
+    '''
+    Like executor.map(func, iterable), but submits lazily so that at most
+    max_pending calls are queued at a time. Results are yielded in input
+    order. Extra positional args are passed to every call.
+    '''
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(func, item, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+retry_statuses = (429, 500, 502, 503, 504)
+
+
+class RetryError(Exception):
+    '''
+    Raised when a call still fails after all retries. `response` is the last
+    response if the failure was a retriable HTTP status.
+    '''
+    def __init__(self, message, response=None):
+        super(RetryError, self).__init__(message)
+        self.response = response
+
+
+class CircuitOpenError(RetryError):
+    '''
+    Raised instead of calling a host whose circuit breaker is open (only
+    when the policy is set not to wait for it)
+    '''
+
+
+def _retriable_exceptions():
+    errors = (ConnectionError, TimeoutError)
+    try:
+        from requests import exceptions as rex
+    except ImportError:
+        return errors
+    return errors + (rex.ConnectionError, rex.Timeout,
+                     rex.ChunkedEncodingError)
+
+
+def retry_after(response, now=None):
+    '''
+    Seconds to wait according to a response's Retry-After header (seconds
+    or an HTTP date), or None
+    '''
+    value = getattr(response, 'headers', {}).get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or time.time()
+    return max(0.0, when.timestamp() - now)
+
+
+class CircuitBreaker(object):
+    '''
+    Stops calls to a failing host for a while
+
+    After failure_threshold consecutive failures the circuit opens and
+    callers are told to wait reset_timeout seconds. Then a single trial call
+    is let through (half-open): success closes the circuit, failure opens it
+    again.
+    '''
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Seconds to wait before calling; 0 means go ahead (in the half-open
+        state this claims the trial call)
+        '''
+        with self._lock:
+            if self.state == 'closed':
+                return 0.0
+            now = time.monotonic()
+            if self.state == 'open':
+                remaining = self.opened_at + self.reset_timeout - now
+                if remaining > 0:
+                    return remaining
+                self.state = 'half-open'
+                self._trial = False
+            if not self._trial:
+                self._trial = True
+                return 0.0
+            return min(1.0, self.reset_timeout)
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or \
+                    self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    metrics.inc('circuit_opened')
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self._trial = False
+
+
+class RetryPolicy(object):
+    '''
+    Retries with decorrelated jitter, Retry-After and per-host circuit
+    breakers, shared by the fetchers
+
+    Only transient failures are retried: connection errors and timeouts,
+    and responses whose status is in `statuses` (429 and 5xx by default).
+    Anything else, including 404s and programming errors, is returned or
+    raised at once. Waits follow the "decorrelated jitter" scheme
+    (uniformly between initial_wait and 3x the previous wait, capped at
+    max_wait), but never less than the server's Retry-After. When a call
+    still fails after max_retries, RetryError is raised, so throttled or
+    error pages are never mistaken for content.
+
+    Each host has a CircuitBreaker; while it is open, callers wait for it
+    (wait_open=True) or get a CircuitOpenError. Under sustained throttling
+    a backfill therefore slows down to one probe per reset_timeout instead
+    of hammering the server.
+
+    policy = RetryPolicy(max_retries=8, max_wait=120)
+    response = policy.call(session.get, (url,), {'timeout': 30},
+                           host=urlsplit(url).netloc)
+    '''
+    def __init__(self, max_retries=5, initial_wait=1.0, max_wait=60.0,
+                 statuses=retry_statuses, failure_threshold=5,
+                 reset_timeout=60.0, wait_open=True, max_retry_after=600.0,
+                 sleep=time.sleep):
+        self.max_retries = max_retries
+        self.initial_wait = initial_wait
+        self.max_wait = max_wait
+        self.statuses = set(statuses)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.wait_open = wait_open
+        self.max_retry_after = max_retry_after
+        self.sleep = sleep
+        self._exceptions = None
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def exceptions(self):
+        '''
+        Exception classes that are retried, resolved on first use so that
+        importing common (e.g. for its paths) does not load requests
+        '''
+        if self._exceptions is None:
+            self._exceptions = _retriable_exceptions()
+        return self._exceptions
+
+    def breaker(self, host):
+        if host is None:
+            return None
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self.failure_threshold,
+                                                      self.reset_timeout)
+            return self._breakers[host]
+
+    def next_wait(self, prev_wait, response=None):
+        wait = min(self.max_wait,
+                   random.uniform(self.initial_wait,
+                                  max(self.initial_wait, prev_wait * 3)))
+        server = retry_after(response) if response is not None else None
+        if server is not None:
+            wait = max(wait, min(server, self.max_retry_after))
+        return wait
+
+    def _failed(self, result):
+        '''
+        (retriable, response) for a call's result
+        '''
+        status = getattr(result, 'status_code', None)
+        return status in self.statuses, result
+
+    def _attempts(self, name, host):
+        '''
+        Drives the retry loop shared by call and call_async: yields
+        ('wait', seconds) before each attempt as needed and ('call', None)
+        for each attempt; the caller sends back the outcome as
+        (exception, result).
+        '''
+        breaker = self.breaker(host)
+        wait = self.initial_wait
+        n = 0
+        while True:
+            while breaker is not None:
+                hold = breaker.acquire()
+                if not hold:
+                    break
+                if not self.wait_open:
+                    raise CircuitOpenError("circuit open for " + host)
+                metrics.inc('circuit_waits', host=host)
+                yield 'wait', hold
+            exc, result = yield 'call', None
+            retriable, response = (True, None) if exc is not None else \
+                self._failed(result)
+            if not retriable:
+                if breaker is not None:
+                    breaker.record_success()
+                return
+            if breaker is not None:
+                breaker.record_failure()
+            if response is not None and hasattr(response, 'close'):
+                # release the connection of a streamed error response
+                response.close()
+            n += 1
+            if n > self.max_retries:
+                metrics.inc('retry_failures', func=name)
+                if exc is not None:
+                    raise exc
+                raise RetryError("{0} still failing with status {1} after "
+                                 "{2} retries".format(
+                                     name, response.status_code,
+                                     self.max_retries), response)
+            wait = self.next_wait(wait, response)
+            reason = type(exc).__name__ if exc is not None \
+                else str(response.status_code)
+            metrics.inc('retries', func=name, host=host, reason=reason)
+            metrics.event('retry', func=name, host=host, reason=reason,
+                          attempt=n, wait=wait)
+            yield 'wait', wait
+
+    def call(self, func, args=(), kwargs=None, host=None):
+        '''
+        func(*args, **kwargs) with retries; host selects the circuit breaker
+        '''
+        kwargs = kwargs or {}
+        name = getattr(func, '__name__', 'call')
+        steps = self._attempts(name, host)
+        step = next(steps)
+        result = None
+        try:
+            while True:
+                if step[0] == 'wait':
+                    self.sleep(step[1])
+                    step = next(steps)
+                    continue
+                try:
+                    result = func(*args, **kwargs)
+                    outcome = (None, result)
+                except self.exceptions as e:
+                    outcome = (e, None)
+                step = steps.send(outcome)
+        except StopIteration:
+            return result
+
+    async def call_async(self, func, args=(), kwargs=None, host=None):
+        '''
+        Same as call for a coroutine function (e.g. an aiohttp request),
+        waiting with asyncio.sleep so other tasks keep running
+        '''
+        import asyncio
+        kwargs = kwargs or {}
+        name = getattr(func, '__name__', 'call')
+        steps = self._attempts(name, host)
+        step = next(steps)
+        result = None
+        try:
+            while True:
+                if step[0] == 'wait':
+                    await asyncio.sleep(step[1])
+                    step = next(steps)
+                    continue
+                try:
+                    result = await func(*args, **kwargs)
+                    outcome = (None, result)
+                except self.exceptions + (asyncio.TimeoutError,) as e:
+                    outcome = (e, None)
+                step = steps.send(outcome)
+        except StopIteration:
+            return result
+
+
+default_policy = RetryPolicy()
 
 
 def retry(func, args, kwargs, initial_wait=1.0, max_retries=5):
     '''
-    Call the function with retries and exponential backoff
+    Call the function with retries and backoff (see RetryPolicy)
 
     func: a callable func(args, kwargs)
     '''
-    n = 0
-    wait = initial_wait
-    while True:
-        try:
-            ret = func(*args, **kwargs)
-            break
-        except:
-            n += 1
-            if n > max_retries:
-                raise
-            print("Retry {0}, waiting {1}".format(n, wait))
-            time.sleep(wait)
-            wait *= 2
-    return ret
+    policy = RetryPolicy(max_retries=max_retries, initial_wait=initial_wait)
+    return policy.call(func, args, kwargs)
+
+
+class TokenBucket(object):
+    '''
+    Thread-safe token bucket rate limiter
+
+    Tokens refill continuously at `rate` per second up to `capacity`; each
+    acquire() blocks until a token is available.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens +
+                                   (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_time = (tokens - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class HostRateLimiter(object):
+    '''
+    Keeps one TokenBucket per host so that requests to different servers
+    don't throttle each other. A rate of None disables limiting.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url):
+        if not self.rate:
+            return
+        host = urlsplit(url).netloc
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+                self._buckets[host] = bucket
+        bucket.acquire()
+
+
+def make_session(pool_size=10):
+    '''
+    Build a requests Session whose connection pool can keep `pool_size`
+    keep-alive connections per host open, so concurrent workers reuse sockets
+    instead of reconnecting for every page.
+    '''
+    # requests is only imported once something is fetched, so analysis
+    # code importing common stays light
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 class DataFetcher(object):
     '''
     Fetch pages and save them to disk
 
-    Takes a list of URLs, fetches, and saves to disk
+    Takes a list of URLs, fetches, and saves to disk. By default pages are
+    fetched one at a time, at most one request per `sleep_interval` seconds.
+    Set max_workers > 1 to keep several requests in flight on a thread pool;
+    `rate` (requests/second per host, default 1/sleep_interval) and `burst`
+    control how hard any one server is hit regardless of the worker count.
+
+    # e.g. 4 requests in flight, but no more than 2 per second to each host
+    fetcher = DataFetcher(max_workers=4, rate=2, burst=2)
+    fetcher.fetch_pages(urls, 'advisories.json.gz')
+
+    Pass an httpcache.ResponseCache as `cache` to serve repeat fetches from
+    disk; cache hits skip the rate limiter.
+
+    Failed requests are retried according to `policy` (a RetryPolicy,
+    default the shared default_policy, so every fetcher in a process backs
+    off together from a throttling host). Pages that still fail are
+    reported and left out of the output rather than saved as content.
     '''
-    def __init__(self, sleep_interval=1):
+    def __init__(self, sleep_interval=1, max_workers=1, rate=None, burst=1,
+                 session=None, cache=None, policy=None):
         self.sleep_interval = sleep_interval
+        self.max_workers = max(1, int(max_workers))
+        if rate is None and sleep_interval:
+            rate = 1.0 / sleep_interval
+        self.limiter = HostRateLimiter(rate, burst)
+        self.session = session or make_session(pool_size=self.max_workers)
+        self.cache = cache
+        self.policy = policy or default_policy
 
-    def fetch_pages(self, urls, outfile):
+    def _get(self, url, host):
+        with metrics.timer('rate_limit_wait_seconds', host=host):
+            self.limiter.acquire(url)
+        if self.cache:
+            return self.cache.get(url, session=self.session)
+        return self.session.get(url)
+
+    def fetch_page(self, url):
         '''
-        Given a list of URL strings, fetch the content and save to the file
+        Fetch a single URL (rate limited, with retries) and return the record
+        that gets written to the output file, or None if it kept failing
         '''
-        with GzipJsonFile(outfile, 'w') as fout:
+        host = urlsplit(url).netloc
+        response = self.cache and self.cache.fresh('GET', url)
+        if response:
+            metrics.inc('cache_hits', host=host)
+        else:
+            try:
+                with metrics.timer('request_seconds', host=host):
+                    response = self.policy.call(self._get, (url, host),
+                                                host=host)
+            except (RetryError,) + self.policy.exceptions as e:
+                metrics.inc('failed_pages', host=host)
+                print("Giving up on {0}: {1}".format(url, e))
+                return None
+        metrics.inc('requests', host=host, status=response.status_code)
+        metrics.inc('bytes', len(response.content), host=host)
+        return {
+            'url': url,
+            'time': datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'status': response.status_code,
+            'content': response.text
+        }
+
+    def iter_pages(self, urls):
+        '''
+        Yield fetched records as they complete. With a single worker records
+        come back in the order of urls; otherwise in completion order. Pages
+        that could not be fetched are skipped.
+        '''
+        if self.max_workers == 1:
+            for u in urls:
+                line = self.fetch_page(u)
+                if line is not None:
+                    yield line
+            return
+        # bound the number of queued futures so a long url list doesn't
+        # pile up finished pages in memory while the writer catches up
+        max_pending = 2 * self.max_workers
+        urls = iter(urls)
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
             for u in urls:
-                response = retry(requests.get, (u,), {})
-                line = {
-                    'url': u,
-                    'time': pd.datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'),
-                    'status': response.status_code,
-                    'content': response.text
-                }
-                fout.write(line)
-                print("Fetched {0}, length={1}".format(u, len(response.text)))
-                time.sleep(self.sleep_interval)
+                pending.add(pool.submit(self.fetch_page, u))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future.result() is not None:
+                            yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.result() is not None:
+                        yield future.result()
 
+    def fetch_pages(self, urls, outfile, resume=False):
+        '''
+        Given a list of URL strings, fetch the content and save to the file
+
+        The output is an indexed GzipJsonFile: each record is its own gzip
+        member, and its <outfile>.idx entry (url, status, size, fetch time,
+        byte range) is written once the record is on disk. Pages that failed
+        after all retries are not written. With resume=True, URLs already in
+        the index (other than throttled or server errors) are skipped, any
+        partial record left by an interrupted run is cut off, and new records
+        are appended, so re-running over a full date range only fetches what
+        is missing.
+        '''
+        index = RecordIndex(outfile + '.idx')
+        mode = 'w'
+        if resume and os.path.isfile(outfile):
+            if not os.path.isfile(index.filename):
+                print("No index for {0}, cannot resume".format(outfile))
+                return None
+            entries = index.repair()
+            end = 0
+            if entries:
+                end = entries[-1]['offset'] + entries[-1]['length']
+            with open(outfile, 'r+b') as fout:
+                fout.truncate(end)
+            done = set(e['url'] for e in entries
+                       if e['status'] < 500 and
+                       e['status'] not in retry_statuses)
+            urls = list(urls)
+            n_urls = len(urls)
+            urls = [u for u in urls if u not in done]
+            metrics.inc('skipped', n_urls - len(urls), stage='fetch_pages')
+            print("Resuming {0}: {1} fetched, {2} remaining".format(
+                outfile, len(done), len(urls)))
+            mode = 'a'
 
+        with GzipJsonFile(outfile, mode, index=True, sync=True) as fout, \
+                metrics.timer('stage_seconds', stage='fetch_pages'):
+            for line in self.iter_pages(urls):
+                fout.write(line, status=line['status'],
+                           size=len(line['content']), time=line['time'])
+                metrics.inc('records', stage='fetch_pages')
+                print("Fetched {0}, length={1}".format(line['url'],
+                                                       len(line['content'])))
@@ -0,0 +1,219 @@
+"""
+@author: ABerner
+"""
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+from colstore import ColumnTable
+
+elev_bins = [6000., 7500., 9000., 10500.]
+elev_labels = ['btl', 'tl', 'atl']
+
+
+def elevation_band(elevation):
+    '''
+    Vectorized elevation band for event elevations [units: ft]: btl for
+    (6000, 7500], tl for (7500, 9000], atl for (9000, 10500], else NaN
+    '''
+    return pd.cut(elevation, bins=elev_bins, labels=elev_labels)
+
+
+def daily_event_counts(events_df, zones=None):
+    '''
+    Count events and fatal events per day and elevation band
+
+    Parameters:
+    -----------
+    events_df (DataFrame) output of processbtac.process_btac_events
+    zones (list) only count events in these zones
+
+    Returns:
+    --------
+    counts (DataFrame) indexed by day, with columns n_events_<band> and
+                       n_fatal_<band> for every band
+    '''
+    if zones is not None:
+        events_df = events_df[events_df['zone'].isin(zones)]
+    df = pd.DataFrame({'date': pd.to_datetime(events_df['event_date'])
+                                 .dt.normalize().values,
+                       'band': elevation_band(events_df['elevation']).values,
+                       'n_events': 1,
+                       'n_fatal': (events_df['fatality'].fillna(0) > 0)
+                                  .astype(int).values})
+    df = df.dropna(subset=['band'])
+    counts = df.groupby(['date', 'band'], observed=False).sum().unstack('band')
+    counts = counts.reindex(columns=pd.MultiIndex.from_product(
+        [['n_events', 'n_fatal'], elev_labels])).fillna(0).astype(int)
+    counts.columns = ['{0}_{1}'.format(kind, band)
+                      for kind, band in counts.columns]
+    return counts
+
+
+def station_grid(wx_frames, freq='1h'):
+    '''
+    Resample station frames onto a shared regular time grid (UTC) and join
+    them side by side as <stid>_<column>
+
+    Bins are closed and labelled on the right: the value at t is the mean of
+    the observations in (t - freq, t], so a backward join at an issuance
+    time never picks up observations made after it.
+
+    Parameters:
+    -----------
+    wx_frames (dict) station id -> DataFrame from processwx.process_stn
+    freq (str) pandas offset alias of the grid
+    '''
+    parts = []
+    for stid, df in wx_frames.items():
+        num = df.select_dtypes(include=[np.number])
+        if num.index.tz is None:
+            num = num.tz_localize('UTC')
+        num = num.resample(freq, closed='right', label='right').mean()
+        num.columns = ['{0}_{1}'.format(stid, col) for col in num.columns]
+        parts.append(num)
+    if not parts:
+        return pd.DataFrame(index=pd.DatetimeIndex([], tz='UTC'))
+    return pd.concat(parts, axis=1).sort_index()
+
+
+def build_dataset(hzrd_df, events_df, wx_frames, region='teton', zones=None,
+                  wx_freq='1h', tolerance='3h', tz='US/Mountain',
+                  since=None):
+    '''
+    Join hazard ratings, event counts and weather into one model-ready table
+
+    Rows are the hazard issuance times of one region (am and pm). Event
+    counts per elevation band are joined on the calendar day, and each
+    station's weather, resampled to wx_freq (see station_grid), is attached
+    with a backward merge_asof: the latest grid value at or before the
+    issuance time, if it is no older than tolerance, so only observations
+    up to the issuance time are used. Hazard times are local (tz); weather
+    is UTC.
+
+    Parameters:
+    -----------
+    hzrd_df (DataFrame) output of processbtac.process_btac_nowcast
+    events_df (DataFrame) output of processbtac.process_btac_events
+    wx_frames (dict) station id -> DataFrame from processwx.process_stn
+    since (datetime) only build rows at or after this time
+
+    Returns:
+    --------
+    df (DataFrame) indexed by issuance time with columns atl, tl, btl,
+                   n_events_<band>, n_fatal_<band>, <stid>_<column>...
+    '''
+    hz = hzrd_df[hzrd_df['region'] == region][elev_labels[::-1]]
+    hz = hz.sort_index()
+    if since is not None:
+        hz = hz[hz.index >= pd.Timestamp(since)]
+    hz.index.name = 'date'
+
+    counts = daily_event_counts(events_df, zones=zones)
+    days = hz.index.normalize()
+    counts = counts.reindex(days).fillna(0).astype(int)
+    counts.index = hz.index
+    out = pd.concat([hz, counts], axis=1)
+
+    wx = station_grid(wx_frames, freq=wx_freq)
+    utc = hz.index.tz_localize(tz, ambiguous='NaT',
+                               nonexistent='shift_forward').tz_convert('UTC')
+    left = pd.DataFrame({'utc': utc, 'date': hz.index})
+    right = wx.reset_index()
+    right.columns = ['utc'] + list(wx.columns)
+    if hasattr(right['utc'].dt, 'as_unit'):
+        left['utc'] = left['utc'].dt.as_unit('ns')
+        right['utc'] = right['utc'].dt.as_unit('ns')
+    joined = pd.merge_asof(left.dropna(subset=['utc']), right, on='utc',
+                           direction='backward',
+                           tolerance=pd.Timedelta(tolerance))
+    joined = joined.set_index('date').drop('utc', axis=1)
+    out = out.join(joined, how='left')
+    return out
+
+
+class DatasetBuilder(object):
+    '''
+    Cached, incremental wrapper around build_dataset
+
+    The table for each region is kept as a ColumnTable under
+    <cachedir>/<region>, tagged with a fingerprint of the build parameters.
+    When the fingerprint matches, only rows from refresh_days before the
+    last cached issuance time onwards are rebuilt (events and late weather
+    for recent days can still change), and only that window of station data
+    is loaded from the StationStore. Changing parameters, stations or
+    columns triggers a full rebuild.
+
+    builder = DatasetBuilder('datasets', store=StationStore('wxdata'),
+                             stids=['JHR', 'RVG'],
+                             wx_columns=['air_temp_set_1'])
+    df = builder.build(hzrd_df, events_df, region='teton')
+    '''
+    def __init__(self, cachedir, store=None, stids=(), wx_columns=None,
+                 zones=None, wx_freq='1h', tolerance='3h', tz='US/Mountain',
+                 refresh_days=3):
+        self.cachedir = cachedir
+        self.store = store
+        self.stids = list(stids)
+        self.wx_columns = wx_columns
+        self.zones = zones
+        self.wx_freq = wx_freq
+        self.tolerance = tolerance
+        self.tz = tz
+        self.refresh_days = refresh_days
+
+    def _columns(self, stid):
+        columns = self.store.table(stid).columns
+        if self.wx_columns is not None:
+            columns = [c for c in self.wx_columns if c in columns]
+        return columns
+
+    def fingerprint(self, region):
+        # version 2: weather bins closed on the right (no observations from
+        # after the issuance time)
+        params = {'version': 2,
+                  'region': region,
+                  'stids': {stid: self._columns(stid) for stid in self.stids},
+                  'zones': self.zones,
+                  'wx_freq': self.wx_freq,
+                  'tolerance': self.tolerance,
+                  'tz': self.tz}
+        return hashlib.sha1(json.dumps(params, sort_keys=True)
+                            .encode('utf-8')).hexdigest()
+
+    def build(self, hzrd_df, events_df, region='teton'):
+        tbl = ColumnTable(self.cachedir + '/' + region)
+        fp = self.fingerprint(region)
+        since = None
+        if tbl.exists() and tbl.attrs.get('fingerprint') == fp and len(tbl):
+            last = pd.Timestamp(tbl.column('date')[-1])
+            since = last.normalize() - pd.Timedelta(days=self.refresh_days)
+            lo, _ = tbl.row_range(start=since)
+            tbl.truncate(lo)
+        else:
+            tbl.clear()
+
+        wx_start = None
+        if since is not None:
+            wx_start = since - pd.Timedelta(days=1)
+        wx_frames = {stid: self.store.load(stid, columns=self._columns(stid),
+                                           start=wx_start)
+                     for stid in self.stids}
+        new = build_dataset(hzrd_df, events_df, wx_frames, region=region,
+                            zones=self.zones, wx_freq=self.wx_freq,
+                            tolerance=self.tolerance, tz=self.tz, since=since)
+        if tbl.exists():
+            new = new[tbl.columns]
+        tbl.append(new.astype(float), attrs={'fingerprint': fp})
+        return tbl.read()
+
+    def build_all(self, hzrd_df, events_df, regions=None):
+        '''
+        Build (or update) the table for every region in hzrd_df
+        '''
+        if regions is None:
+            regions = sorted(hzrd_df['region'].unique())
+        return {region: self.build(hzrd_df, events_df, region)
+                for region in regions}
@@ -0,0 +1,316 @@
+"""
+@author: ABerner
+"""
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+import metrics
+from dataset import elev_labels
+from panel import Panel
+
+band_names = elev_labels[::-1]
+
+# (variable, reduction, window): trailing-window features of the weather
+# before each forecast time; reductions are sum, mean, max, min and delta
+# (last value minus the first value of the window)
+default_features = [('air_temp_set_1', 'mean', '24h'),
+                    ('air_temp_set_1', 'max', '24h'),
+                    ('wind_speed_set_1', 'mean', '24h'),
+                    ('wind_speed_set_1', 'max', '24h'),
+                    ('precip_accum_one_hour_set_1', 'sum', '24h'),
+                    ('precip_accum_one_hour_set_1', 'sum', '72h'),
+                    ('snow_depth_set_1', 'delta', '24h'),
+                    ('snow_depth_set_1', 'delta', '72h')]
+
+_reductions = ('sum', 'mean', 'max', 'min', 'delta')
+
+
+class LinearHazardModel(object):
+    '''
+    Least squares hazard model: one linear regression per elevation band,
+    predictions clipped to the 1-5 danger scale. Missing features are
+    filled with their training mean.
+
+    A placeholder until the RNN of the README exists; EnsembleEngine accepts
+    any model with a predict(X) -> (n, 3) method, e.g. a fitted
+    scikit-learn regressor.
+    '''
+    def __init__(self, coef=None, intercept=None, fill=None):
+        self.coef = coef
+        self.intercept = intercept
+        self.fill = fill
+
+    def fit(self, X, y):
+        '''
+        Parameters:
+        -----------
+        X (ndarray) (n, features)
+        y (ndarray) (n, 3) ratings for atl, tl, btl
+        '''
+        X = np.asarray(X, dtype=np.float64)
+        self.fill = np.nan_to_num(np.nanmean(X, axis=0))
+        X = np.where(np.isnan(X), self.fill, X)
+        A = np.hstack([X, np.ones((len(X), 1))])
+        sol = np.linalg.lstsq(A, np.asarray(y, dtype=np.float64),
+                              rcond=None)[0]
+        self.coef = sol[:-1]
+        self.intercept = sol[-1]
+        return self
+
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        fill = 0. if self.fill is None else self.fill
+        X = np.where(np.isnan(X), fill, X)
+        return np.clip(X @ self.coef + self.intercept, 1, 5)
+
+
+class EnsembleEngine(object):
+    '''
+    Hazard predictions for a batch of ensemble weather scenarios
+
+    Members are (member, time, station, variable) arrays on the layout of
+    the observed panel, continuing its time grid. Each feature is a
+    trailing-window reduction (see default_features) over the observed
+    history followed by the member's forecast. The history is never copied
+    or concatenated onto the members: its contribution to every window
+    (the reductions over its last k rows, k < window) is computed once and
+    shared by all members, and the forecast part is reduced over a sliding
+    window view of the stacked members. Features and model predictions are
+    then computed for all members and forecast times as one batch.
+
+    panel = Panel('panels/wy')
+    engine = EnsembleEngine(model, panel.variables, stations=['JHR', 'RVG'])
+    ratings = engine.predict(panel, members)    # (member, time, band)
+    bands = engine.percentiles(ratings, times)
+
+    Parameters:
+    -----------
+    model (object) has predict(X) with X (n, station x feature) -> (n, 3)
+    variables (list) variable names of the members' last axis
+    features (list) (variable, reduction, window) tuples
+    step (str) time step of the panel and members
+    stations (list) only use these stations (names in the panel, or
+                    positions when the history is an array)
+    '''
+    def __init__(self, model, variables, features=default_features,
+                 step='1h', stations=None):
+        self.model = model
+        self.variables = list(variables)
+        self.features = [tuple(f) for f in features]
+        self.step = pd.Timedelta(step)
+        self.stations = stations
+        for var, how, window in self.features:
+            if var not in self.variables:
+                raise ValueError("feature variable not in layout: "
+                                 "{0}".format(var))
+            if how not in _reductions:
+                raise ValueError("unknown reduction: {0}".format(how))
+        self._windows = [max(1, int(pd.Timedelta(w) / self.step))
+                         for _, _, w in self.features]
+
+    @property
+    def history_rows(self):
+        '''
+        Rows of observed history the features need
+        '''
+        return max(self._windows) - 1
+
+    def _station_key(self, history):
+        if self.stations is None:
+            return slice(None)
+        if isinstance(history, Panel):
+            return Panel._axis(history.stations, self.stations)
+        return np.asarray(self.stations)
+
+    def tail(self, history):
+        '''
+        The last history_rows rows of the history (a Panel or a (time,
+        station, variable) array), for the engine's stations; a view of the
+        memory-mapped panel where the station selection allows it
+        '''
+        values = history.values if isinstance(history, Panel) else history
+        n = self.history_rows
+        tail = values[len(values) - min(n, len(values)):]
+        key = self._station_key(history)
+        return tail if _all(key) else tail[:, key]
+
+    def features_of(self, tail, members):
+        '''
+        Feature array for every member and forecast time
+
+        Parameters:
+        -----------
+        tail (ndarray) (rows, station, variable) end of the observed history
+                       (see tail)
+        members (ndarray) (member, time, station, variable) forecasts, for
+                          the same stations
+
+        Returns:
+        --------
+        X (ndarray) float32 (member, time, station, feature)
+        '''
+        m, t, s = members.shape[:3]
+        out = np.empty((m, t, s, len(self.features)), dtype=np.float32)
+        for i, ((var, how, _), n) in enumerate(zip(self.features,
+                                                   self._windows)):
+            v = self.variables.index(var)
+            out[..., i] = _window_feature(tail[:, :, v], members[..., v],
+                                          how, n)
+        return out
+
+    def predict(self, history, members):
+        '''
+        Ratings (member, time, band) with bands atl, tl, btl
+        '''
+        key = self._station_key(history)
+        if not _all(key):
+            members = members[:, :, key]
+        with metrics.timer('stage_seconds', stage='ensemble'):
+            X = self.features_of(self.tail(history), members)
+            m, t = X.shape[:2]
+            y = self.model.predict(X.reshape(m * t, -1))
+        metrics.inc('records', m * t, stage='ensemble')
+        return np.asarray(y, dtype=np.float32).reshape(m, t, -1)
+
+    @staticmethod
+    def percentiles(ratings, times=None, q=(10, 25, 50, 75, 90)):
+        '''
+        Percentiles over members of the ratings of each band and time
+
+        Returns:
+        --------
+        bands (DataFrame) indexed by forecast time, columns (band, percentile)
+        '''
+        pct = np.nanpercentile(ratings, q, axis=0)
+        data = {(band, p): pct[j, :, b]
+                for b, band in enumerate(band_names)
+                for j, p in enumerate(q)}
+        df = pd.DataFrame(data, index=times)
+        df.columns = pd.MultiIndex.from_tuples(df.columns,
+                                               names=['band', 'percentile'])
+        return df
+
+
+def _all(key):
+    return isinstance(key, slice) and key == slice(None)
+
+
+def _window_feature(hist, fc, how, n):
+    '''
+    One trailing-window reduction of n rows ending at every forecast step
+
+    hist is the shared (rows, station) end of the history and fc the
+    (member, time, station) forecasts; the window ending at step t covers
+    the last n - 1 - t history rows (if t < n - 1) and forecast steps
+    max(0, t - n + 1) .. t.
+    '''
+    m, t, s = fc.shape
+    steps = np.arange(t)
+    # history rows in each step's window, and reductions over the last k
+    # rows of the history for every k (row k - 1), computed once
+    k = np.clip(n - 1 - steps, 0, len(hist))
+    rev = hist[::-1].astype(np.float64)
+    ok = np.isfinite(rev)
+    h_sum = np.concatenate([np.zeros((1, s)),
+                            np.cumsum(np.where(ok, rev, 0.), axis=0)])[k]
+    h_cnt = np.concatenate([np.zeros((1, s)), np.cumsum(ok, axis=0)])[k]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if how in ('sum', 'mean'):
+            # running sums along the forecast axis (row j: steps before j),
+            # so each window is a difference of two rows, as for the history
+            f_ok = np.isfinite(fc)
+            zero = np.zeros((m, 1, s))
+            f_sum = np.concatenate([zero, np.cumsum(
+                np.where(f_ok, fc, 0.), axis=1, dtype=np.float64)], axis=1)
+            f_cnt = np.concatenate([zero, np.cumsum(f_ok, axis=1)], axis=1)
+            lo = np.maximum(steps - n + 1, 0)
+            total = f_sum[:, steps + 1] - f_sum[:, lo] + h_sum
+            count = f_cnt[:, steps + 1] - f_cnt[:, lo] + h_cnt
+            if how == 'sum':
+                return np.where(count > 0, total, np.nan)
+            return total / count
+        if how in ('max', 'min'):
+            pad = np.full((m, n - 1, s), np.nan, dtype=fc.dtype)
+            win = sliding_window_view(np.concatenate([pad, fc], axis=1), n,
+                                      axis=1)[:, :t]
+            acc = np.fmax if how == 'max' else np.fmin
+            h_ext = np.full((len(hist) + 1, s), np.nan)
+            if len(hist):
+                h_ext[1:] = acc.accumulate(rev, axis=0)
+            return acc(acc.reduce(win, axis=-1), h_ext[k])
+        # delta: last value minus the first value of the window
+        start = steps - n + 1
+        f_first = fc[:, np.clip(start, 0, t - 1)]
+        h_first = np.full((t, s), np.nan)
+        back = n - 1 - steps
+        has = (back > 0) & (back <= len(hist))
+        h_first[has] = hist[len(hist) - back[has]]
+        first = np.where((start >= 0)[None, :, None], f_first, h_first)
+        return fc - first
+
+
+def _predict_shard(engine, tail, members):
+    return engine.predict(tail, members)
+
+
+def evaluate_ensemble(history, members, engines, times=None, n_jobs=1,
+                      n_shards=None, q=(10, 25, 50, 75, 90)):
+    '''
+    Percentile hazard bands per region and elevation band for an ensemble
+
+    Parameters:
+    -----------
+    history (Panel or ndarray) observed weather, (time, station, variable)
+    members (ndarray) (member, time, station, variable) forecasts
+                      continuing the history's time grid
+    engines (dict) region -> EnsembleEngine
+    times (DatetimeIndex) forecast times, default the steps after the end
+                          of the Panel
+    n_jobs (int) processes; with more than one, members are split into
+                 n_shards (default n_jobs) shards and every (region, shard)
+                 is one task. Only the history rows the features need are
+                 sent to the workers.
+
+    Returns:
+    --------
+    bands (dict) region -> DataFrame of percentiles (see
+                 EnsembleEngine.percentiles)
+    '''
+    if times is None and isinstance(history, Panel):
+        times = history.times[-1] + history.step * \
+            np.arange(1, members.shape[1] + 1)
+    regions = list(engines)
+    tails = {}
+    for region in regions:
+        engine = engines[region]
+        key = engine._station_key(history)
+        tails[region] = (np.array(engine.tail(history)),
+                         members if _all(key) else members[:, :, key])
+    # stations are already selected in the tails and members
+    tasks = []
+    for region in regions:
+        engine = engines[region]
+        engine = EnsembleEngine(engine.model, engine.variables,
+                                engine.features, engine.step)
+        tail, mem = tails[region]
+        shards = np.array_split(np.arange(len(mem)),
+                                n_shards or max(1, n_jobs))
+        tasks.extend((region, engine, tail, mem[idx])
+                     for idx in shards if len(idx))
+    if n_jobs == 1:
+        results = [_predict_shard(e, tl, mb) for _, e, tl, mb in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_predict_shard,
+                                    [task[1] for task in tasks],
+                                    [task[2] for task in tasks],
+                                    [task[3] for task in tasks]))
+    bands = {}
+    for region in regions:
+        ratings = np.concatenate([r for task, r in zip(tasks, results)
+                                  if task[0] == region], axis=0)
+        bands[region] = EnsembleEngine.percentiles(ratings, times, q)
+    return bands
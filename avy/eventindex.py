@@ -0,0 +1,317 @@
+"""
+@author: ABerner
+"""
+import numpy as np
+import pandas as pd
+
+from dataset import elevation_band
+from geo import GeoIndex
+
+
+class EventIndex(object):
+    '''
+    Spatio-temporal index over avalanche events or observations
+
+    Rows are sorted by date, so a date range is a binary search to one
+    contiguous block of rows. Zone and elevation band are secondary keys:
+    each maps to the (date-sorted) row positions holding that value, so a
+    zone or band restriction of a date range is another pair of binary
+    searches rather than a filter over the whole table. Locations go in a
+    geo.GeoIndex for radius queries, and per-day, per-zone, per-band counts
+    are aggregated once up front, so count views over any period are
+    computed from a table with at most one row per day and key.
+
+    idx = EventIndex.from_events(pd.read_csv('btac_events.csv.gz',
+                                             index_col=0))
+    df = idx.query('2017-01-01', '2017-01-31', zones=['Teton'], bands=['atl'])
+    near = idx.query('2017-01-01', '2017-01-31', lat=43.59, lon=-110.87,
+                     r_km=10)
+    monthly = idx.counts(freq='MS', by='zone')
+
+    Parameters:
+    -----------
+    df (DataFrame) one row per event/observation
+    date_col, lat_col, lon_col, zone_col, elev_col (str) column names; elev
+                  may be None when there is no elevation (observations)
+    fatal_col (str) column counted as fatalities when > 0, or None
+    cell_deg (float) GeoIndex cell size [units: degrees]
+    '''
+    def __init__(self, df, date_col='event_date', lat_col='lat',
+                 lon_col='lng', zone_col='zone', elev_col='elevation',
+                 fatal_col='fatality', cell_deg=0.1):
+        dates = pd.to_datetime(df[date_col])
+        order = np.argsort(dates.values, kind='stable')
+        self.df = df.iloc[order].reset_index(drop=True)
+        self.dates = pd.DatetimeIndex(dates.values[order])
+        self._days = self.dates.values.astype('datetime64[D]')
+
+        zones = self.df[zone_col].astype(object).where(
+            self.df[zone_col].notnull(), None).values
+        self.zones = self._keys(zones)
+        if elev_col is not None:
+            bands = elevation_band(pd.to_numeric(self.df[elev_col],
+                                                 errors='coerce'))
+            bands = np.asarray(bands.astype(object).where(bands.notnull(),
+                                                          None))
+        else:
+            bands = np.full(len(self.df), None, dtype=object)
+        self.bands = self._keys(bands)
+        self._zone_values = zones
+        self._band_values = bands
+
+        lat = pd.to_numeric(self.df[lat_col], errors='coerce').values
+        lon = pd.to_numeric(self.df[lon_col], errors='coerce').values
+        located = np.isfinite(lat) & np.isfinite(lon)
+        self._geo_rows = np.flatnonzero(located)
+        self.geo = GeoIndex(lat[located], lon[located], cell_deg=cell_deg)
+        self.lat = lat
+        self.lon = lon
+
+        fatal = None
+        if fatal_col is not None and fatal_col in self.df.columns:
+            fatal = pd.to_numeric(self.df[fatal_col], errors='coerce') \
+                .fillna(0).values > 0
+        self.daily = self._aggregate(fatal)
+
+    @classmethod
+    def from_events(cls, df, **kwargs):
+        '''
+        Index the output of processbtac.process_btac_events
+        '''
+        return cls(df, **kwargs)
+
+    @classmethod
+    def from_obs(cls, df, **kwargs):
+        '''
+        Index BTAC observations, as loaded from fetchbtac.fetch_btac_obs
+        (attribute keys with an '@' prefix) or fetchbtac.stream_btac_obs
+        '''
+        df = df.rename(columns=lambda c: c.lstrip('@'))
+        kwargs.setdefault('date_col', 'obs_date')
+        kwargs.setdefault('elev_col',
+                          'elevation' if 'elevation' in df.columns else None)
+        kwargs.setdefault('fatal_col', None)
+        return cls(df, **kwargs)
+
+    @staticmethod
+    def _keys(values):
+        '''
+        value -> sorted row positions, for every non-null value
+        '''
+        present = np.array([v is not None for v in values], dtype=bool)
+        rows = np.flatnonzero(present)
+        if not len(rows):
+            return {}
+        codes, uniques = pd.factorize(values[rows])
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+        return {key: rows[order[bounds[i]:bounds[i + 1]]]
+                for i, key in enumerate(uniques)}
+
+    def _aggregate(self, fatal):
+        '''
+        Counts per (day, zone, band); missing zones/bands are counted under
+        'unknown'
+        '''
+        agg = pd.DataFrame({'date': self._days,
+                            'zone': pd.Series(self._zone_values)
+                                    .fillna('unknown').values,
+                            'band': pd.Series(self._band_values)
+                                    .fillna('unknown').values,
+                            'n_events': 1})
+        if fatal is not None:
+            agg['n_fatal'] = fatal.astype(int)
+        agg['date'] = pd.to_datetime(agg['date'])
+        return agg.groupby(['date', 'zone', 'band']).sum().sort_index()
+
+    def __len__(self):
+        return len(self.df)
+
+    def _date_bounds(self, start, end):
+        lo = 0 if start is None else int(np.searchsorted(
+            self._days, np.datetime64(pd.Timestamp(start).date()), 'left'))
+        hi = len(self._days) if end is None else int(np.searchsorted(
+            self._days, np.datetime64(pd.Timestamp(end).date()), 'right'))
+        return lo, max(lo, hi)
+
+    @staticmethod
+    def _key_rows(keys, values, lo, hi):
+        '''
+        Rows in [lo, hi) whose key is in values, via each key's sorted
+        positions
+        '''
+        parts = []
+        for v in values:
+            pos = keys.get(v)
+            if pos is None:
+                continue
+            a, b = np.searchsorted(pos, [lo, hi])
+            parts.append(pos[a:b])
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(parts))
+
+    def rows(self, start=None, end=None, zones=None, bands=None, lat=None,
+             lon=None, r_km=None):
+        '''
+        Row positions matching a query (see query); with a radius, also
+        their distances [units: km]
+        '''
+        lo, hi = self._date_bounds(start, end)
+        rows = None
+        if zones is not None:
+            rows = self._key_rows(self.zones, zones, lo, hi)
+        if bands is not None:
+            brows = self._key_rows(self.bands, bands, lo, hi)
+            rows = brows if rows is None else np.intersect1d(
+                rows, brows, assume_unique=True)
+        if r_km is None:
+            if rows is None:
+                rows = np.arange(lo, hi)
+            return rows, None
+        idx, dist = self.geo.query_radius(lat, lon, r_km)[0]
+        near = self._geo_rows[idx]
+        keep = (near >= lo) & (near < hi)
+        if rows is not None:
+            keep &= np.isin(near, rows)
+        near, dist = near[keep], dist[keep]
+        order = np.argsort(near, kind='stable')
+        return near[order], dist[order]
+
+    def query(self, start=None, end=None, zones=None, bands=None, lat=None,
+              lon=None, r_km=None):
+        '''
+        Events in [start, end] (inclusive days), optionally restricted to
+        zones, elevation bands ('btl', 'tl', 'atl') and to within r_km of
+        (lat, lon), in date order
+
+        Returns:
+        --------
+        df (DataFrame) the matching rows, with a dist column [units: km]
+                       for radius queries
+        '''
+        rows, dist = self.rows(start, end, zones, bands, lat, lon, r_km)
+        out = self.df.iloc[rows]
+        if dist is not None:
+            out = out.assign(dist=dist)
+        return out
+
+    def near_stations(self, md_df, r_km, start=None, end=None):
+        '''
+        All (event, station) pairs within r_km, for a set of stations
+
+        Each station is one radius query on the GeoIndex, so the cost grows
+        with the number of stations and of events near them, not with
+        events x stations.
+
+        Parameters:
+        -----------
+        md_df (DataFrame) station metadata with stid, latitude and longitude
+                          columns (see processwx.load_stn_metadata)
+
+        Returns:
+        --------
+        pairs (DataFrame) row (position in self.df), stid, dist, date
+        '''
+        lo, hi = self._date_bounds(start, end)
+        results = self.geo.query_radius(md_df['latitude'].values,
+                                        md_df['longitude'].values, r_km)
+        parts = []
+        for stid, (idx, dist) in zip(md_df['stid'].values, results):
+            rows = self._geo_rows[idx]
+            keep = (rows >= lo) & (rows < hi)
+            parts.append(pd.DataFrame({'row': rows[keep], 'stid': stid,
+                                       'dist': dist[keep]}))
+        if not parts:
+            return pd.DataFrame(columns=['row', 'stid', 'dist', 'date'])
+        pairs = pd.concat(parts, ignore_index=True)
+        pairs['date'] = self.dates[pairs['row'].values]
+        return pairs.sort_values(['row', 'dist'], kind='mergesort') \
+            .reset_index(drop=True)
+
+    def join_stations(self, pairs, wx_frames, tolerance='3h', times=None,
+                      tz='US/Mountain'):
+        '''
+        Attach each pair's station observation at (or just before) the
+        event time
+
+        Every station's series is matched in one sorted merge_asof with
+        all of its events, so the join is O((events + observations) log n)
+        rather than a scan of the series per event.
+
+        Parameters:
+        -----------
+        pairs (DataFrame) output of near_stations
+        wx_frames (dict) station id -> DataFrame from processwx.process_stn
+        tolerance (str) latest observation age accepted
+        times (Series) event times per row position, default the event date
+                       (local midnight)
+        tz (str) time zone of the event times; station data are UTC
+
+        Returns:
+        --------
+        joined (DataFrame) pairs with the station's columns added (NaN where
+                           no observation is within tolerance)
+        '''
+        if times is None:
+            times = pd.Series(self.dates)
+        t = pd.DatetimeIndex(times.values[pairs['row'].values])
+        if t.tz is None:
+            t = t.tz_localize(tz, ambiguous='NaT',
+                              nonexistent='shift_forward')
+        left = pairs.assign(utc=t.tz_convert('UTC'),
+                            _order=np.arange(len(pairs)))
+        parts = []
+        for stid, grp in left.groupby('stid', sort=False):
+            wx = wx_frames.get(stid)
+            grp = grp.dropna(subset=['utc']).sort_values('utc')
+            if wx is None or wx.empty:
+                parts.append(grp)
+                continue
+            wx = wx.select_dtypes(include=[np.number])
+            if wx.index.tz is None:
+                wx = wx.tz_localize('UTC')
+            right = wx.tz_convert('UTC').sort_index()
+            right.index.name = 'utc'
+            right = right.reset_index()
+            if hasattr(right['utc'].dt, 'as_unit'):
+                grp['utc'] = grp['utc'].dt.as_unit('ns')
+                right['utc'] = right['utc'].dt.as_unit('ns')
+            parts.append(pd.merge_asof(grp, right, on='utc',
+                                       direction='backward',
+                                       tolerance=pd.Timedelta(tolerance)))
+        joined = pd.concat(parts, ignore_index=True)
+        return joined.sort_values('_order').drop(['_order', 'utc'], axis=1) \
+            .reset_index(drop=True)
+
+    def counts(self, start=None, end=None, freq='D', by=None, zones=None,
+               bands=None):
+        '''
+        Event (and fatality) counts per period from the daily aggregates
+
+        Parameters:
+        -----------
+        freq (str) pandas offset alias of the periods, e.g. 'MS' for months
+        by (str or list) also group by 'zone' and/or 'band'
+        zones, bands (list) only count these
+
+        Returns:
+        --------
+        counts (DataFrame) n_events (and n_fatal) indexed by period start
+                           (and the by keys)
+        '''
+        daily = self.daily
+        dates = daily.index.get_level_values('date')
+        keep = np.ones(len(daily), dtype=bool)
+        if start is not None:
+            keep &= dates >= pd.Timestamp(start).normalize()
+        if end is not None:
+            keep &= dates <= pd.Timestamp(end).normalize()
+        if zones is not None:
+            keep &= daily.index.get_level_values('zone').isin(zones)
+        if bands is not None:
+            keep &= daily.index.get_level_values('band').isin(bands)
+        daily = daily[keep].reset_index()
+        by = [] if by is None else ([by] if isinstance(by, str) else list(by))
+        return daily.groupby([pd.Grouper(key='date', freq=freq)] + by) \
+            .sum(numeric_only=True)
@@ -3,28 +3,49 @@
 @author: ABerner
 """
 
+import datetime
+import numpy as np
 import pandas as pd
 import requests
 import json
 import xmltodict
 from gzip import GzipFile
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
 
-from common import DataFetcher
+from colstore import ColumnTable, TableWriter
+from common import DataFetcher, default_policy
+from schema import event_types, obs_types
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# errors that mean a (possibly truncated) response body isn't valid JSON
+_json_errors = (ValueError, KeyError) + \
+    ((ijson.JSONError,) if ijson is not None else ())
+
+today = datetime.date.today()
+today = (today.year, today.month, today.day)
+
+events_url = ('http://www.jhavalanche.org/lib/avy_events.php?action=get'
+              '&start={1:02}%2F{2:02}%2F{0}&end={4:02}%2F{5:02}%2F{3}'
+              '&areas=All+areas&')
+obs_url = 'http://www.jhavalanche.org/lib/obs_xml.php'
+obs_page_url = 'http://www.jhavalanche.org/observations/viewObs'
 
 
 def fetch_btac_events(outfile='btac_events.txt.gz', start_date=(2000,1,1), 
-                      end_date=(today[0],today[1],today[2])):
+                      end_date=(today[0],today[1],today[2]), cache=None):
     '''
     Fetch all the BTAC recorded avalanche events in specified date range
     
-    <<more doc here>>
+    Pass an httpcache.ResponseCache as `cache` to reuse earlier responses.
     '''
-    base_url = ('http://www.jhavalanche.org/lib/avy_events.php?action=get'
-                '&start={1:02}%2F{2:02}%2F{0}&end={4:02}%2F{5:02}%2F{3}'
-                '&areas=All+areas&')
-    
-    url = base_url.format(*start_date,*end_date)
-    response = requests.get(url)
+    url = events_url.format(*start_date,*end_date)
+    response = default_policy.call(cache.get if cache else requests.get,
+                                   (url,), host=urlsplit(url).netloc)
     try: 
         dd = json.loads(response.content)
         drop_keys = [str(i) for i in range(26)]
@@ -41,36 +62,30 @@ def fetch_btac_events(outfile='btac_events.txt.gz', start_date=(2000,1,1),
     
     
 def fetch_btac_obs(outfile='btac_obs.txt.gz', start_date=(2000,1,1),
-                   end_date=(today[0],today[1],today[2])):
+                   end_date=(today[0],today[1],today[2]), cache=None):
     '''
     Fetch all the BTAC observations in specified date range
     
-    <<more doc here>>
+    Pass an httpcache.ResponseCache as `cache` to reuse earlier responses;
+    windows served from the cache skip the cookie handshake entirely.
     '''
     
-    base_url = 'http://www.jhavalanche.org/lib/obs_xml.php'
+    base_url = obs_url
     dd = {}
     dd['data'] = []
-    yrs_chunk = 5
-    tmp_start, tmp_end = start_date, start_date
-    tmp_end = (tmp_end[0] + yrs_chunk, tmp_end[1], tmp_end[2])
-    while tmp_start < end_date:
-        tmp_end = min(tmp_end, end_date)
-        #hack to deal with bad data on 02/14/2013
-        if tmp_start < (2013,2,14) and tmp_end > (2013,2,14):
-            tmp_end = (2013,2,13)
-     
+    for tmp_start, tmp_end in obs_windows(start_date, end_date):
         print(tmp_start, tmp_end)
         session = requests.Session()
-        session.head('http://www.jhavalanche.org/observations/viewObs') #set cookies
-        response = session.post(
-                url=base_url,
-                data={'start_date': '{1:02}/{2:02}/{0}'.format(*tmp_start),
-                      'end_date': '{1:02}/{2:02}/{0}'.format(*tmp_end),
-                      'area': 'All areas',
-                      'zone': '0',
-                      'approved': '1'},
-                headers={'Referer': base_url})
+        form = obs_form(tmp_start, tmp_end)
+        response = cache and cache.fresh('POST', base_url, form)
+        if not response:
+            session.head('http://www.jhavalanche.org/observations/viewObs') #set cookies
+            if cache:
+                response = cache.post(base_url, session=session, data=form,
+                                      headers={'Referer': base_url})
+            else:
+                response = session.post(url=base_url, data=form,
+                                        headers={'Referer': base_url})
         try:
             #hack to fix bad data on 02/14/2013
             s = response.content
@@ -90,19 +105,197 @@ def fetch_btac_obs(outfile='btac_obs.txt.gz', start_date=(2000,1,1),
             print(response.content)
         
         session.close()
-        tmp_start = tmp_end
-        tmp_start = pd.datetime(*tmp_end) + pd.offsets.Day(1)
-        tmp_start = (tmp_start.year, tmp_start.month, tmp_start.day)
-        tmp_end = (tmp_end[0] + yrs_chunk,tmp_end[1], tmp_end[2])
     
     dd['data'].sort(key=lambda x: pd.to_datetime(x['@obs_date']))
     filename = outfile
     with GzipFile(filename=filename, mode='w') as fout:
         fout.write(json.dumps(dd).encode(encoding='utf-8'))
+
+
+def obs_windows(start_date, end_date, yrs_chunk=5):
+    '''
+    Date windows for the obs endpoint, at most yrs_chunk years each, with the
+    window boundary forced to 02/13/2013 to isolate bad data on 02/14/2013
+    '''
+    tmp_start, tmp_end = start_date, start_date
+    tmp_end = (tmp_end[0] + yrs_chunk, tmp_end[1], tmp_end[2])
+    while tmp_start < end_date:
+        tmp_end = min(tmp_end, end_date)
+        #hack to deal with bad data on 02/14/2013
+        if tmp_start < (2013,2,14) and tmp_end > (2013,2,14):
+            tmp_end = (2013,2,13)
+        yield tmp_start, tmp_end
+        tmp_start = datetime.date(*tmp_end) + datetime.timedelta(1)
+        tmp_start = (tmp_start.year, tmp_start.month, tmp_start.day)
+        tmp_end = (tmp_end[0] + yrs_chunk,tmp_end[1], tmp_end[2])
+
+
+def obs_form(tmp_start, tmp_end):
+    return {'start_date': '{1:02}/{2:02}/{0}'.format(*tmp_start),
+            'end_date': '{1:02}/{2:02}/{0}'.format(*tmp_end),
+            'area': 'All areas',
+            'zone': '0',
+            'approved': '1'}
+
+
+def _resume_obs(tbl, start_date):
+    '''
+    Where an incremental stream_btac_obs picks up: (start date, obs_ids
+    already stored from that date on). With obs_ids the last stored day is
+    fetched again and its known markers skipped; without them fetching
+    resumes the day after.
+    '''
+    if not len(tbl):
+        return start_date, set()
+    dates = tbl.column('obs_date')
+    last = pd.Timestamp(int(dates.max()))
+    if pd.isnull(last):
+        return start_date, set()
+    if 'obs_id' not in tbl.columns:
+        last = last + pd.Timedelta(days=1)
+        return max(start_date, (last.year, last.month, last.day)), set()
+    day = last.normalize()
+    seen = set()
+    for chunk in tbl.iter_chunks(100000, columns=['obs_date', 'obs_id']):
+        seen.update(chunk['obs_id'][chunk['obs_date'] >= day].dropna())
+    return max(start_date, (day.year, day.month, day.day)), seen
+
+
+def stream_btac_obs(outdir='btac_obs', start_date=(2000,1,1),
+                    end_date=(today[0],today[1],today[2]), batch_size=1000,
+                    chunk_size=2**16, resume=True, cache=None):
+    '''
+    Fetch BTAC observations into a ColumnTable at outdir without holding
+    them in memory
+
+    Each window's XML response is read in chunks through a pull parser and
+    every <marker> is written to the table as it arrives, in typed batches
+    (obs_date as a datetime, other attributes as strings). Markers before
+    unparseable data are kept, which covers the bad 02/14/2013 data without
+    the string surgery in fetch_btac_obs. Requests go through
+    common.default_policy, and windows answering with an error status are
+    skipped. Pass an httpcache.ResponseCache as `cache` to reuse earlier
+    responses (they are then read whole rather than streamed).
+
+    With resume=True an existing table is only appended to: fetching starts
+    at its last observation date and markers already stored are skipped.
+    The table is sorted by obs_date at the end, only if the new rows are
+    out of order.
+    '''
+    tbl = ColumnTable(outdir)
+    if not resume:
+        tbl.clear()
+    start_date, seen = _resume_obs(tbl, start_date)
+    writer = TableWriter(tbl, obs_types, batch_size=batch_size)
+    host = urlsplit(obs_url).netloc
+    headers = {'Referer': obs_url}
+    for tmp_start, tmp_end in obs_windows(start_date, end_date):
+        print(tmp_start, tmp_end)
+        form = obs_form(tmp_start, tmp_end)
+        session = requests.Session()
+        response = cache and cache.fresh('POST', obs_url, form)
+        if not response:
+            session.head(obs_page_url) #set cookies
+            if cache:
+                response = default_policy.call(
+                    cache.post, (obs_url,),
+                    {'session': session, 'data': form, 'headers': headers},
+                    host=host)
+            else:
+                response = default_policy.call(
+                    session.post, (obs_url,),
+                    {'data': form, 'headers': headers, 'stream': True},
+                    host=host)
+        if response.status_code != 200:
+            print("{0} returned status {1}".format(obs_url,
+                                                   response.status_code))
+            if hasattr(response, 'close'):
+                response.close()
+            session.close()
+            continue
+        if getattr(response, 'from_cache', False):
+            chunks = [response.content]
+        else:
+            chunks = response.iter_content(chunk_size=chunk_size)
+        parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        root = None
+        try:
+            for chunk in chunks:
+                parser.feed(chunk)
+                for event, elem in parser.read_events():
+                    if root is None:
+                        root = elem
+                    elif event == 'start' and elem.tag == 'marker':
+                        if elem.attrib.get('obs_id') not in seen:
+                            writer.add(dict(elem.attrib))
+                    elif event == 'end' and elem.tag == 'marker':
+                        root.clear()
+        except ElementTree.ParseError as e:
+            print("XML Response cannot be parsed past {0}".format(e))
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        session.close()
+    writer.flush()
+    if len(tbl):
+        dates = tbl.column('obs_date')
+        if not np.all(dates[1:] >= dates[:-1]):
+            tbl.sort_by('obs_date')
+    print("Wrote {0} observations to {1}".format(writer.n, outdir))
+    return tbl
+
+
+def stream_btac_events(outdir='btac_events', start_date=(2000,1,1),
+                       end_date=(today[0],today[1],today[2]),
+                       batch_size=1000):
+    '''
+    Fetch BTAC avalanche events into a ColumnTable at outdir, typed with
+    event_types
+
+    With ijson installed the response is parsed incrementally and events are
+    written in batches as they arrive; otherwise the body is parsed in one go
+    but still written batch-wise. The table is sorted by event date once at
+    the end.
+    '''
+    url = events_url.format(*start_date,*end_date)
+    tbl = ColumnTable(outdir)
+    tbl.clear()
+    writer = TableWriter(tbl, event_types, batch_size=batch_size)
+    drop_keys = set(str(i) for i in range(26))
+    response = default_policy.call(requests.get, (url,), {'stream': True},
+                                   host=urlsplit(url).netloc)
+    if response.status_code != 200:
+        print("{0} returned status {1}".format(url, response.status_code))
+        response.close()
+        return tbl
+    try:
+        if ijson is not None:
+            response.raw.decode_content = True
+            events = ijson.items(response.raw, 'data.item', use_float=True)
+        else:
+            events = json.loads(response.content)['data']
+        for event in events:
+            writer.add({k: v for k, v in event.items() if k not in drop_keys})
+    except _json_errors:
+        print("Response did not contain valid JSON")
+    finally:
+        response.close()
+    writer.flush()
+    if len(tbl):
+        tbl.sort_by('event_date', key=pd.to_datetime)
+    print("Wrote {0} events to {1}".format(writer.n, outdir))
+    return tbl
         
 
 def fetch_btac_advisory(outfile, area='teton', start_yr=1999, 
-                        end_yr=today[0], start_date=(11,1), end_date=(5,30)):
+                        end_yr=today[0], start_date=(11,1), end_date=(5,30),
+                        fetcher=None, resume=False):
+    '''
+    Fetch the daily advisories for an area over the given seasons. Pass a
+    configured DataFetcher (e.g. DataFetcher(max_workers=4, rate=2)) to
+    control concurrency and request rate. With resume=True only days missing
+    from an existing outfile are fetched.
+    '''
     base_url = 'http://www.jhavalanche.org/view'
     base_url_dict = {'teton': base_url + 'Teton?data_date={0}' +
                               '&template=teton_print.tpl.php',
@@ -116,12 +309,13 @@ def fetch_btac_advisory(outfile, area='teton', start_yr=1999,
             urls.append(base_url_dict[area].format(current_day))
             current_day = current_day + datetime.timedelta(1)
         year += 1
-    fetcher = DataFetcher()
-    fetcher.fetch_pages(urls, outfile)
+    fetcher = fetcher or DataFetcher()
+    fetcher.fetch_pages(urls, outfile, resume=resume)
         
     
 def fetch_btac_evening_fcst(outfile, start_yr=2005, end_yr = today[0], 
-                            start_date=(11,1), end_date=(5,30)):
+                            start_date=(11,1), end_date=(5,30), fetcher=None,
+                            resume=False):
     base_url = 'http://www.jhavalanche.org/viewAdvisory?&data_date={0}'  
     urls = []
     for year in range(start_yr, end_yr):
@@ -131,5 +325,5 @@ def fetch_btac_evening_fcst(outfile, start_yr=2005, end_yr = today[0],
             urls.append(base_url.format(current_day))
             current_day = current_day + datetime.timedelta(1)
         year += 1
-    fetcher = DataFetcher()
-    fetcher.fetch_pages(urls, outfile)
\ No newline at end of file
+    fetcher = fetcher or DataFetcher()
+    fetcher.fetch_pages(urls, outfile, resume=resume)
\ No newline at end of file
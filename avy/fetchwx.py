@@ -1,44 +1,88 @@
 """
 @author: ABerner
 """
-from os import listdir
-from os.path import isfile
+from os import makedirs, replace
+from os.path import isfile, getsize
+import codecs
+import io
+import itertools
 import re
+import gzip
 from gzip import GzipFile
 import json
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+import numpy as np
 import pandas as pd
 import requests
-import yaml
-
-mwnet_dict = {'SNOTEL': 25,
-              'NWAC': 37,
-              'BTAVAL': 48}
 
-with open('synoptic_config.yml', 'r') as ymlfile:
-    cfg = yaml.load(ymlfile)
+import metrics
+from common import (HostRateLimiter, RetryError, bounded_map, default_policy,
+                    mwnet_dict)
 
-api_token = cfg['SynopticAPI']['token']
+config_file = 'synoptic_config.yml'
+_config = None
 
-today = pd.datetime.today()
+today = datetime.today()
 today = (today.year, today.month, today.day, today.hour, today.minute)
 
 
+def load_config(filename=None):
+    '''
+    Read the Synoptic API config (by default synoptic_config.yml in the
+    working directory). It is only read when a token is first needed, so
+    importing this module works without credentials.
+    '''
+    global _config
+    if _config is None or filename is not None:
+        import yaml
+        with open(filename or config_file, 'r') as ymlfile:
+            _config = yaml.safe_load(ymlfile)
+    return _config
+
+
+def get_api_token():
+    return load_config()['SynopticAPI']['token']
+
+
 class MwFetcher(object):
     '''
     Class wrapping basic functionality of Synoptic API for MesoWest stations.
-    Implements metadata and timeseries requests.
+    Implements metadata and timeseries requests. Pass an
+    httpcache.ResponseCache as `cache` to serve repeat requests from disk, and
+    api_url to talk to another server with the same API (e.g. a local stub).
+    Throttled (429) and server error responses are retried according to
+    `policy` (default common.default_policy, shared with DataFetcher).
     '''
-    def __init__(self, token=api_token):
-        self.api_url = 'https://api.mesowest.net/v2/'
-        self.api_token = api_token
+    def __init__(self, token=None, cache=None,
+                 api_url='https://api.mesowest.net/v2/', policy=None):
+        self.api_url = api_url
+        self.api_token = token or get_api_token()
+        self.cache = cache
+        self.policy = policy or default_policy
     
+    def _get(self, url, stream=False):
+        host = urlsplit(url).netloc
+        if self.cache and not stream:
+            get, kwargs = self.cache.get, {}
+        else:
+            get, kwargs = requests.get, {'stream': stream}
+        with metrics.timer('request_seconds', host=host):
+            response = self.policy.call(get, (url,), kwargs, host=host)
+        metrics.inc('requests', host=host, status=response.status_code)
+        if not stream:
+            metrics.inc('bytes', len(response.content), host=host)
+        return response
+
     def fetch_networks(self):
         '''
         Retrieve data on the available station networks.
         '''
         url = self.api_url + 'networks?&token=' + self.api_token
-        response = requests.get(url)
+        response = self._get(url)
         return json.loads(response.content)
     
     def fetch_stn_metadata(self, networks, args={'state':('WA',),
@@ -56,9 +100,18 @@ class MwFetcher(object):
             url = (url + '&' + key + '=' + 
                    ','.join([str(val) for val in value]))
         url = url + '&token=' + self.api_token
-        response = requests.get(url)
+        response = self._get(url)
         return json.loads(response.content)
 
+    def _ts_url(self, stids, output, start_date, end_date):
+        start = datetime(*start_date)
+        end = datetime(*end_date)
+        start_str = start.strftime('%Y%m%d%H%M')
+        end_str = end.strftime('%Y%m%d%H%M')
+        return (self.api_url + 'stations/timeseries?&stid=' + ','.join(stids) + 
+                '&start=' + start_str + '&end=' + end_str + 
+                '&output=' + output + '&token=' + self.api_token)
+
     def fetch_stn_ts(self, stids, output='JSON', start_date=(1997,1,1),
                      end_date=today):
         '''
@@ -67,16 +120,21 @@ class MwFetcher(object):
         Gets station observations in date range [start_date:end_date]; can
         specify either JSON or CSV. JSON only available for periods shorter
         than two years. Return none and print error message if API throws an
-        error.
+        error or the request keeps failing.
         '''
-        start = pd.datetime(*start_date)
-        end = pd.datetime(*end_date)
-        start_str = start.strftime('%Y%m%d%H%M')
-        end_str = end.strftime('%Y%m%d%H%M')
-        url = (self.api_url + 'stations/timeseries?&stid=' + ','.join(stids) + 
-               '&start=' + start_str + '&end=' + end_str + 
-               '&output=' + output + '&token=' + self.api_token)
-        response = requests.get(url)
+        url = self._ts_url(stids, output, start_date, end_date)
+        try:
+            response = self._get(url)
+        except (RetryError,) + self.policy.exceptions as e:
+            print("Timeseries request failed: {0}".format(e))
+            return None
+        if response.status_code != 200:
+            print("Timeseries request failed with status {0}".format(
+                response.status_code))
+            return None
+        if output == 'CSV' and not response.content.lstrip().startswith(b'{'):
+            # CSV bodies are data; only errors come back as JSON
+            return response.content
         try: 
             out = json.loads(response.content)
             if out['SUMMARY']['RESPONSE_CODE'] == -1:
@@ -90,9 +148,233 @@ class MwFetcher(object):
                 pass
         return response.content
 
+    def stream_stn_ts(self, stids, output='CSV', start_date=(1997,1,1),
+                      end_date=today, chunk_size=2**16):
+        '''
+        Retrieve station timeseries as typed DataFrames without holding the
+        response body in memory
+        
+        The body is read incrementally. API errors are recognised from the
+        first bytes (CSV responses only ever start with '{' when they are an
+        error message), and CSV rows are decoded block by block straight into
+        growable NumPy columns (see parse_stn_csv_stream). JSON output is
+        parsed once and each OBSERVATIONS array converted directly to a
+        column. Responses are not cached.
+        
+        Returns:
+        --------
+        frames (dict) station id -> DataFrame in the same layout as
+                      processwx.process_stn, or None on an API error
+        '''
+        url = self._ts_url(stids, output, start_date, end_date)
+        try:
+            response = self._get(url, stream=True)
+        except (RetryError,) + self.policy.exceptions as e:
+            print("Timeseries request failed: {0}".format(e))
+            return None
+        if response.status_code != 200:
+            print("Timeseries request failed with status {0}".format(
+                response.status_code))
+            response.close()
+            return None
+        chunks = response.iter_content(chunk_size=chunk_size)
+        first = next(chunks, b'')
+        try:
+            if output == 'CSV' and not first.lstrip().startswith(b'{'):
+                return parse_stn_csv_stream(itertools.chain([first], chunks))
+            body = first + b''.join(chunks)
+        finally:
+            response.close()
+        try:
+            out = json.loads(body)
+        except json.JSONDecodeError:
+            print("Request too large for JSON response")
+            return None
+        if out['SUMMARY']['RESPONSE_CODE'] == -1:
+            print(out['SUMMARY']['RESPONSE MESSAGE'])
+            return None
+        return stn_json_to_frames(out)
+
+
+class ColumnBuffer(object):
+    '''
+    Growable typed array; capacity doubles as values are appended
+    '''
+    def __init__(self, dtype, capacity=4096):
+        self._data = np.empty(capacity, dtype=dtype)
+        self._n = 0
+
+    def extend(self, values):
+        n = self._n + len(values)
+        if n > len(self._data):
+            data = np.empty(max(n, 2 * len(self._data)),
+                            dtype=self._data.dtype)
+            data[:self._n] = self._data[:self._n]
+            self._data = data
+        self._data[self._n:n] = values
+        self._n = n
+
+    def values(self):
+        return self._data[:self._n]
+
+
+def _coerce_block(values):
+    '''
+    Numeric view of one block of a CSV column, or None if nothing in it
+    parses as a number but something is present (a text column)
+    '''
+    if pd.api.types.is_numeric_dtype(values):
+        return values.values.astype(float)
+    numeric = pd.to_numeric(values, errors='coerce')
+    if numeric.isnull().all() and values.notnull().any():
+        return None
+    return numeric.values.astype(float)
+
+
+class _CsvSection(object):
+    '''
+    Accumulates the rows of one station's section of a Synoptic CSV
+    '''
+    def __init__(self, stid):
+        self.stid = stid
+        self.columns = None
+        self.buffers = {}
+        self.text = {}
+
+    def add_block(self, lines):
+        block = pd.read_csv(io.StringIO('\n'.join(lines)), header=None,
+                            names=self.columns,
+                            dtype={self.columns[0]: str})
+        times = pd.to_datetime(block['Date_Time'], utc=True)
+        times = pd.DatetimeIndex(times)
+        if hasattr(times, 'as_unit'):
+            times = times.as_unit('ns')
+        self.buffers.setdefault('Date_Time', ColumnBuffer(np.int64)).extend(
+            times.asi8)
+        for col in self.columns:
+            if col in ('Date_Time', 'heat_index_set_1d'):
+                continue
+            if col == 'Station_ID' or col in self.text:
+                self.text.setdefault(col, []).append(block[col].values)
+                continue
+            values = _coerce_block(block[col])
+            if values is None and col not in self.buffers:
+                self.text[col] = [block[col].values]
+                continue
+            if values is None:
+                values = np.full(len(block), np.nan)
+            self.buffers.setdefault(col, ColumnBuffer(np.float64)).extend(
+                values)
+
+    def frame(self):
+        index = pd.DatetimeIndex(
+            self.buffers['Date_Time'].values().view('datetime64[ns]'),
+            name='Date_Time').tz_localize('UTC')
+        data = {}
+        for col in self.columns:
+            if col in self.buffers and col != 'Date_Time':
+                data[col] = self.buffers[col].values()
+            elif col in self.text:
+                data[col] = np.concatenate(self.text[col])
+        cols = [c for c in self.columns if c in data]
+        return pd.DataFrame(data, index=index, columns=cols)
+
+
+def parse_stn_csv_stream(chunks, block_lines=20000):
+    '''
+    Parse a Synoptic timeseries CSV from an iterable of byte chunks
+
+    Each station section ('# STATION: ...' metadata lines, a column line, a
+    units line, then data rows) is decoded block_lines rows at a time and
+    appended to typed columns, so memory is bounded by the output arrays
+    plus one block rather than by copies of the response body. Columns are
+    coerced to numbers the way processwx.process_stn does.
+
+    Returns:
+    --------
+    frames (dict) station id -> DataFrame indexed by Date_Time
+    '''
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    frames = {}
+    section = None
+    state = 'meta'
+    block = []
+    pending = ''
+
+    def finish():
+        if section is not None and block:
+            section.add_block(block)
+        if section is not None and 'Date_Time' in section.buffers:
+            frames[section.stid] = section.frame()
+        del block[:]
+
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            text = pending + decoder.decode(b'', final=True)
+            lines = text.split('\n')
+            pending = ''
+        else:
+            text = pending + decoder.decode(chunk)
+            lines = text.split('\n')
+            pending = lines.pop()
+        for ln in lines:
+            ln = ln.rstrip('\r')
+            if not ln:
+                continue
+            if ln.startswith('#'):
+                if state != 'meta':
+                    finish()
+                    section = None
+                    state = 'meta'
+                if ln.upper().startswith('# STATION:'):
+                    section = _CsvSection(ln.split(':', 1)[1].strip())
+            elif state == 'meta':
+                if section is None:
+                    section = _CsvSection(None)
+                section.columns = ln.strip().split(',')
+                state = 'units'
+            elif state == 'units':
+                state = 'data'
+            else:
+                block.append(ln)
+                if len(block) >= block_lines:
+                    section.add_block(block)
+                    del block[:]
+    finish()
+    return frames
+
+
+def stn_json_to_frames(out):
+    '''
+    Convert a parsed Synoptic JSON timeseries response to DataFrames, one
+    column per OBSERVATIONS array
+
+    Returns:
+    --------
+    frames (dict) station id -> DataFrame indexed by Date_Time
+    '''
+    frames = {}
+    for stn in out.get('STATION', []):
+        obs = stn['OBSERVATIONS']
+        index = pd.DatetimeIndex(pd.to_datetime(obs['date_time'], utc=True),
+                                 name='Date_Time')
+        data = {'Station_ID': np.full(len(index), stn['STID'], dtype=object)}
+        for var, values in obs.items():
+            if var in ('date_time', 'heat_index_set_1d'):
+                continue
+            arr = np.array(values, dtype=object)
+            numeric = pd.to_numeric(arr, errors='coerce')
+            # text only if something is present but nothing is a number; a
+            # sensor that is null throughout stays numeric, as in the CSV
+            text = np.isnan(numeric).all() and pd.notnull(arr).any()
+            data[var] = arr if text else numeric.astype(float)
+        frames[stn['STID']] = pd.DataFrame(data, index=index)
+    return frames
+
 
 def fetch_mnet_ts(networks, args, outdir, start_date=(1997,1,1), 
-                  end_date=today):
+                  end_date=today, cache=None, max_workers=1, window_days=None,
+                  rate=2.0, fetcher=None):
     '''
     Retrieve and archive metadata and station timeseries 
     
@@ -100,7 +382,14 @@ def fetch_mnet_ts(networks, args, outdir, start_date=(1997,1,1),
     networks (by MNET_ID) and dict of API args (e.g. {'status':('Active',), 
     'state':('WA','OR')}) in the date range. Current implementation is to save
     a metadata file and station files in CSV format in directory outdir.
-    Existing CSVs are updated with latest available data.
+    Existing CSVs are updated with latest available data by appending only
+    the new observations (see update_stn_csv). An optional
+    httpcache.ResponseCache is passed through to the MwFetcher; pass a
+    configured MwFetcher as `fetcher` to use it instead.
+
+    With max_workers > 1 or window_days set, stations are downloaded
+    concurrently in date windows (see fetch_stns_windowed), at most `rate`
+    requests per second (None for no limit).
     '''
     
     def md_json_to_df(md_json):
@@ -113,50 +402,248 @@ def fetch_mnet_ts(networks, args, outdir, start_date=(1997,1,1),
                      'ELEVATION', 'STATE', 'REC_START', 'REC_END']]
         return df
     
-    fetcher = MwFetcher(token=api_token)
-    md_df = md_json_to_df(fetcher.fetch_stn_metadata(networks,args=args))
-    md_df.to_csv(outdir + 'stn_metadata_MNETIDs_' + 
-                  '_'.join([str(net_id) for net_id in networks]) + '.csv',
-                  compression = 'gzip')
-    stids = md_df['STID'].values
-    fls = [f.split('.csv')[0] for f in listdir(outdir) if (isfile(outdir+f)
-               and not f.startswith('stn_metadata'))]
-    p = re.compile('(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z)') #datetime regex
-    for stid in stids: 
-        tmp_strt_dt = start_date
-        s = ''
-        if stid in fls:
-            print(stid + " exists, updating")
-            f = outdir + stid + '.csv'
-            with GzipFile(filename=f, mode='r') as fin:
-                s = fin.read().decode(encoding='utf-8')
-            lst_ln_idx = s[0:-2].rfind('\n')+1
-            lst_ln = s[lst_ln_idx:]
-            dt_str = p.search(lst_ln)
-            if dt_str:
-                dt = pd.to_datetime(dt_str.group())
-                tmp_strt_dt = (dt.year,dt.month,dt.day,dt.hour,dt.minute+1)
-            else:
-                print("Failed to find end date in file. Skipping " + stid)
-                continue
-        resp = fetcher.fetch_stn_ts([stid], output='CSV', 
-                                    start_date=tmp_strt_dt, end_date=end_date)
-        if resp:
-            if s:
-                s1 = resp.decode(encoding='utf-8')
-                match = p.search(s1)
-                if match:
-                    idx = match.start()
-                    fst_ln_idx = s1.rfind('\n',0,idx)+1
-                    s1 = s1[fst_ln_idx:]
-                    s = ''.join([s,s1])
-                    resp = s.encode(encoding='utf-8')
-                else:
-                    print("No data in response. Skipping update to " + stid)
-                    continue
-            filename = outdir + stid + '.csv'
-            with GzipFile(filename=filename, mode='w') as fout:
-                fout.write(resp)
-            print("Wrote " + stid + " to file")
+    fetcher = fetcher or MwFetcher(cache=cache)
+    with metrics.timer('stage_seconds', stage='fetch_mnet_ts'):
+        md_df = md_json_to_df(fetcher.fetch_stn_metadata(networks,args=args))
+        md_df.to_csv(outdir + 'stn_metadata_MNETIDs_' + 
+                      '_'.join([str(net_id) for net_id in networks]) + '.csv',
+                      compression = 'gzip')
+        stids = md_df['STID'].values
+        metrics.inc('stations', len(stids), stage='fetch_mnet_ts')
+        if max_workers > 1 or window_days:
+            fetch_stns_windowed(fetcher, stids, outdir, start_date, end_date,
+                                rec_start=dict(zip(stids, md_df['REC_START'])),
+                                max_workers=max_workers,
+                                window_days=window_days or 700, rate=rate)
+            return
+        for stid in stids: 
+            update_stn_csv(fetcher, stid, outdir, start_date, end_date)
+
+
+dt_re = re.compile(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z)') #datetime regex
+
+
+def manifest_path(outdir, stid):
+    return outdir + 'manifest/' + stid + '.json'
+
+
+def read_manifest(outdir, stid):
+    '''
+    Load a station's manifest, or None if there is none
+    '''
+    try:
+        with open(manifest_path(outdir, stid), 'r') as fin:
+            return json.load(fin)
+    except (IOError, ValueError):
+        return None
+
+
+def write_manifest(outdir, stid, manifest):
+    filename = manifest_path(outdir, stid)
+    makedirs(outdir + 'manifest', exist_ok=True)
+    with open(filename + '.tmp', 'w') as fout:
+        json.dump(manifest, fout)
+    replace(filename + '.tmp', filename)
+
+
+def scan_stn_csv(filename):
+    '''
+    Build a manifest for an existing station CSV by streaming through it
+    once: column header line and last observation time. Returns None if no
+    observation time can be found.
+    '''
+    columns = None
+    last_ln = ''
+    with GzipFile(filename=filename, mode='r') as fin:
+        for ln in fin:
+            ln = ln.decode(encoding='utf-8')
+            if columns is None and not ln.startswith('#'):
+                columns = ln.strip()
+            if ln.strip():
+                last_ln = ln
+    dt_str = dt_re.search(last_ln)
+    if not dt_str:
+        return None
+    return {'columns': columns,
+            'last_obs': dt_str.group(),
+            'members': 1,
+            'size': getsize(filename)}
+
+
+def stn_update_start(stid, outdir, start_date):
+    '''
+    Where a station's download should start: start_date for a new station,
+    otherwise one minute after the last archived observation. Returns
+    (start tuple, manifest or None), or None if the existing file can't be
+    read.
+    '''
+    f = outdir + stid + '.csv'
+    if not isfile(f):
+        return start_date, None
+    print(stid + " exists, updating")
+    manifest = read_manifest(outdir, stid)
+    if manifest is None or manifest['size'] != getsize(f):
+        manifest = scan_stn_csv(f)
+    if manifest is None:
+        print("Failed to find end date in file. Skipping " + stid)
+        return None
+    dt = pd.to_datetime(manifest['last_obs']) + pd.Timedelta(minutes=1)
+    return (dt.year, dt.month, dt.day, dt.hour, dt.minute), manifest
+
+
+def append_stn_csv(stid, outdir, resp, manifest):
+    '''
+    Write a CSV response to <outdir><stid>.csv (or append its data rows if
+    manifest says the file exists) and update the manifest.
+
+    Returns the updated manifest, or the unchanged one (possibly None) if the
+    response holds no observations.
+    '''
+    f = outdir + stid + '.csv'
+    s1 = resp.decode(encoding='utf-8')
+    match = dt_re.search(s1)
+    if not match:
+        return manifest
+    fst_ln_idx = s1.rfind('\n', 0, match.start()) + 1
+    header = s1[:fst_ln_idx].rstrip('\n').split('\n')
+    columns = [ln for ln in header if not ln.startswith('#')][0].strip()
+    if not s1.endswith('\n'):
+        s1 = s1 + '\n'
+    if manifest:
+        if columns != manifest['columns']:
+            print("Warning: column layout of " + stid + " changed since " +
+                  "the file was created")
+        mode = 'ab'
+        data = s1[fst_ln_idx:]
+        # a new dict, so callers can tell an update from a skipped response
+        manifest = dict(manifest, members=manifest['members'] + 1)
+    else:
+        mode = 'wb'
+        data = s1
+        manifest = {'columns': columns, 'members': 1}
+    with open(f, mode) as fout:
+        fout.write(gzip.compress(data.encode(encoding='utf-8')))
+    metrics.inc('records', s1.count('\n', fst_ln_idx),
+                stage='append_stn_csv')
+    lst_ln = data[data[0:-2].rfind('\n') + 1:]
+    manifest['last_obs'] = dt_re.search(lst_ln).group()
+    manifest['size'] = getsize(f)
+    write_manifest(outdir, stid, manifest)
+    return manifest
+
+
+def update_stn_csv(fetcher, stid, outdir, start_date, end_date):
+    '''
+    Fetch a station's timeseries and write or extend <outdir><stid>.csv
+
+    Station CSVs are gzip files that grow by appending one gzip member per
+    update (gzip readers and pandas see a single stream), and a small
+    manifest in <outdir>manifest/ records the last observation time, so an
+    update never decompresses or rewrites the existing history. CSVs without
+    a manifest (or changed since it was written) are scanned once to build
+    one.
+    '''
+    start = stn_update_start(stid, outdir, start_date)
+    if start is None:
+        return
+    tmp_strt_dt, manifest = start
+    resp = fetcher.fetch_stn_ts([stid], output='CSV', 
+                                start_date=tmp_strt_dt, end_date=end_date)
+    if not resp:
+        metrics.inc('failures', stage='update_stn_csv')
+        print(stid + " failed to write")
+        return
+    new_manifest = append_stn_csv(stid, outdir, resp, manifest)
+    if new_manifest is manifest:
+        if manifest:
+            print("No data in response. Skipping update to " + stid)
         else:
             print(stid + " failed to write")
+        return
+    print("Wrote " + stid + " to file")
+
+
+def date_windows(start_date, end_date, window_days=700):
+    '''
+    Split [start_date, end_date] into consecutive, non-overlapping windows
+    of at most window_days (the default keeps JSON requests under the API's
+    two year limit). Dates are (year, month, day[, hour, minute]) tuples.
+    '''
+    start = datetime(*start_date)
+    end = datetime(*end_date)
+    step = timedelta(days=window_days)
+    windows = []
+    while start <= end:
+        w_end = min(start + step, end)
+        windows.append(((start.year, start.month, start.day, start.hour,
+                         start.minute),
+                        (w_end.year, w_end.month, w_end.day, w_end.hour,
+                         w_end.minute)))
+        start = w_end + timedelta(minutes=1)
+    return windows
+
+
+def fetch_stns_windowed(fetcher, stids, outdir, start_date, end_date,
+                        rec_start=None, max_workers=4, window_days=700,
+                        rate=2.0):
+    '''
+    Download or update many stations concurrently
+
+    Each station's missing period (from stn_update_start, clipped to its
+    record start if rec_start maps stid -> first observation datetime) is
+    split into date_windows. All windows of all stations are fetched on a
+    pool of max_workers threads, at most `rate` requests per second to the
+    API (a conservative 2/s by default, so more workers overlap latency
+    rather than multiply the request rate; None for no limit), and each
+    station's windows are appended to its CSV strictly in date order as
+    they become available. If a window fails, the station's
+    later windows are dropped so the archive never has a gap; the next run
+    resumes from the last archived observation.
+    '''
+    limiter = HostRateLimiter(rate)
+    rec_start = rec_start or {}
+
+    def fetch_window(stid, window):
+        limiter.acquire(fetcher.api_url)
+        return fetcher.fetch_stn_ts([stid], output='CSV',
+                                    start_date=window[0], end_date=window[1])
+
+    tasks = []
+    state = {}
+    for stid in stids:
+        start = stn_update_start(stid, outdir, start_date)
+        if start is None:
+            continue
+        tmp_strt_dt, manifest = start
+        first = rec_start.get(stid)
+        if manifest is None and first is not None and not pd.isnull(first):
+            first = (first.year, first.month, first.day, first.hour,
+                     first.minute)
+            tmp_strt_dt = max(tmp_strt_dt, first)
+        windows = date_windows(tmp_strt_dt, end_date, window_days)
+        state[stid] = {'manifest': manifest, 'n': len(windows),
+                       'failed': False}
+        tasks.extend((stid, i, w) for i, w in enumerate(windows))
+
+    def run(task):
+        stid, i, window = task
+        return stid, i, fetch_window(stid, window)
+
+    # bounded_map yields in submission order, so each station's windows
+    # arrive in date order while later windows are already in flight
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for stid, i, resp in bounded_map(pool, run, tasks,
+                                         max_pending=4 * max_workers):
+            st = state[stid]
+            if st['failed']:
+                continue
+            if resp is None:
+                metrics.inc('failures', stage='fetch_stns_windowed')
+                print("{0} window {1} failed, stopping at {2}".format(
+                    stid, i, st['manifest'] and st['manifest']['last_obs']))
+                st['failed'] = True
+                continue
+            st['manifest'] = append_stn_csv(stid, outdir, resp,
+                                            st['manifest'])
+            if i == st['n'] - 1:
+                print("Wrote " + stid + " to file")
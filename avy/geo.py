@@ -0,0 +1,166 @@
+"""
+@author: ABerner
+"""
+import numpy as np
+
+R_EARTH = 6373.0
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''
+    Vectorized great-circle distance, same spherical approximation as
+    processwx.calc_dist. Inputs are scalars or arrays that broadcast against
+    each other, e.g. haversine(lat[:, None], lon[:, None], stn_lat, stn_lon)
+    gives the full (points x stations) distance matrix.
+
+    Parameters:
+    -----------
+    lat1, lon1 (float or array) coordinates of first point(s) [units: degrees]
+    lat2, lon2 (float or array) coordinates of second point(s) [units: degrees]
+
+    Returns:
+    --------
+    dist (float or array) great-circle distances [units: km]
+    '''
+    lat1 = np.radians(lat1)
+    lon1 = np.radians(lon1)
+    lat2 = np.radians(lat2)
+    lon2 = np.radians(lon2)
+
+    a = (np.sin((lat2 - lat1) / 2)**2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2)**2)
+    return 2 * R_EARTH * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class GeoIndex(object):
+    '''
+    Spatial index over a set of lat/lon points (e.g. station metadata or
+    avalanche events) on a regular lat/lon grid.
+
+    Points are bucketed into cell_deg x cell_deg cells and sorted by cell, so
+    a radius query only computes distances for points in the cells that
+    overlap the query's bounding box. A k-nearest query grows a square of
+    cells around the query point until it holds k points, then searches the
+    circle through the k-th nearest of those, so memory stays proportional
+    to the points near each query. Longitudes are not wrapped at the
+    antimeridian, which is fine for North American data.
+
+    idx = GeoIndex(md_df['latitude'].values, md_df['longitude'].values)
+    dist, nbrs = idx.query_knn(evt_lat, evt_lon, k=3)
+    '''
+    def __init__(self, lat, lon, cell_deg=0.5):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.cell_deg = cell_deg
+        self._n_lon = int(np.ceil(360.0 / cell_deg)) + 1
+        self._n_lat = int(np.ceil(180.0 / cell_deg)) + 1
+        keys = self._cell_keys(self.lat, self.lon)
+        self._order = np.argsort(keys, kind='stable')
+        self._keys = keys[self._order]
+
+    def __len__(self):
+        return len(self.lat)
+
+    def _cell_index(self, lat, lon):
+        ilat = np.floor((np.asarray(lat) + 90.0) / self.cell_deg)
+        ilon = np.floor((np.asarray(lon) + 180.0) / self.cell_deg)
+        return ilat.astype(np.int64), ilon.astype(np.int64)
+
+    def _cell_keys(self, lat, lon):
+        ilat, ilon = self._cell_index(lat, lon)
+        return ilat * self._n_lon + ilon
+
+    def _candidates(self, lat, lon, r_km):
+        '''
+        Indices of all points in cells overlapping the bounding box of the
+        circle of radius r_km around (lat, lon)
+        '''
+        dlat = np.degrees(r_km / R_EARTH)
+        coslat = np.cos(np.radians(min(abs(lat) + dlat, 89.9)))
+        dlon = min(dlat / coslat, 180.0)
+        lat0, lon0 = self._cell_index(lat - dlat, lon - dlon)
+        lat1, lon1 = self._cell_index(lat + dlat, lon + dlon)
+        lo = np.arange(lat0, lat1 + 1) * self._n_lon + lon0
+        hi = np.arange(lat0, lat1 + 1) * self._n_lon + lon1
+        starts = np.searchsorted(self._keys, lo, side='left')
+        ends = np.searchsorted(self._keys, hi, side='right')
+        if len(starts) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self._order[s:e]
+                               for s, e in zip(starts, ends)])
+
+    def query_radius(self, lat, lon, r_km):
+        '''
+        Points within r_km of each query point
+
+        Returns:
+        --------
+        results (list) one (indices, distances) pair of arrays per query
+                       point, sorted by distance
+        '''
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        results = []
+        for qlat, qlon in zip(lat, lon):
+            cand = self._candidates(qlat, qlon, r_km)
+            d = haversine(qlat, qlon, self.lat[cand], self.lon[cand])
+            keep = d <= r_km
+            cand, d = cand[keep], d[keep]
+            order = np.argsort(d, kind='stable')
+            results.append((cand[order], d[order]))
+        return results
+
+    def _square(self, ilat, ilon, r):
+        '''
+        (starts, ends) into the sorted points of the cell rows of the square
+        of cells within r of cell (ilat, ilon)
+        '''
+        rows = np.arange(max(ilat - r, 0), min(ilat + r, self._n_lat - 1) + 1)
+        lon0 = max(ilon - r, 0)
+        lon1 = min(ilon + r, self._n_lon - 1)
+        starts = np.searchsorted(self._keys, rows * self._n_lon + lon0,
+                                 side='left')
+        ends = np.searchsorted(self._keys, rows * self._n_lon + lon1,
+                               side='right')
+        return starts, ends
+
+    def query_knn(self, lat, lon, k=1):
+        '''
+        k nearest points to each query point
+
+        Returns:
+        --------
+        dist (array) (n_query, k) distances, nearest first [units: km]
+        idx (array) (n_query, k) indices into the indexed points; -1 (and
+                    NaN distances) for query points with missing coordinates
+        '''
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        k = min(k, len(self))
+        dist = np.full((len(lat), k), np.nan)
+        idx = np.full((len(lat), k), -1, dtype=np.int64)
+        if k == 0:
+            return dist, idx
+        r_max = max(self._n_lat, self._n_lon)
+        for i, (qlat, qlon) in enumerate(zip(lat, lon)):
+            if not (np.isfinite(qlat) and np.isfinite(qlon)):
+                continue
+            ilat, ilon = self._cell_index(qlat, qlon)
+            # grow the square of cells until it holds k points; the k-th
+            # nearest of them bounds the search radius
+            r = 0
+            while True:
+                starts, ends = self._square(ilat, ilon, r)
+                if (ends - starts).sum() >= k or r >= r_max:
+                    break
+                r = 2 * r + 1
+            cand = np.concatenate([self._order[a:b]
+                                   for a, b in zip(starts, ends)])
+            d = haversine(qlat, qlon, self.lat[cand], self.lon[cand])
+            r_km = np.partition(d, k - 1)[k - 1]
+            cand = self._candidates(qlat, qlon, r_km)
+            d = haversine(qlat, qlon, self.lat[cand], self.lon[cand])
+            order = np.argsort(d, kind='stable')[:k]
+            idx[i] = cand[order]
+            dist[i] = d[order]
+        return dist, idx
@@ -0,0 +1,315 @@
+"""
+@author: ABerner
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import numpy as np
+
+import metrics
+from common import (GzipJsonFile, HostRateLimiter, RetryError, bounded_map,
+                    default_policy, make_session)
+
+# North American Public Avalanche Danger Scale colours [RGB], by level
+danger_colors = {1: (80, 184, 72),
+                 2: (255, 242, 0),
+                 3: (247, 148, 30),
+                 4: (237, 28, 36),
+                 5: (35, 31, 32)}
+
+band_names = ['atl', 'tl', 'btl']
+
+# bumped whenever decode_image's output changes (2: None for no rating,
+# 3: outlines no longer vote Extreme)
+decode_version = 3
+_decoded_dir = 'decoded_v{0}'.format(decode_version)
+
+_img_re = re.compile(r'<img\b[^>]*?\bsrc\s*=\s*["\']?([^"\'\s>]+)', re.I)
+hazard_img_re = re.compile(r'danger|hazard', re.I)
+
+
+def decode_pixels(pixels, tolerance=60):
+    '''
+    Danger level of every pixel of an RGB image: the nearest danger scale
+    colour, or 0 for pixels further than tolerance from all of them
+    (background, coloured text). Extreme is near-black, so black and dark
+    grey outlines and text come out as 5; dominant_level discounts them.
+
+    Parameters:
+    -----------
+    pixels (ndarray) (height, width, 3) RGB values
+    tolerance (float) max euclidean distance to a scale colour
+
+    Returns:
+    --------
+    levels (ndarray) int8 (height, width)
+    '''
+    px = np.asarray(pixels, dtype=np.float32)[..., :3]
+    ref = np.array([danger_colors[k] for k in sorted(danger_colors)],
+                   dtype=np.float32)
+    dist = np.sqrt(((px[..., None, :] - ref) ** 2).sum(axis=-1))
+    nearest = dist.argmin(axis=-1)
+    levels = (nearest + 1).astype(np.int8)
+    levels[dist.min(axis=-1) > tolerance] = 0
+    return levels
+
+
+def dominant_level(levels, min_fraction=0.02):
+    '''
+    Most common non-zero level, or None (no rating) if fewer than
+    min_fraction of the pixels carry a danger colour
+
+    Extreme (5) only counts when no other level covers min_fraction of the
+    pixels: its near-black also matches the outlines and text of icons of
+    every level, which can outnumber a small fill.
+    '''
+    counts = np.bincount(levels.ravel(), minlength=6)[1:6]
+    if counts.sum() < min_fraction * levels.size:
+        return None
+    if counts[:4].max() >= min_fraction * levels.size:
+        counts[4] = 0
+    return int(counts.argmax()) + 1
+
+
+def decode_image(data, tolerance=60, min_fraction=0.02):
+    '''
+    Decode a hazard image (GIF, PNG, ...) into danger levels
+
+    Returns:
+    --------
+    decoded (dict) 'level': dominant level of the whole image (for single
+                   rating icons) and 'bands': dominant level of its top,
+                   middle and bottom thirds as atl, tl, btl (for elevation
+                   band graphics); None where no danger colour was found
+    '''
+    try:
+        # imported here so that processbtac, which only reads decoded
+        # ratings, doesn't load Pillow
+        from PIL import Image
+    except ImportError:
+        raise ImportError("Pillow is required to decode hazard graphics")
+    with Image.open(io.BytesIO(data)) as img:
+        pixels = np.asarray(img.convert('RGB'))
+    levels = decode_pixels(pixels, tolerance)
+    thirds = np.array_split(levels, 3, axis=0)
+    return {'level': dominant_level(levels, min_fraction),
+            'bands': [dominant_level(part, min_fraction) for part in thirds]}
+
+
+def bulletin_images(line, engine=None):
+    '''
+    Absolute urls of the hazard images of a fetched bulletin record
+
+    Returns:
+    --------
+    rows (list) [am, pm] image urls for each row of the hazard table that
+                has images in its rating cells (icons, one per band)
+    graphics (list) other images whose file name mentions danger/hazard
+                    (whole-forecast graphics, am first)
+    '''
+    base = line['url']
+    rows = []
+    if engine is not None:
+        try:
+            table = engine.hazard_images()
+        except (IndexError, AttributeError):
+            table = []
+        for srcs in table:
+            if len(srcs) >= 2:
+                rows.append([urljoin(base, srcs[0]), urljoin(base, srcs[1])])
+    graphics = []
+    if len(rows) >= 3:
+        # an icon per band and time; no need to scan the whole page
+        return rows, graphics
+    seen = set(u for row in rows for u in row)
+    for src in _img_re.findall(line['content']):
+        url = urljoin(base, src)
+        if url not in seen and hazard_img_re.search(
+                urlsplit(url).path.rsplit('/', 1)[-1]):
+            seen.add(url)
+            graphics.append(url)
+    return rows, graphics
+
+
+def graphic_ratings(rows, graphics, decoded):
+    '''
+    am/pm ratings per elevation band from decoded hazard images (see
+    bulletin_images), or None if an image hasn't been decoded or a band
+    carries no danger colour
+
+    Icon rows map to atl, tl, btl in table order; otherwise the first two
+    graphics are read as am and pm, each split into three horizontal bands
+    (a single graphic is used for both).
+    '''
+    out = {}
+    if len(rows) >= 3:
+        for band, (am, pm) in zip(band_names, rows):
+            if am not in decoded or pm not in decoded:
+                return None
+            out[band + '_am'] = decoded[am]['level']
+            out[band + '_pm'] = decoded[pm]['level']
+        return None if None in out.values() else out
+    if not graphics:
+        return None
+    am = graphics[0]
+    pm = graphics[1] if len(graphics) > 1 else graphics[0]
+    if am not in decoded or pm not in decoded:
+        return None
+    for i, band in enumerate(band_names):
+        out[band + '_am'] = decoded[am]['bands'][i]
+        out[band + '_pm'] = decoded[pm]['bands'][i]
+    return None if None in out.values() else out
+
+
+class ImageCache(object):
+    '''
+    Content-addressed cache of downloaded hazard images and their decoding
+
+    The same few icons and graphics are referenced by thousands of
+    bulletins, so each url is downloaded once and each distinct image
+    (by sha1 of its bytes) decoded once. Everything is one small file per
+    entry, written atomically, so concurrent stages can share a cachedir:
+
+    <cachedir>/urls/<sha1 of url>         content hash of the image at url
+    <cachedir>/blobs/<content hash>       image bytes
+    <cachedir>/decoded_v3/<content hash>  decode_image result (json)
+
+    The decoded directory is versioned (decode_version) so decodings made
+    by an older decode_image are not reused.
+
+    cache = ImageCache('hazard_images')
+    decoded = cache.decode_all(urls, max_workers=4)
+    '''
+    def __init__(self, cachedir, session=None, rate=2.0, policy=None,
+                 tolerance=60, min_fraction=0.02):
+        self.cachedir = cachedir
+        self.session = session
+        self.limiter = HostRateLimiter(rate)
+        self.policy = policy or default_policy
+        self.tolerance = tolerance
+        self.min_fraction = min_fraction
+        self._lock = threading.Lock()
+        self._memo = {}
+        for sub in ('urls', 'blobs', _decoded_dir):
+            os.makedirs(os.path.join(cachedir, sub), exist_ok=True)
+
+    def _path(self, sub, key):
+        return os.path.join(self.cachedir, sub, key)
+
+    @staticmethod
+    def _write(path, data):
+        tmp = '{0}.{1}.{2}.tmp'.format(path, os.getpid(),
+                                       threading.get_ident())
+        with open(tmp, 'wb') as fout:
+            fout.write(data)
+        os.replace(tmp, path)
+
+    def content_hash(self, url):
+        '''
+        Hash of the image at url, downloading it if it isn't cached
+        '''
+        ukey = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        upath = self._path('urls', ukey)
+        if os.path.isfile(upath):
+            with open(upath, 'r') as fin:
+                return fin.read().strip()
+        if self.session is None:
+            with self._lock:
+                if self.session is None:
+                    self.session = make_session()
+        self.limiter.acquire(url)
+        response = self.policy.call(self.session.get, (url,),
+                                    host=urlsplit(url).netloc)
+        metrics.inc('requests', host=urlsplit(url).netloc,
+                    status=response.status_code)
+        if response.status_code != 200:
+            raise IOError("{0} returned status {1}".format(
+                url, response.status_code))
+        chash = hashlib.sha1(response.content).hexdigest()
+        bpath = self._path('blobs', chash)
+        if not os.path.isfile(bpath):
+            self._write(bpath, response.content)
+        self._write(upath, chash.encode('utf-8'))
+        return chash
+
+    def decode(self, url):
+        '''
+        decode_image result for the image at url
+        '''
+        chash = self.content_hash(url)
+        with self._lock:
+            if chash in self._memo:
+                metrics.inc('cache_hits', stage='decode_image')
+                return self._memo[chash]
+        dpath = self._path(_decoded_dir, chash)
+        if os.path.isfile(dpath):
+            with open(dpath, 'r') as fin:
+                decoded = json.load(fin)
+        else:
+            with open(self._path('blobs', chash), 'rb') as fin:
+                decoded = decode_image(fin.read(), self.tolerance,
+                                       self.min_fraction)
+            metrics.inc('records', stage='decode_image')
+            self._write(dpath, json.dumps(decoded).encode('utf-8'))
+        with self._lock:
+            self._memo[chash] = decoded
+        return decoded
+
+    def _decode_safe(self, url):
+        try:
+            return url, self.decode(url)
+        except (IOError, ValueError, RetryError) as e:
+            metrics.inc('failures', stage='decode_image')
+            print("Could not decode {0}: {1}".format(url, e))
+            return url, None
+
+    def decode_all(self, urls, max_workers=4):
+        '''
+        Decode every image in urls (duplicates are fetched once), on a pool
+        of max_workers threads. Returns url -> decoded for those that could
+        be fetched and decoded.
+        '''
+        urls = sorted(set(urls))
+        out = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for url, decoded in bounded_map(pool, self._decode_safe, urls,
+                                            max_pending=4 * max_workers):
+                if decoded is not None:
+                    out[url] = decoded
+        return out
+
+
+def decode_bulletin_images(infile, cachedir, outfile=None, max_workers=4,
+                           rate=2.0, engine='fast'):
+    '''
+    Find the hazard images referenced by every bulletin in a fetched archive
+    and decode them through an ImageCache
+
+    Returns (and, with outfile, writes as json) the url -> decoded table to
+    pass as `graphics` to processbtac.process_btac_nowcast.
+    '''
+    from processbtac import bulletin_engines
+    urls = set()
+    with GzipJsonFile(filename=infile, mode='r') as fin:
+        for line in fin:
+            if 'teton_print' in line['url']:
+                continue
+            rows, graphics = bulletin_images(
+                line, bulletin_engines[engine](line['content']))
+            urls.update(u for row in rows for u in row)
+            urls.update(graphics)
+    print("{0} distinct hazard images in {1}".format(len(urls), infile))
+    cache = ImageCache(cachedir, rate=rate)
+    decoded = cache.decode_all(urls, max_workers=max_workers)
+    if outfile is not None:
+        tmp = outfile + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump(decoded, fout, sort_keys=True)
+        os.replace(tmp, outfile)
+    return decoded
@@ -0,0 +1,231 @@
+"""
+@author: ABerner
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+
+class CachedResponse(object):
+    '''
+    Minimal stand-in for requests.Response served from the on-disk cache.
+    Exposes the attributes the fetchers use: status_code, headers, content,
+    text, url and json().
+    '''
+    def __init__(self, meta, content):
+        from requests.structures import CaseInsensitiveDict
+        self.url = meta['url']
+        self.status_code = meta['status']
+        self.headers = CaseInsensitiveDict(meta['headers'])
+        self.encoding = meta.get('encoding') or 'utf-8'
+        self.content = content
+        self.from_cache = True
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache(object):
+    '''
+    On-disk HTTP response cache shared by the fetchers
+
+    Responses are keyed by method, URL (minus ignored query parameters such
+    as the API token) and request body, and stored under cachedir as a json
+    metadata file plus the raw body. Entries are fresh for a TTL chosen by the
+    first regex in `ttls` that matches the URL (falling back to default_ttl;
+    a TTL of None never expires). Stale entries are revalidated with
+    If-None-Match/If-Modified-Since when the server sent an ETag or
+    Last-Modified, so an unchanged resource costs a 304 instead of a download.
+    Once the cache grows past max_bytes, least recently used entries are
+    evicted.
+
+    # archived bulletins never change, station metadata changes slowly
+    cache = ResponseCache('http_cache',
+                          ttls=[(r'data_date=', None),
+                                (r'stations/metadata', 7*86400)])
+    fetcher = DataFetcher(cache=cache)
+    '''
+    def __init__(self, cachedir, ttls=(), default_ttl=86400,
+                 max_bytes=2*1024**3, ignore_params=('token',),
+                 methods=('GET', 'POST')):
+        self.cachedir = cachedir
+        self.ttls = [(re.compile(pattern), ttl) for pattern, ttl in ttls]
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.ignore_params = set(ignore_params)
+        self.methods = set(methods)
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(cachedir, exist_ok=True)
+
+    def strip(self, url):
+        '''
+        url without the ignored query parameters, as used in the key and
+        saved in the metadata (so the API token never reaches the disk)
+        '''
+        parts = urlsplit(url)
+        query = [(k, v) for k, v in parse_qsl(parts.query,
+                                              keep_blank_values=True)
+                 if k not in self.ignore_params]
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+    def key(self, method, url, data=None):
+        '''
+        Cache key for a request
+        '''
+        url = self.strip(url)
+        if isinstance(data, dict):
+            data = urlencode(sorted(data.items()))
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        h = hashlib.sha1()
+        h.update(method.upper().encode('utf-8') + b'\n')
+        h.update(url.encode('utf-8') + b'\n')
+        h.update(data or b'')
+        return h.hexdigest()
+
+    def ttl(self, url):
+        for pattern, ttl in self.ttls:
+            if pattern.search(url):
+                return ttl
+        return self.default_ttl
+
+    def _paths(self, key):
+        d = os.path.join(self.cachedir, key[:2])
+        return os.path.join(d, key + '.json'), os.path.join(d, key + '.body')
+
+    def _load(self, key):
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as fin:
+                meta = json.load(fin)
+            with open(body_path, 'rb') as fin:
+                content = fin.read()
+        except (IOError, ValueError):
+            return None, None
+        # body mtime doubles as the LRU access time
+        os.utime(body_path, None)
+        return meta, content
+
+    def _store(self, key, meta, content):
+        meta_path, body_path = self._paths(key)
+        os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+        old_size = (os.path.getsize(body_path)
+                    if os.path.isfile(body_path) else 0)
+        tmp = '{0}.{1}.tmp'.format(body_path, threading.get_ident())
+        with open(tmp, 'wb') as fout:
+            fout.write(content)
+        os.replace(tmp, body_path)
+        tmp = '{0}.{1}.tmp'.format(meta_path, threading.get_ident())
+        with open(tmp, 'w', encoding='utf-8') as fout:
+            json.dump(meta, fout)
+        os.replace(tmp, meta_path)
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(content) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for sub in os.scandir(self.cachedir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith('.body'):
+                    yield entry
+
+    def _scan_size(self):
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _evict(self):
+        '''
+        Drop least recently used entries until the cache is at 90% of
+        max_bytes. Called with the lock held.
+        '''
+        entries = sorted(((e.stat().st_mtime, e.stat().st_size, e.path)
+                          for e in self._entries()))
+        target = 0.9 * self.max_bytes
+        for _, size, body_path in entries:
+            if self._size <= target:
+                break
+            for path in (body_path, body_path[:-5] + '.json'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size -= size
+
+    def _is_fresh(self, meta, url):
+        ttl = self.ttl(url)
+        return ttl is None or time.time() - meta['stored'] < ttl
+
+    def fresh(self, method, url, data=None):
+        '''
+        Return the cached response if there is one that needs no
+        revalidation, otherwise None. Never touches the network.
+        '''
+        meta, content = self._load(self.key(method, url, data))
+        if meta is not None and self._is_fresh(meta, url):
+            return CachedResponse(meta, content)
+        return None
+
+    def request(self, method, url, session=None, data=None, **kwargs):
+        '''
+        Drop-in for session.request(method, url, data=data, **kwargs) that
+        serves and fills the cache
+        '''
+        method = method.upper()
+        requester = session
+        if requester is None:
+            import requests
+            requester = requests
+        if method not in self.methods:
+            return requester.request(method, url, data=data, **kwargs)
+
+        key = self.key(method, url, data)
+        meta, content = self._load(key)
+        if meta is not None and self._is_fresh(meta, url):
+            return CachedResponse(meta, content)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if meta is not None:
+            if meta['headers'].get('ETag'):
+                headers['If-None-Match'] = meta['headers']['ETag']
+            if meta['headers'].get('Last-Modified'):
+                headers['If-Modified-Since'] = meta['headers']['Last-Modified']
+        response = requester.request(method, url, data=data, headers=headers,
+                                     **kwargs)
+
+        if response.status_code == 304 and meta is not None:
+            meta['stored'] = time.time()
+            self._store(key, meta, content)
+            return CachedResponse(meta, content)
+        if response.status_code == 200:
+            keep = ('Content-Type', 'ETag', 'Last-Modified')
+            meta = {'url': self.strip(url),
+                    'method': method,
+                    'status': response.status_code,
+                    'headers': {k: response.headers[k] for k in keep
+                                if k in response.headers},
+                    'encoding': (response.encoding or
+                                 response.apparent_encoding),
+                    'stored': time.time()}
+            self._store(key, meta, response.content)
+        response.from_cache = False
+        return response
+
+    def get(self, url, session=None, **kwargs):
+        return self.request('GET', url, session=session, **kwargs)
+
+    def post(self, url, session=None, data=None, **kwargs):
+        return self.request('POST', url, session=session, data=data, **kwargs)
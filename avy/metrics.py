@@ -0,0 +1,253 @@
+"""
+@author: ABerner
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# Instrumentation is off until enable() is called: every hook below then
+# returns after a single global lookup, so the fetch/process code can call
+# them unconditionally.
+_registry = None
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry(object):
+    '''
+    Thread-safe store of counters, histograms and (with trace=True) a log of
+    individual events such as per-record parse timings
+    '''
+    def __init__(self, trace=False, buckets=latency_buckets):
+        self.trace = trace
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.events = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value, labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram(self.buckets)
+            hist.observe(value)
+
+    def event(self, name, fields):
+        if self.trace:
+            with self._lock:
+                self.events.append(dict(fields, name=name, time=time.time()))
+
+    @staticmethod
+    def _order(item):
+        # label values may be of any (and mixed) types, e.g. status=429 and
+        # reason='Timeout'; order series by their string form
+        (name, labels), _ = item
+        return name, tuple((k, str(v)) for k, v in labels)
+
+    def snapshot(self):
+        '''
+        All metrics as a list of plain dicts
+        '''
+        with self._lock:
+            out = [{'type': 'counter', 'name': name, 'labels': dict(labels),
+                    'value': value}
+                   for (name, labels), value in sorted(self.counters.items(),
+                                                       key=self._order)]
+            for (name, labels), hist in sorted(self.histograms.items(),
+                                               key=self._order):
+                out.append({'type': 'histogram', 'name': name,
+                            'labels': dict(labels),
+                            'count': hist.count,
+                            'sum': hist.sum,
+                            'buckets': dict(zip(
+                                [str(b) for b in hist.buckets] + ['+Inf'],
+                                hist.counts))})
+        return out
+
+
+class _Timer(object):
+    '''
+    Context manager that records its elapsed time in a histogram
+    '''
+    __slots__ = ('registry', 'name', 'labels', 'start', 'elapsed')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.registry.observe(self.name, self.elapsed, self.labels)
+        return False
+
+
+class _NullTimer(object):
+    elapsed = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def enable(trace=False, buckets=latency_buckets):
+    '''
+    Start collecting metrics in a fresh registry and return it. With
+    trace=True individual events (e.g. per-record parse timings) are kept
+    as well.
+    '''
+    global _registry
+    _registry = Registry(trace=trace, buckets=buckets)
+    return _registry
+
+
+def disable():
+    global _registry
+    _registry = None
+
+
+def registry():
+    return _registry
+
+
+def inc(name, value=1, **labels):
+    '''
+    Add to a counter, e.g. inc('fetch_bytes', len(body), host=host)
+    '''
+    reg = _registry
+    if reg is not None:
+        reg.inc(name, value, labels)
+
+
+def observe(name, value, **labels):
+    '''
+    Record a value (usually seconds) in a histogram
+    '''
+    reg = _registry
+    if reg is not None:
+        reg.observe(name, value, labels)
+
+
+def timer(name, **labels):
+    '''
+    with timer('stage_seconds', stage='process_btac_nowcast'): ...
+    '''
+    reg = _registry
+    if reg is None:
+        return _null_timer
+    return _Timer(reg, name, labels)
+
+
+def tracing():
+    reg = _registry
+    return reg is not None and reg.trace
+
+
+def event(name, **fields):
+    '''
+    Log one event; only kept when tracing
+    '''
+    reg = _registry
+    if reg is not None and reg.trace:
+        reg.event(name, fields)
+
+
+def write_json_lines(filename, reg=None):
+    '''
+    Append the current metrics (one line per series, plus traced events) to
+    a JSON lines file, stamped with the export time
+    '''
+    reg = reg or _registry
+    if reg is None:
+        return
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    with open(filename, 'a') as fout:
+        for item in reg.snapshot():
+            fout.write(json.dumps(dict(item, time=now)) + '\n')
+        with reg._lock:
+            events, reg.events = reg.events, []
+        for evt in events:
+            fout.write(json.dumps(dict(evt, type='event')) + '\n')
+
+
+def _prom_labels(labels, extra=None):
+    items = sorted(labels.items()) + list(extra or [])
+    if not items:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in items) + '}'
+
+
+def write_prometheus(filename, reg=None, prefix='avy_'):
+    '''
+    Write the current metrics in the Prometheus text format, e.g. for the
+    node exporter's textfile collector. The file is replaced atomically.
+    '''
+    reg = reg or _registry
+    if reg is None:
+        return
+    lines = []
+    typed = set()
+    for item in reg.snapshot():
+        name = prefix + item['name']
+        if item['type'] == 'counter':
+            if name not in typed:
+                lines.append('# TYPE {0}_total counter'.format(name))
+                typed.add(name)
+            lines.append('{0}_total{1} {2}'.format(
+                name, _prom_labels(item['labels']), item['value']))
+            continue
+        if name not in typed:
+            lines.append('# TYPE {0} histogram'.format(name))
+            typed.add(name)
+        cum = 0
+        for le, n in item['buckets'].items():
+            cum += n
+            lines.append('{0}_bucket{1} {2}'.format(
+                name, _prom_labels(item['labels'], [('le', le)]), cum))
+        lines.append('{0}_sum{1} {2}'.format(
+            name, _prom_labels(item['labels']), item['sum']))
+        lines.append('{0}_count{1} {2}'.format(
+            name, _prom_labels(item['labels']), item['count']))
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    os.replace(tmp, filename)
@@ -0,0 +1,336 @@
+"""
+@author: ABerner
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+class Panel(object):
+    '''
+    Dense time x station x variable array of weather observations on a
+    regular time grid, memory-mapped from disk
+
+    A panel directory holds values.f32 (float32, NaN where missing),
+    mask.u8 (True where at least one observation fell in the grid cell) and
+    coords.json (grid start and freq, number of times, the station metadata
+    rows and the variable names). Time is the leading axis, so a time
+    window of any station subset is one contiguous block of the files, and
+    extending the panel in time only appends to them.
+
+    panel = Panel('panels/wy')
+    values, mask = panel.sel(stations=['JHR', 'RVG'], start='2017-01-01',
+                             end='2017-02-01')
+
+    sel() returns memory-mapped views (no copy) for time windows, single
+    stations/variables, and station or variable lists that are evenly spaced
+    in the panel (e.g. a contiguous range); other lists are gathered into a
+    copy of just the selected window.
+    '''
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, 'coords.json'), 'r') as fin:
+            self.coords = json.load(fin)
+        self.stations = [s['stid'] for s in self.coords['stations']]
+        self.variables = list(self.coords['variables'])
+        self.freq = self.coords['freq']
+        self.start = pd.Timestamp(self.coords['start'])
+        self._map()
+
+    def _map(self):
+        shape = self.shape
+        if shape[0] == 0:
+            self.values = np.zeros(shape, dtype=np.float32)
+            self.mask = np.zeros(shape, dtype=bool)
+            return
+        self.values = np.memmap(os.path.join(self.path, 'values.f32'),
+                                dtype=np.float32, mode=self.mode, shape=shape)
+        self.mask = np.memmap(os.path.join(self.path, 'mask.u8'),
+                              dtype=bool, mode=self.mode, shape=shape)
+
+    @property
+    def shape(self):
+        return (self.coords['ntimes'], len(self.stations),
+                len(self.variables))
+
+    @property
+    def step(self):
+        return pd.Timedelta(self.freq)
+
+    @property
+    def times(self):
+        return pd.date_range(self.start, periods=self.coords['ntimes'],
+                             freq=self.freq)
+
+    @property
+    def metadata(self):
+        '''
+        Station metadata (as passed to build_panel), indexed by stid
+        '''
+        return pd.DataFrame(self.coords['stations']).set_index('stid')
+
+    def time_index(self, value, side='left'):
+        '''
+        Row of the first grid time >= value (side='left') or one past the
+        last grid time <= value (side='right'), clipped to the panel
+        '''
+        ts = _utc(pd.Timestamp(value))
+        pos = (ts - self.start) / self.step
+        pos = int(np.ceil(pos)) if side == 'left' else int(np.floor(pos)) + 1
+        return min(max(pos, 0), self.coords['ntimes'])
+
+    def time_slice(self, start=None, end=None):
+        '''
+        Slice of grid rows in [start, end]
+        '''
+        lo = 0 if start is None else self.time_index(start, 'left')
+        hi = self.coords['ntimes'] if end is None else \
+            self.time_index(end, 'right')
+        return slice(lo, max(lo, hi))
+
+    @staticmethod
+    def _axis(labels, names):
+        if names is None:
+            return slice(None)
+        if isinstance(names, str):
+            return labels.index(names)
+        idx = np.array([labels.index(n) for n in names], dtype=np.int64)
+        return _as_slice(idx)
+
+    def sel(self, stations=None, variables=None, start=None, end=None):
+        '''
+        Values and mask for a time window of some stations and variables
+
+        Parameters:
+        -----------
+        stations (str or list) station id(s), default all
+        variables (str or list) variable name(s), default all
+        start, end (str or datetime) inclusive time bounds (UTC if naive)
+
+        Returns:
+        --------
+        values (ndarray) float32, NaN where missing
+        mask (ndarray) bool, True where observed
+        '''
+        key = (self.time_slice(start, end),
+               self._axis(self.stations, stations),
+               self._axis(self.variables, variables))
+        return self.values[key], self.mask[key]
+
+    def frame(self, stid, start=None, end=None):
+        '''
+        One station as a DataFrame indexed by grid time, like
+        processwx.process_stn resampled to the panel freq
+        '''
+        t = self.time_slice(start, end)
+        values, _ = self.sel(stations=stid, start=start, end=end)
+        return pd.DataFrame(np.array(values), index=self.times[t],
+                            columns=self.variables)
+
+
+def _utc(ts):
+    return ts.tz_localize('UTC') if ts.tzinfo is None else \
+        ts.tz_convert('UTC')
+
+
+def _as_slice(idx):
+    '''
+    An equivalent slice for evenly spaced indices (so numpy returns a view),
+    else the index array
+    '''
+    if len(idx) == 0:
+        return idx
+    if len(idx) == 1:
+        return slice(idx[0], idx[0] + 1)
+    step = idx[1] - idx[0]
+    if step > 0 and np.all(np.diff(idx) == step):
+        return slice(idx[0], idx[-1] + 1, step)
+    return idx
+
+
+def _index_ns(df):
+    index = df.index
+    if index.tz is None:
+        index = index.tz_localize('UTC')
+    return index.tz_convert('UTC').asi8
+
+
+def _station_span(store, stid):
+    '''
+    First and last observation time of a station [units: ns since epoch,
+    UTC], read from its table's memory-mapped index, or None if empty
+    '''
+    tbl = store.table(stid)
+    if not len(tbl):
+        return None
+    idx = tbl.column(tbl.meta['index'])
+    return int(idx[0]), int(idx[-1])
+
+
+def _station_columns(store, stid, variables):
+    columns = store.table(stid).columns
+    return [v for v in variables if v in columns]
+
+
+def _fill_station(panel, s, store, lo, hi):
+    '''
+    Bin one station's observations into grid rows [lo, hi) of the panel:
+    each cell gets the mean of the observations in [t, t + freq)
+    '''
+    panel.values[lo:hi, s, :] = np.nan
+    panel.mask[lo:hi, s, :] = False
+    stid = panel.stations[s]
+    columns = _station_columns(store, stid, panel.variables)
+    if hi <= lo or not columns:
+        return 0
+    t0 = panel.start + lo * panel.step
+    t1 = panel.start + hi * panel.step
+    df = store.load(stid, columns=columns, start=t0,
+                    end=t1 - pd.Timedelta(1, 'ns'))
+    if df.empty:
+        return 0
+    step = panel.step.value
+    rows = (_index_ns(df) - t0.value) // step
+    keep = (rows >= 0) & (rows < hi - lo)
+    rows = rows[keep]
+    for col in columns:
+        x = df[col].values[keep].astype(np.float64)
+        ok = ~np.isnan(x)
+        counts = np.bincount(rows[ok], minlength=hi - lo)
+        sums = np.bincount(rows[ok], weights=x[ok], minlength=hi - lo)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (sums / counts).astype(np.float32)
+        v = panel.variables.index(col)
+        panel.values[lo:hi, s, v] = mean
+        panel.mask[lo:hi, s, v] = counts > 0
+    return len(rows)
+
+
+def _station_records(metadata):
+    if isinstance(metadata, pd.DataFrame):
+        md = metadata.copy()
+        md.columns = [c.lower() for c in md.columns]
+        md = md.reset_index(drop='stid' in md.columns)
+    else:
+        md = pd.DataFrame({'stid': list(metadata)})
+    md['stid'] = md['stid'].astype(str)
+    # json friendly: NaN -> None, numpy scalars -> python
+    return json.loads(md.to_json(orient='records', date_format='iso'))
+
+
+def _resize(path, ntimes, n_cells):
+    for name, itemsize in (('values.f32', 4), ('mask.u8', 1)):
+        fname = os.path.join(path, name)
+        with open(fname, 'ab') as fout:
+            fout.truncate(ntimes * n_cells * itemsize)
+
+
+def _write_coords(path, coords):
+    tmp = os.path.join(path, 'coords.json.tmp')
+    with open(tmp, 'w') as fout:
+        json.dump(coords, fout, indent=1)
+    os.replace(tmp, os.path.join(path, 'coords.json'))
+
+
+def build_panel(path, store, metadata, variables, freq='1h', start=None,
+                end=None):
+    '''
+    Build a Panel from station data, one station at a time
+
+    Each station is loaded from the store and its observations averaged
+    into the grid cells by index arithmetic, written straight into the
+    memory-mapped arrays; no joined DataFrame of all stations is ever held
+    in memory.
+
+    Parameters:
+    -----------
+    path (str) panel directory (replaced if it exists)
+    store (StationStore or qc.QCStore) where station data is loaded from
+    metadata (DataFrame or list) station metadata, e.g.
+                                 processwx.select_stn(..., return_df=True),
+                                 or just a list of station ids
+    variables (list) Synoptic column names, e.g. ['air_temp_set_1']
+    freq (str) grid spacing as a pandas Timedelta string
+    start, end (str or datetime) grid bounds (UTC if naive), default the
+                                 span of the stations' data
+
+    Returns:
+    --------
+    panel (Panel) opened read/write
+    '''
+    stations = _station_records(metadata)
+    stids = [s['stid'] for s in stations]
+    spans = [sp for sp in (_station_span(store, stid) for stid in stids)
+             if sp is not None]
+    if start is None:
+        start = pd.Timestamp(min(sp[0] for sp in spans), tz='UTC') \
+            if spans else pd.Timestamp('1970-01-01', tz='UTC')
+    if end is None:
+        end = pd.Timestamp(max(sp[1] for sp in spans), tz='UTC') \
+            if spans else start
+    start = _utc(pd.Timestamp(start)).floor(freq)
+    end = _utc(pd.Timestamp(end))
+    ntimes = max(0, int((end - start) // pd.Timedelta(freq)) + 1)
+
+    os.makedirs(path, exist_ok=True)
+    for name in ('values.f32', 'mask.u8'):
+        fname = os.path.join(path, name)
+        if os.path.isfile(fname):
+            os.remove(fname)
+    _resize(path, ntimes, len(stids) * len(variables))
+    _write_coords(path, {'start': start.isoformat(),
+                         'freq': freq,
+                         'ntimes': ntimes,
+                         'stations': stations,
+                         'variables': list(variables)})
+    panel = Panel(path, mode='r+')
+    for s, stid in enumerate(stids):
+        n = _fill_station(panel, s, store, 0, ntimes)
+        print("Binned {0} observations of {1}".format(n, stid))
+    if ntimes:
+        panel.values.flush()
+        panel.mask.flush()
+    return panel
+
+
+def update_panel(path, store, end=None, refresh='1D'):
+    '''
+    Extend a panel in place with new observations
+
+    The time axis is extended to end (default the last observation of any
+    station) and, for every station, the grid rows from refresh before the
+    previous end onwards are recomputed, so cells that were only partly
+    observed at the last update are filled in. Earlier rows are left alone;
+    rebuild with build_panel after changing stations, variables or the
+    history of the data (e.g. the QC configuration).
+
+    Returns:
+    --------
+    panel (Panel) opened read/write
+    '''
+    panel = Panel(path)
+    old = panel.coords['ntimes']
+    if end is None:
+        spans = [sp for sp in (_station_span(store, stid)
+                               for stid in panel.stations) if sp is not None]
+        end = pd.Timestamp(max(sp[1] for sp in spans), tz='UTC') if spans \
+            else panel.start
+    ntimes = max(old, int((_utc(pd.Timestamp(end)) - panel.start) //
+                          panel.step) + 1)
+    _resize(path, ntimes, len(panel.stations) * len(panel.variables))
+    if ntimes > old:
+        # the files grow with zero bytes; _fill_station below resets the
+        # new rows to missing before filling them
+        _write_coords(path, dict(panel.coords, ntimes=ntimes))
+    panel = Panel(path, mode='r+')
+    lo = max(0, old - int(np.ceil(pd.Timedelta(refresh) / panel.step)))
+    for s, stid in enumerate(panel.stations):
+        _fill_station(panel, s, store, lo, ntimes)
+    if ntimes:
+        panel.values.flush()
+        panel.mask.flush()
+    print("Updated {0}: rows {1} to {2}".format(path, lo, ntimes))
+    return panel
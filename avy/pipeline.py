@@ -0,0 +1,552 @@
+"""
+@author: ABerner
+"""
+import argparse
+import ast
+import hashlib
+import inspect
+import json
+import os
+import sys
+import threading
+import textwrap
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import metrics
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+
+def path_fingerprint(path, content=False):
+    '''
+    Fingerprint of a file or directory tree: sizes and mtimes of every file
+    (or their sha1 with content=True). None if the path doesn't exist.
+    '''
+    if os.path.isfile(path):
+        files = [('', path)]
+    elif os.path.isdir(path):
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                full = os.path.join(root, name)
+                files.append((os.path.relpath(full, path), full))
+    else:
+        return None
+    h = hashlib.sha1()
+    for rel, full in files:
+        st = os.stat(full)
+        h.update(rel.encode('utf-8'))
+        if content:
+            with open(full, 'rb') as fin:
+                for block in iter(lambda: fin.read(1 << 20), b''):
+                    h.update(block)
+        else:
+            h.update('{0}:{1}'.format(st.st_size, st.st_mtime_ns)
+                     .encode('utf-8'))
+    return h.hexdigest()
+
+
+def _local_imports(source):
+    '''
+    Names of the avy modules imported anywhere in source
+    '''
+    names = set()
+    for node in ast.walk(ast.parse(textwrap.dedent(source))):
+        if isinstance(node, ast.Import):
+            names.update(a.name.split('.')[0] for a in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and \
+                not node.level:
+            names.add(node.module.split('.')[0])
+    return [name for name in names
+            if os.path.isfile(os.path.join(_here, name + '.py'))]
+
+
+def _code_fingerprint(func):
+    '''
+    sha1 of the source of func and of every avy module it imports, directly
+    or through other avy modules, so editing e.g. processbtac makes the
+    stages that call it stale
+    '''
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = getattr(func, '__qualname__', repr(func))
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+    sources = {}
+    todo = _local_imports(source)
+    while todo:
+        name = todo.pop()
+        if name in sources:
+            continue
+        with open(os.path.join(_here, name + '.py'), 'r') as fin:
+            sources[name] = fin.read()
+        todo.extend(_local_imports(sources[name]))
+    h = hashlib.sha1(source.encode('utf-8'))
+    for name in sorted(sources):
+        h.update(name.encode('utf-8'))
+        h.update(sources[name].encode('utf-8'))
+    return h.hexdigest()
+
+
+class Stage(object):
+    '''
+    One step of a pipeline: func(**params) reads the `inputs` paths and
+    writes the `outputs` paths.
+
+    A stage is stale, and rebuilt, when an output is missing or when its
+    fingerprint (its params, the source of func and of the avy modules it
+    imports, and the fingerprints of its inputs) differs from the one
+    recorded after its last successful run.
+    Stages without inputs (e.g. downloads) are exempt from the code part:
+    they rerun when forced, when an output is missing, when their params
+    change, or once their last run is older than ttl seconds, so edits to
+    their code (or to shared modules) take effect on the next forced or
+    ttl run rather than triggering a full refetch.
+    Dependencies are the stages listed in deps plus any stage whose output
+    is, or contains, one of this stage's inputs.
+    '''
+    def __init__(self, name, func, inputs=(), outputs=(), params=None,
+                 deps=(), ttl=None, content_hash=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = dict(params or {})
+        self.deps = list(deps)
+        self.ttl = ttl
+        self.content_hash = content_hash
+
+    def params_fingerprint(self):
+        return hashlib.sha1(json.dumps(self.params, sort_keys=True,
+                                       default=str).encode('utf-8')) \
+            .hexdigest()
+
+    def fingerprint(self):
+        data = {'name': self.name,
+                'params': self.params,
+                'code': _code_fingerprint(self.func),
+                'inputs': {path: path_fingerprint(path, self.content_hash)
+                           for path in self.inputs}}
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=str)
+                            .encode('utf-8')).hexdigest()
+
+    def run(self):
+        return self.func(**self.params)
+
+
+def _contains(outer, inner):
+    outer = os.path.normpath(outer)
+    inner = os.path.normpath(inner)
+    return inner == outer or inner.startswith(outer + os.sep)
+
+
+class Pipeline(object):
+    '''
+    DAG of Stages with incremental, parallel execution
+
+    The fingerprint of every successful stage is kept in a json state file,
+    so a run only executes stale stages (and whatever they make stale
+    downstream). Independent stages run concurrently on up to `jobs`
+    threads; a failed stage blocks its dependents but not unrelated
+    branches.
+
+    pipe = Pipeline('data/.pipeline_state.json')
+    pipe.add(Stage('nowcast', process, inputs=['btac.json.gz'],
+                   outputs=['nowcast.csv.gz']))
+    pipe.run(jobs=2)
+    '''
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.stages = {}
+        self._lock = threading.Lock()
+        self.state = {}
+        if os.path.isfile(state_file):
+            with open(state_file, 'r') as fin:
+                self.state = json.load(fin)
+
+    def add(self, stage):
+        if stage.name in self.stages:
+            raise ValueError("duplicate stage name: " + stage.name)
+        self.stages[stage.name] = stage
+        return stage
+
+    def dependencies(self, name):
+        stage = self.stages[name]
+        deps = set(stage.deps)
+        for other in self.stages.values():
+            if other.name == name:
+                continue
+            if any(_contains(out, inp) for out in other.outputs
+                   for inp in stage.inputs):
+                deps.add(other.name)
+        return deps
+
+    def order(self, targets=None):
+        '''
+        Topological order of the targets (default all stages) and
+        everything they depend on
+        '''
+        graph = {name: self.dependencies(name) for name in self.stages}
+        wanted = set()
+        todo = list(targets or self.stages)
+        while todo:
+            name = todo.pop()
+            if name not in self.stages:
+                raise KeyError("unknown stage: " + name)
+            if name not in wanted:
+                wanted.add(name)
+                todo.extend(graph[name])
+        order, done = [], set()
+        while len(order) < len(wanted):
+            ready = sorted(n for n in wanted - done if graph[n] <= done)
+            if not ready:
+                raise ValueError("dependency cycle among: " +
+                                 ', '.join(sorted(wanted - done)))
+            order.extend(ready)
+            done.update(ready)
+        return order, graph
+
+    def stale(self, name, force=()):
+        '''
+        Reason the stage needs to run, or None if it is up to date
+        '''
+        stage = self.stages[name]
+        if name in force:
+            return 'forced'
+        missing = [p for p in stage.outputs if not os.path.exists(p)]
+        if missing:
+            return 'missing output ' + missing[0]
+        last = self.state.get(name)
+        if last is None:
+            return 'never run'
+        if stage.ttl is not None and time.time() - last['finished'] > \
+                stage.ttl:
+            return 'older than ttl'
+        # states written before params were recorded separately have no
+        # 'params'; they are compared again after the stage's next run
+        if last.get('params', stage.params_fingerprint()) != \
+                stage.params_fingerprint():
+            return 'params changed'
+        # a code change alone must not trigger a full refetch of downloads
+        if stage.inputs and last['fingerprint'] != stage.fingerprint():
+            return 'inputs, params or code changed'
+        return None
+
+    def _save(self, name, fingerprint, params, seconds):
+        with self._lock:
+            self.state[name] = {'fingerprint': fingerprint,
+                                'params': params,
+                                'finished': time.time(),
+                                'seconds': seconds}
+            tmp = self.state_file + '.tmp'
+            d = os.path.dirname(self.state_file)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            with open(tmp, 'w') as fout:
+                json.dump(self.state, fout, indent=1, sort_keys=True)
+            os.replace(tmp, self.state_file)
+
+    def _execute(self, name):
+        stage = self.stages[name]
+        start = time.time()
+        with metrics.timer('stage_seconds', stage=name):
+            stage.run()
+        # fingerprint after the run: inputs are final once deps are done
+        self._save(name, stage.fingerprint(), stage.params_fingerprint(),
+                   time.time() - start)
+
+    def plan(self, targets=None, force=()):
+        '''
+        What run() would do, without running anything: stage -> reason it
+        would run (or None)
+        '''
+        order, graph = self.order(targets)
+        plan = {}
+        for name in order:
+            reason = self.stale(name, force)
+            if reason is None and any(plan[d] for d in graph[name]):
+                reason = 'upstream stale'
+            plan[name] = reason
+        return plan
+
+    def run(self, targets=None, force=(), jobs=1):
+        '''
+        Bring the targets (default all stages) up to date
+
+        Returns:
+        --------
+        status (dict) stage -> 'fresh', 'ran', 'failed' or 'blocked'
+        '''
+        order, graph = self.order(targets)
+        status = {}
+        pending = list(order)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            while pending or running:
+                for name in list(pending):
+                    deps = graph[name]
+                    if not deps <= set(status):
+                        continue
+                    pending.remove(name)
+                    if any(status[d] in ('failed', 'blocked') for d in deps):
+                        status[name] = 'blocked'
+                        print("{0}: blocked by failed dependency".format(name))
+                        continue
+                    reason = self.stale(name, force)
+                    if reason is None:
+                        status[name] = 'fresh'
+                        continue
+                    print("{0}: running ({1})".format(name, reason))
+                    running[pool.submit(self._execute, name)] = name
+                if not running:
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        status[name] = 'ran'
+                        print("{0}: done".format(name))
+                    except Exception:
+                        status[name] = 'failed'
+                        metrics.inc('failures', stage=name)
+                        print("{0}: failed\n{1}".format(
+                            name, traceback.format_exc()))
+        return status
+
+
+# --- stage functions for the default pipeline -------------------------------
+# heavy modules are imported inside each function, so planning a run (or
+# running analysis stages only) never loads the fetch code or its config
+
+def fetch_advisory(outfile, region, start_yr, end_yr, max_workers=1,
+                   rate=1.0):
+    from common import DataFetcher
+    from fetchbtac import fetch_btac_advisory
+    fetcher = DataFetcher(max_workers=max_workers, rate=rate)
+    fetch_btac_advisory(outfile, area=region, start_yr=start_yr,
+                        end_yr=end_yr, fetcher=fetcher, resume=True)
+
+
+def fetch_events(outdir, start_date):
+    from fetchbtac import stream_btac_events
+    stream_btac_events(outdir=outdir, start_date=tuple(start_date))
+
+
+def decode_images(infile, cachedir, outfile, max_workers=4, rate=2.0):
+    from hazardimg import decode_bulletin_images
+    decode_bulletin_images(infile, cachedir, outfile,
+                           max_workers=max_workers, rate=rate)
+
+
+def process_nowcast(infile, outfile, engine='fast', n_jobs=1,
+                    incremental=True, graphics=None):
+    from processbtac import process_btac_nowcast
+    process_btac_nowcast(infile, outfile, engine=engine, n_jobs=n_jobs,
+                         incremental=incremental, graphics=graphics)
+
+
+def process_events(infile, outfile):
+    from processbtac import process_btac_events
+    process_btac_events(infile, outfile)
+
+
+def fetch_wx(outdir, networks, args, start_date, end_date=None,
+             max_workers=1, window_days=None, rate=2.0, api_url=None):
+    from fetchwx import MwFetcher, fetch_mnet_ts, today
+    os.makedirs(outdir, exist_ok=True)
+    fetcher = MwFetcher(api_url=api_url) if api_url else None
+    fetch_mnet_ts(networks, {k: tuple(v) for k, v in args.items()},
+                  outdir, start_date=tuple(start_date),
+                  end_date=tuple(end_date) if end_date else today,
+                  max_workers=max_workers, window_days=window_days,
+                  rate=rate, fetcher=fetcher)
+
+
+def _stn_ids(wxdir):
+    '''
+    Stations with a CSV in wxdir: the STIDs of the metadata file written by
+    fetch_mnet_ts, or (without one) the CSV names other than metadata files
+    '''
+    from processwx import load_stn_metadata
+    names = [name[:-len('.csv')] for name in os.listdir(wxdir)
+             if name.endswith('.csv')]
+    files = set(name for name in names if 'metadata' not in name.lower())
+    if len(files) == len(names):
+        return sorted(files)
+    md_df = load_stn_metadata(wxdir)
+    if md_df is None:
+        return sorted(files)
+    return sorted(set(md_df['stid'].astype(str)) & files)
+
+
+def qc_wx(wxdir, storedir, n_jobs=1):
+    from processwx import StationStore
+    from qc import qc_stations
+    summary = qc_stations(StationStore(wxdir, storedir=storedir),
+                          _stn_ids(wxdir), n_jobs=n_jobs)
+    print(summary)
+
+
+def build_datasets(nowcast_files, events_file, wxdir, storedir, cachedir,
+                   stids=None, wx_columns=None):
+    import pandas as pd
+    from dataset import DatasetBuilder
+    from processwx import StationStore
+    from qc import QCStore
+    hzrd_df = pd.concat([pd.read_csv(f, index_col=0, parse_dates=[0])
+                         for f in nowcast_files]).sort_index()
+    events_df = pd.read_csv(events_file, index_col=0)
+    store = QCStore(StationStore(wxdir, storedir=storedir))
+    builder = DatasetBuilder(cachedir, store=store,
+                             stids=stids or _stn_ids(wxdir),
+                             wx_columns=wx_columns)
+    builder.build_all(hzrd_df, events_df)
+
+
+def build_pipeline(cfg):
+    '''
+    The standard fetch -> process -> QC -> dataset pipeline from a config
+    dict (see load_pipeline_config). Sections other than datadir are
+    optional; the dataset stage is added when btac, events and wx all are.
+
+    datadir: data
+    btac: {regions: [teton], start_yr: 2010, end_yr: 2018}
+    events: {start_date: [2000, 1, 1]}
+    wx: {networks: [48], args: {state: [WY]}, start_date: [2010, 1, 1]}
+        (optionally end_date, and api_url for another Synoptic-like server)
+    qc: {n_jobs: 4}
+    dataset: {stids: [...], wx_columns: [air_temp_set_1]}
+    '''
+    d = cfg['datadir']
+    pipe = Pipeline(os.path.join(d, '.pipeline_state.json'))
+    nowcast_files = []
+    if 'btac' in cfg:
+        c = cfg['btac']
+        for region in c.get('regions', ['teton']):
+            raw = os.path.join(d, 'btac_{0}.json.gz'.format(region))
+            out = os.path.join(d, 'nowcast_{0}.csv.gz'.format(region))
+            pipe.add(Stage('fetch_advisory_' + region, fetch_advisory,
+                           outputs=[raw], ttl=c.get('ttl'),
+                           params={'outfile': raw, 'region': region,
+                                   'start_yr': c['start_yr'],
+                                   'end_yr': c['end_yr'],
+                                   'max_workers': c.get('max_workers', 1),
+                                   'rate': c.get('rate', 1.0)}))
+            inputs, graphics = [raw], None
+            if region != 'teton':
+                # tog and grey ratings are only in the hazard images
+                graphics = os.path.join(
+                    d, 'hazard_images_{0}.json'.format(region))
+                pipe.add(Stage('hazard_images_' + region, decode_images,
+                               inputs=[raw], outputs=[graphics],
+                               params={'infile': raw,
+                                       'cachedir': os.path.join(
+                                           d, 'hazard_images'),
+                                       'outfile': graphics,
+                                       'max_workers': c.get('max_workers',
+                                                            1),
+                                       'rate': c.get('rate', 1.0)}))
+                inputs.append(graphics)
+            pipe.add(Stage('nowcast_' + region, process_nowcast,
+                           inputs=inputs, outputs=[out],
+                           params={'infile': raw, 'outfile': out,
+                                   'engine': c.get('engine', 'fast'),
+                                   'n_jobs': c.get('n_jobs', 1),
+                                   'incremental': c.get('incremental',
+                                                        True),
+                                   'graphics': graphics}))
+            nowcast_files.append(out)
+    events_file = None
+    if 'events' in cfg:
+        c = cfg['events']
+        raw = os.path.join(d, 'btac_events')
+        events_file = os.path.join(d, 'btac_events.csv.gz')
+        pipe.add(Stage('fetch_events', fetch_events, outputs=[raw],
+                       ttl=c.get('ttl'),
+                       params={'outdir': raw,
+                               'start_date': c.get('start_date',
+                                                   [2000, 1, 1])}))
+        pipe.add(Stage('events', process_events, inputs=[raw],
+                       outputs=[events_file],
+                       params={'infile': raw, 'outfile': events_file}))
+    wxdir = os.path.join(d, 'wx') + '/'
+    storedir = os.path.join(d, 'wx_store')
+    if 'wx' in cfg:
+        c = cfg['wx']
+        pipe.add(Stage('fetch_wx', fetch_wx, outputs=[wxdir],
+                       ttl=c.get('ttl'),
+                       params={'outdir': wxdir,
+                               'networks': c['networks'],
+                               'args': c.get('args', {}),
+                               'start_date': c['start_date'],
+                               'end_date': c.get('end_date'),
+                               'max_workers': c.get('max_workers', 1),
+                               'window_days': c.get('window_days'),
+                               'rate': c.get('rate', 2.0),
+                               'api_url': c.get('api_url')}))
+        pipe.add(Stage('qc', qc_wx, inputs=[wxdir], outputs=[storedir],
+                       params={'wxdir': wxdir, 'storedir': storedir,
+                               'n_jobs': cfg.get('qc', {}).get('n_jobs',
+                                                                1)}))
+    if nowcast_files and events_file and 'wx' in cfg:
+        c = cfg.get('dataset', {})
+        cachedir = os.path.join(d, 'datasets')
+        pipe.add(Stage('dataset', build_datasets,
+                       inputs=nowcast_files + [events_file, storedir],
+                       outputs=[cachedir],
+                       params={'nowcast_files': nowcast_files,
+                               'events_file': events_file,
+                               'wxdir': wxdir, 'storedir': storedir,
+                               'cachedir': cachedir,
+                               'stids': c.get('stids'),
+                               'wx_columns': c.get('wx_columns')}))
+    return pipe
+
+
+def load_pipeline_config(filename):
+    with open(filename, 'r') as fin:
+        if filename.endswith('.json'):
+            return json.load(fin)
+        import yaml
+        return yaml.safe_load(fin)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Bring avy pipeline outputs up to date')
+    parser.add_argument('config', help='pipeline config (.yml or .json)')
+    parser.add_argument('targets', nargs='*',
+                        help='stages to build (default all)')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--force', default='',
+                        help='comma separated stages to rerun regardless')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='only show which stages would run and why')
+    parser.add_argument('--metrics', default=None,
+                        help='append run metrics to this JSON lines file')
+    args = parser.parse_args(argv)
+
+    pipe = build_pipeline(load_pipeline_config(args.config))
+    force = set(s for s in args.force.split(',') if s)
+    targets = args.targets or None
+    if args.dry_run:
+        for name, reason in pipe.plan(targets, force).items():
+            print('{0:<24} {1}'.format(name, reason or 'up to date'))
+        return 0
+    if args.metrics:
+        metrics.enable()
+    status = pipe.run(targets, force, jobs=args.jobs)
+    if args.metrics:
+        metrics.write_json_lines(args.metrics)
+    for name, st in status.items():
+        print('{0:<24} {1}'.format(name, st))
+    return 1 if any(st in ('failed', 'blocked') for st in status.values()) \
+        else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
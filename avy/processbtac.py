@@ -1,92 +1,407 @@
 """
 @author: ABerner
 """
+import os
 import pandas as pd
 import re
 import json
+import lxml.html
 from bs4 import BeautifulSoup
-from common import GzipJsonFile
+import metrics
+from colstore import ColumnTable
+from common import GzipJsonFile, RecordIndex, batched, bounded_map
+from schema import event_types
+from hazardimg import bulletin_images, graphic_ratings
+import gzip
+from concurrent.futures import ProcessPoolExecutor
 from gzip import GzipFile
 
-def process_btac_nowcast(infile, outfile, cutoff=15000):
+def hzrd_mapper(text):
     '''
-    Takes the html files saved from the daily avalanche bulletins and extracts
-    the hazard ratings at different elevations for the morning and afternoon.
-    Writes cleaned output to .csv.
-    
-    TO-DO: bulletins for the Continental Divide and Grey's Pass regions 
-    somewhat inconveniently encode the hazard only in gif form, cannot be
-    scraped from text. Will need to add image download/processing to make this
-    work. Eventually would also like to extract avalanche problem details.
+    Map a hazard rating description to its numeric level (0 = no rating)
+    '''
+    text = text.lower()
+    if 'low' in text:
+        return 1
+    elif 'moderate' in text:
+        return 2
+    elif 'considerable' in text:
+        return 3
+    elif 'high' in text:
+        return 4
+    elif 'extreme' in text:
+        return 5
+    else:
+        return 0
+
+
+lvl_dict = {0: 'atl',
+            1: 'tl',
+            2: 'btl'}
+
+date_re = re.compile(r'(\d{2}/\d{2}/\d{4})')
+
+# bump when parse_btac_bulletin changes what it extracts, so incremental
+# nowcast outputs built by older code are rebuilt from scratch
+parser_version = 1
+
+
+class Bs4Bulletin(object):
+    '''
+    Bulletin element access through a full BeautifulSoup tree (reference
+    engine)
     '''
-    df = pd.DataFrame()
+    def __init__(self, content):
+        self.soup = BeautifulSoup(content, "lxml")
+
+    def headline_text(self):
+        fcst_header = self.soup.find_all('div', class_='forecast-headline-box')
+        return ''.join([elem.get_text() for elem in fcst_header])
+
+    def hazard_rows(self):
+        hzrd_tbl = self.soup.find_all('table', class_='mtnWeather')[2]
+        return [[elem.text.strip() for elem in row.find_all('td')]
+                for row in hzrd_tbl.find_all('tr')]
+
+    def hazard_images(self):
+        hzrd_tbl = self.soup.find_all('table', class_='mtnWeather')[2]
+        rows = []
+        for row in hzrd_tbl.find_all('tr'):
+            imgs = [td.find('img') for td in row.find_all('td')[1:]]
+            if imgs and all(img is not None and img.get('src')
+                            for img in imgs):
+                rows.append([img['src'] for img in imgs])
+        return rows
+
+
+class FastBulletin(object):
+    '''
+    Bulletin element access without building a document tree. The raw HTML
+    is scanned for the opening tags of the forecast-headline-box divs and the
+    mtnWeather tables, and only those elements are cut out (balancing nested
+    tags of the same name) and parsed with lxml. Returns the same text as
+    Bs4Bulletin for well-formed bulletins; see compare_nowcast_engines.
+    '''
+    _class_re = re.compile(
+        r'\bclass\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.I)
+
+    def __init__(self, content):
+        self.content = content
+
+    def _elements(self, tag, cls, limit=None):
+        open_re = re.compile(r'<{0}\b([^>]*)>'.format(tag), re.I)
+        frags = []
+        for m in open_re.finditer(self.content):
+            attr = self._class_re.search(m.group(1))
+            if not attr:
+                continue
+            classes = (attr.group(1) or attr.group(2) or attr.group(3)).split()
+            if cls not in classes:
+                continue
+            end = self._element_end(tag, m.start())
+            frags.append(lxml.html.fragment_fromstring(
+                self.content[m.start():end]))
+            if limit and len(frags) == limit:
+                break
+        return frags
+
+    def _element_end(self, tag, start):
+        tag_re = re.compile(r'<(/?){0}\b[^>]*>'.format(tag), re.I)
+        depth = 0
+        for m in tag_re.finditer(self.content, start):
+            depth += -1 if m.group(1) else 1
+            if depth == 0:
+                return m.end()
+        return len(self.content)
+
+    def headline_text(self):
+        return ''.join([elem.text_content() for elem in
+                        self._elements('div', 'forecast-headline-box')])
+
+    def hazard_rows(self):
+        hzrd_tbl = self._elements('table', 'mtnWeather', limit=3)[2]
+        return [[elem.text_content().strip() for elem in row.iter('td')]
+                for row in hzrd_tbl.iter('tr')]
+
+    def hazard_images(self):
+        hzrd_tbl = self._elements('table', 'mtnWeather', limit=3)[2]
+        rows = []
+        for row in hzrd_tbl.iter('tr'):
+            imgs = [next(td.iter('img'), None)
+                    for td in list(row.iter('td'))[1:]]
+            if imgs and all(img is not None and img.get('src')
+                            for img in imgs):
+                rows.append([img.get('src') for img in imgs])
+        return rows
+
+
+bulletin_engines = {'bs4': Bs4Bulletin,
+                    'fast': FastBulletin}
+
+
+def parse_btac_bulletin(line, cutoff=15000, engine='bs4', graphics=None):
+    '''
+    Extract the date, region and am/pm hazard ratings from one fetched
+    bulletin record ({'url': ..., 'content': ...}). Returns a flat row dict,
+    or None if the bulletin is too short or can't be parsed.
+
+    engine selects how elements are pulled out of the HTML: 'bs4' builds the
+    full BeautifulSoup tree, 'fast' (FastBulletin) only parses the headline
+    box and hazard table.
+
+    Continental Divide and Greys River bulletins only show the hazard as
+    images; their ratings are looked up in graphics, the url -> decoded
+    image table from hazardimg.decode_bulletin_images.
+    '''
+    if len(line['content']) < cutoff:
+        return None
     
-    def hzrd_mapper(text):
-        text = text.lower()
-        if 'low' in text:
-            return 1
-        elif 'moderate' in text:
-            return 2
-        elif 'considerable' in text:
-            return 3
-        elif 'high' in text:
-            return 4
-        elif 'extreme' in text:
-            return 5
-        else:
-            return 0
+    data_row = {}
+    s = bulletin_engines[engine](line['content'])
+    
+    header_text = s.headline_text()
+    dt = date_re.search(header_text).group()
+    data_row.update({'date': dt})
+    
+    header_text = header_text.lower()
+    if 'teton' in header_text:
+        region = 'teton'
+    elif 'continental divide' in header_text:
+        region = 'tog'
+    elif 'grey' in header_text:
+        region = 'grey'
+    else:
+        print("region not recognized, skipping...")
+        return None
+    data_row.update({'region': region})
     
-    lvl_dict = {0: 'atl',
-                1: 'tl',
-                2: 'btl'}
-                    
-    df_idx = 0
+    if 'teton_print' in line['url'] and region == 'teton':
+        for i, cols in enumerate(s.hazard_rows()):
+            data_row.update({lvl_dict[i]+'_am': hzrd_mapper(cols[1]),
+                             lvl_dict[i]+'_pm': hzrd_mapper(cols[2])})
+    elif graphics is not None:
+        ratings = graphic_ratings(*bulletin_images(line, s), graphics)
+        if ratings is None:
+            print("hazard graphic not decoded or unrated, skipping...")
+            return None
+        data_row.update(ratings)
+    else:
+        print("hazard graphics need decoding first (see hazardimg)")
+        return None
+    return data_row
+
+
+def compare_nowcast_engines(infile, cutoff=15000, engines=('bs4', 'fast'),
+                            graphics=None):
+    '''
+    Parse every bulletin in infile with each engine and report the urls
+    where the extracted rows differ (an engine raising counts as a
+    difference). Run this over the archive before switching engines; the
+    benchmark suite's nowcast_engines_agree check runs it on synthetic
+    bulletins and fails on any difference.
+
+    Returns:
+    --------
+    mismatches (list) (url, {engine: row or exception}) for each difference
+    '''
+    mismatches = []
+    n = 0
     with GzipJsonFile(filename=infile, mode='r') as fin:
         for line in fin:
-            if len(line['content']) < cutoff:
-                continue
-            
-            data_row = {}
-            s = BeautifulSoup(line['content'],"lxml")
-            
-            fcst_header = s.find_all('div', class_='forecast-headline-box')
-            header_text = ''.join([elem.get_text() for elem in fcst_header])
-            p = re.compile('(\d{2}/\d{2}/\d{4})')
-            dt = p.search(header_text).group()
-            data_row.update({'date': dt})
-            
-            header_text = header_text.lower()
-            if 'teton' in header_text:
-                region = 'teton'
-            elif 'continental divide' in header_text:
-                region = 'tog'
-            elif 'grey' in header_text:
-                region = 'grey'
-            else:
-                print("region not recognized, skipping...")
-                continue
-            data_row.update({'region': region})
-            
-            mtn_wx_tbl = s.find_all('table', class_='mtnWeather')
-            if 'teton_print' in line['url'] and region == 'teton':
-                hzrd_tbl = mtn_wx_tbl[2]
-                rows = hzrd_tbl.find_all('tr')
-                
-                for i, row in enumerate(rows):
-                    cols = row.find_all('td')
-                    cols = [elem.text.strip() for elem in cols]
-                    data_row.update({lvl_dict[i]+'_am': hzrd_mapper(cols[1]),
-                                     lvl_dict[i]+'_pm': hzrd_mapper(cols[2])})
-            else:
-                print("hazard graphic parsing not yet implemented")
-                continue
-            df = df.append(pd.DataFrame(data_row, index=[df_idx]))
-            df_idx += 1
+            n += 1
+            results = {}
+            for engine in engines:
+                try:
+                    results[engine] = parse_btac_bulletin(line, cutoff,
+                                                          engine, graphics)
+                except Exception as e:
+                    results[engine] = e
+            values = list(results.values())
+            if any(isinstance(v, Exception) or v != values[0]
+                   for v in values):
+                mismatches.append((line['url'], results))
+    print("{0} of {1} bulletins differ between engines".format(
+        len(mismatches), n))
+    return mismatches
+
+
+def _parse_batch(batch, cutoff, engine, graphics):
+    rows = [parse_btac_bulletin(line, cutoff, engine, graphics)
+            for line in batch]
+    return ([row for row in rows if row is not None],
+            [line['url'] for line, row in zip(batch, rows) if row is not None],
+            len(batch))
+
+
+def _parse_traced(line, cutoff, engine, graphics):
+    '''
+    parse_btac_bulletin, logging its time per record when metrics tracing
+    is on
+    '''
+    if not metrics.tracing():
+        return parse_btac_bulletin(line, cutoff, engine, graphics)
+    with metrics.timer('parse_seconds', engine=engine) as t:
+        row = parse_btac_bulletin(line, cutoff, engine, graphics)
+    metrics.event('parse', url=line['url'], engine=engine,
+                  seconds=t.elapsed, parsed=row is not None)
+    return row
+
+
+def parse_btac_bulletins(infile, cutoff=15000, n_jobs=1, batch_size=32,
+                         engine='bs4', graphics=None):
+    '''
+    Parse every bulletin in a fetched GzipJsonFile and return the list of row
+    dicts, in file order.
+
+    With n_jobs > 1 records are streamed to a process pool in batches of
+    batch_size; only a few batches per worker are in flight at once, so the
+    archive is never held in memory. Per-record parse timings (with
+    metrics tracing on) are only recorded for n_jobs=1.
+    '''
+    with GzipJsonFile(filename=infile, mode='r') as fin:
+        return _parse_records(fin, cutoff, n_jobs, batch_size, engine,
+                              graphics)
+
+
+def _parse_records(records, cutoff, n_jobs, batch_size, engine, graphics,
+                   parsed=None):
+    '''
+    Parse records into a list of rows; the urls of the records that gave a
+    row are appended to parsed, if given
+    '''
+    rows = []
+    parsed = [] if parsed is None else parsed
+    n = 0
+    with metrics.timer('stage_seconds', stage='parse_btac_bulletins'):
+        if n_jobs == 1:
+            for line in records:
+                n += 1
+                row = _parse_traced(line, cutoff, engine, graphics)
+                if row is not None:
+                    rows.append(row)
+                    parsed.append(line['url'])
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                for batch_rows, batch_urls, n_batch in bounded_map(
+                        pool, _parse_batch, batched(records, batch_size),
+                        max_pending=2 * n_jobs,
+                        args=(cutoff, engine, graphics)):
+                    rows.extend(batch_rows)
+                    parsed.extend(batch_urls)
+                    n += n_batch
+    metrics.inc('records', n, stage='parse_btac_bulletins')
+    metrics.inc('skipped', n - len(rows), stage='parse_btac_bulletins')
+    return rows
+
+
+def process_btac_nowcast(infile, outfile, cutoff=15000, n_jobs=1,
+                         batch_size=32, engine='bs4', incremental=False,
+                         graphics=None):
+    '''
+    Takes the html files saved from the daily avalanche bulletins and extracts
+    the hazard ratings at different elevations for the morning and afternoon.
+    Writes cleaned output to .csv. Set n_jobs > 1 to parse bulletins on a
+    process pool (see parse_btac_bulletins), and engine='fast' to skip
+    building a full BeautifulSoup tree per bulletin (see FastBulletin).
+
+    With incremental=True only bulletins not processed by an earlier run are
+    parsed (see NowcastState) and merged into the existing output: rows
+    dated after everything in it are appended as a new gzip member, anything
+    else is upserted on (date, region) and the table rewritten. A changed
+    parser_version, cutoff or engine, or an output modified by something
+    else, falls back to a full rebuild.
+    
+    Bulletins for the Continental Divide and Grey's Pass regions encode the
+    hazard only in gif form. Decode their images first with
+    hazardimg.decode_bulletin_images and pass the resulting table (or the
+    json file it wrote) as graphics. Eventually would also like to extract
+    avalanche problem details.
+    '''
+    if isinstance(graphics, str):
+        with open(graphics, 'r') as fin:
+            graphics = json.load(fin)
+    with metrics.timer('stage_seconds', stage='process_btac_nowcast'):
+        return _process_btac_nowcast(infile, outfile, cutoff, n_jobs,
+                                     batch_size, engine, incremental,
+                                     graphics)
+
+
+class NowcastState(object):
+    '''
+    Record of what an incremental nowcast output was built from, kept as
+    json at <outfile>.state.json: the parser settings, the input records
+    already in the output (url -> byte offset of the record in an indexed
+    input, so a refetched bulletin is parsed again), the last date in the
+    output and the output's size and mtime when it was written.
+    Records that gave no row (e.g. their hazard graphics weren't decoded
+    yet) are not recorded, so they are parsed again on the next run.
+    '''
+    def __init__(self, outfile, cutoff, engine):
+        self.filename = outfile + '.state.json'
+        self.outfile = outfile
+        self.settings = {'parser_version': parser_version,
+                         'cutoff': cutoff,
+                         'engine': engine}
+        self.seen = {}
+        self.last_date = None
+
+    def _stamp(self):
+        st = os.stat(self.outfile)
+        return [st.st_size, st.st_mtime_ns]
+
+    def load(self):
+        '''
+        Load the state; False if there is none or it doesn't describe the
+        current output and settings (i.e. a full rebuild is needed)
+        '''
+        if not (os.path.isfile(self.filename) and
+                os.path.isfile(self.outfile)):
+            return False
+        with open(self.filename, 'r') as fin:
+            state = json.load(fin)
+        if state.get('settings') != self.settings or \
+                state.get('output') != self._stamp():
+            return False
+        self.seen = state['seen']
+        self.last_date = pd.Timestamp(state['last_date'])
+        return True
+
+    def save(self):
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump({'settings': self.settings,
+                       'seen': self.seen,
+                       'last_date': str(self.last_date),
+                       'output': self._stamp()}, fout)
+        os.replace(tmp, self.filename)
+
+
+def _unseen_records(infile, seen, offsets):
+    '''
+    Yield the records of infile not in seen, noting their offsets (None
+    for an unindexed input) in offsets so the caller can mark the ones that
+    parsed as seen. An indexed input is read by seeking to the new records
+    only; otherwise the file is scanned and seen urls skipped.
+    '''
+    entries = RecordIndex(infile + '.idx').load()
+    with GzipJsonFile(filename=infile, mode='r') as fin:
+        if not entries:
+            for line in fin:
+                if line['url'] not in seen:
+                    offsets[line['url']] = None
+                    yield line
+            return
+        new = [e for e in entries if seen.get(e['url']) != e['offset']]
+        for entry, line in zip(new, fin.read(new)):
+            offsets[entry['url']] = entry['offset']
+            yield line
+
+
+def _nowcast_frame(rows):
+    df = pd.DataFrame(rows)
     df['date'] = pd.to_datetime(df['date'])
-    df['dt_am'] = df['date'].apply(lambda x: 
-                                   pd.datetime(x.year, x.month, x.day, 9))
-    df['dt_pm'] = df['date'].apply(lambda x:
-                                   pd.datetime(x.year, x.month, x.day, 15))
+    df['dt_am'] = df['date'] + pd.Timedelta(hours=9)
+    df['dt_pm'] = df['date'] + pd.Timedelta(hours=15)
     
     col_names = ['date', 'region', 'atl', 'tl', 'btl']
     df_am = df[['dt_am', 'region', 'atl_am', 'tl_am', 'btl_am']]
@@ -96,46 +411,75 @@ def process_btac_nowcast(infile, outfile, cutoff=15000):
     df_pm.columns = col_names
     df_pm = df_pm.set_index('date')
     df = pd.concat([df_am,df_pm])
-    df = df.sort_index()
-    df.to_csv(outfile, compression='gzip')
+    return df.sort_index(kind='mergesort')
+
+
+def _process_btac_nowcast(infile, outfile, cutoff, n_jobs, batch_size,
+                          engine, incremental, graphics):
+    state = NowcastState(outfile, cutoff, engine)
+    update = incremental and state.load()
+    if incremental and not update:
+        print("No usable state for {0}, rebuilding".format(outfile))
+    offsets, parsed = {}, []
+    rows = _parse_records(_unseen_records(infile, state.seen, offsets),
+                          cutoff, n_jobs, batch_size, engine, graphics,
+                          parsed)
+    # only records that made it into the output count as seen
+    state.seen.update((url, offsets[url]) for url in parsed)
+    if not rows:
+        if update:
+            state.save()
+            print("No new bulletins in " + infile)
+            return None
+        print("No bulletins parsed from " + infile)
+        return None
+    df = _nowcast_frame(rows)
+    metrics.inc('records', len(df), stage='process_btac_nowcast')
+    if not update:
+        df.to_csv(outfile, compression='gzip')
+    elif df.index[0] > state.last_date:
+        # strictly after the existing rows: append as another gzip member
+        with open(outfile, 'ab') as fout:
+            fout.write(gzip.compress(df.to_csv(header=False)
+                                     .encode('utf-8')))
+    else:
+        old = pd.read_csv(outfile, index_col=0, parse_dates=[0],
+                          compression='gzip')
+        df = pd.concat([old, df])
+        df = df[~df.set_index('region', append=True).index
+                .duplicated(keep='last')]
+        df = df.sort_index(kind='mergesort')
+        df.to_csv(outfile, compression='gzip')
+    if state.last_date is None or df.index[-1] > state.last_date:
+        state.last_date = df.index[-1]
+    state.save()
 
 
 def process_btac_events(infile, outfile):
     '''
     Takes serialized JSON file of BTAC avalanche events and writes to .csv for 
-    ease of conversion to a pandas dataframe.
+    ease of conversion to a pandas dataframe. infile can also be a
+    ColumnTable directory written by fetchbtac.stream_btac_events.
     '''
-    with GzipFile(filename=infile, mode='r') as fin:
-        dd = json.loads(fin.read())
-    
-    type_mapper = {'ID': float,
-                   'affiliation': str,
-                   'aspect': str,
-                   'avy_trigger': str,
-                   'depth': float,
-                   'destructive_size': float,
-                   'elevation': float,
-                   'event_date': str,
-                   'event_time': str,
-                   'event_year': float,
-                   'fatality': float,
-                   'fldType': str,
-                   'lat': float,
-                   'lng': float,
-                   'notes': str,
-                   'observer': str,
-                   'pathname': str,
-                   'relative_size': float,
-                   'slope_angle': str,
-                   'zone': str}
+    with metrics.timer('stage_seconds', stage='process_btac_events'):
+        return _process_btac_events(infile, outfile)
+
+
+def _process_btac_events(infile, outfile):
+    if os.path.isdir(infile):
+        df = ColumnTable(infile).read()
+    else:
+        with GzipFile(filename=infile, mode='r') as fin:
+            dd = json.loads(fin.read())
+        df = pd.DataFrame(dd['data'])
     
-    df = pd.DataFrame(dd['data'])
-    for col in type_mapper.keys():
-        df[col] = df[col].astype(type_mapper[col])
+    for col in event_types.keys():
+        df[col] = df[col].astype(event_types[col])
     df['event_date'] = pd.to_datetime(df['event_date'])
     df = df[['ID', 'event_date', 'event_time',
              'zone', 'pathname', 'elevation', 'lat', 'lng', 'aspect',
              'slope_angle', 'destructive_size','relative_size', 'depth',
              'avy_trigger', 'fldType', 'fatality', 'observer', 'affiliation', 
              'notes']]
+    metrics.inc('records', len(df), stage='process_btac_events')
     df.to_csv(outfile, compression='gzip')
\ No newline at end of file
@@ -3,9 +3,14 @@
 """
 from math import sin, cos, sqrt, atan2, radians
 from os import listdir
+import os
 
+import numpy as np
 import pandas as pd
-from fetchwx import mwnet_dict
+import metrics
+from common import mwnet_dict
+from colstore import ColumnTable
+from geo import GeoIndex, haversine
 
 #implementation courtesy of Stack Overflow
 #http://stackoverflow.com/questions/19412462/getting-distance-between-two-points-based-on-latitude-longitude
@@ -43,6 +48,45 @@ def calc_dist(pt1, pt2):
     return R * c
     
 
+def load_stn_metadata(datadir):
+    '''
+    Read the station metadata file in datadir, with lower-cased column names.
+    Returns None if there isn't exactly one metadata file.
+    '''
+    file_list = listdir(datadir)
+    md_file = [file for file in file_list if 'metadata' in file.lower()]
+    if len(md_file) != 1:
+        print("more than one metadatafile, check directory setup")
+        return None
+    filepath = datadir + '/' + md_file[0]
+    df = pd.read_csv(filepath, compression='gzip', index_col=[0])
+    df.columns = [col.lower() for col in df.columns]
+    return df
+
+
+def _filter_stns(df, args):
+    '''
+    Apply the mnet/state/elevation filters of select_stn to a metadata frame.
+    Returns None (after printing why) on bad arguments.
+    '''
+    args_keys = args.keys()
+    if 'mnet' in args_keys:
+        try:
+            nets = [mwnet_dict[mnet] for mnet in args['mnet']]
+        except KeyError:
+            print("mesonet string not recognized")
+            return None
+        df = df[df['mnet_id'].isin(nets)]
+    if 'state' in args_keys:
+        states = [state.upper() for state in args['state']]
+        df = df[df['state'].isin(states)]
+    if 'elevation' in args_keys:
+        el_min = args['elevation']['min']
+        el_max = args['elevation']['max']
+        df = df[(df['elevation'] < el_max) & (df['elevation'] > el_min)]
+    return df
+
+
 def select_stn(datadir, args, return_df=False):
     '''
     Provides a list of downloaded weather stations meeting criteria in args.
@@ -58,14 +102,9 @@ def select_stn(datadir, args, return_df=False):
     stn_list (list) list of station id strings corresponding to station data 
                     files
     '''
-    file_list = listdir(datadir)
-    md_file = [file for file in file_list if 'metadata' in file.lower()]
-    if len(md_file) != 1:
-        print("more than one metadatafile, check directory setup")
+    df = load_stn_metadata(datadir)
+    if df is None:
         return None
-    filepath = datadir + '/' + md_file[0]
-    df = pd.read_csv(filepath, compression='gzip', index_col=[0])
-    df.columns = [col.lower() for col in df.columns]
     
     args_keys = args.keys()
     allowed_keys = ['mnet', 'elevation', 'state', 'max_dist', 'k_nrst',
@@ -79,23 +118,14 @@ def select_stn(datadir, args, return_df=False):
             print("must provide coordinates for proximity calculations")
             return None
         else:
+            # one point: a single vectorized pass over the stations is
+            # cheaper than building a GeoIndex (see nearest_stns for many)
             pt1 = args['lat_lon']
-            df['dist'] = df.apply(lambda x: calc_dist(pt1,(x['latitude'],
-                                  x['longitude'])), axis=1)
-    if 'mnet' in args_keys:
-        try:
-            nets = [mwnet_dict[mnet] for mnet in args['mnet']]
-        except KeyError:
-            print("mesonet string not recognized")
-            return None
-        df = df[df['mnet_id'].isin(nets)]
-    if 'state' in args_keys:
-        states = [state.upper() for state in args['state']]
-        df = df[df['state'].isin(states)]
-    if 'elevation' in args_keys:
-        el_min = args['elevation']['min']
-        el_max = args['elevation']['max']
-        df = df[(df['elevation'] < el_max) & (df['elevation'] > el_min)]
+            df['dist'] = haversine(pt1[0], pt1[1], df['latitude'].values,
+                                   df['longitude'].values)
+    df = _filter_stns(df, args)
+    if df is None:
+        return None
     if 'k_nrst' in args_keys and 'max_dist' in args_keys:
         print("can only specify one of k_nrst or max_dist")
         return None
@@ -115,14 +145,164 @@ def select_stn(datadir, args, return_df=False):
         else:
             return list(df['stid'].values)
 
+
+def nearest_stns(datadir, lat, lon, args={'k_nrst': 1}, md_df=None):
+    '''
+    Batch version of the proximity queries in select_stn: finds stations
+    near every one of many target points (e.g. all BTAC event locations) in
+    one call, using a GeoIndex over the station metadata.
+    
+    Parameters:
+    -----------
+    datadir (str) path to directory where station data is stored
+    lat, lon (array) target point coordinates [units: degrees]
+    args (dict) exactly one of 'k_nrst' or 'max_dist' [units: km], plus
+                optionally the 'mnet', 'state' and 'elevation' filters of
+                select_stn
+    md_df (DataFrame) metadata to use instead of reading it from datadir
+    
+    Returns:
+    --------
+    df (DataFrame) one row per (target point, station) match with columns
+                   pt (position of the target point), stid, dist and rank
+                   (0 = nearest), sorted by pt then dist. With k_nrst,
+                   target points with missing coordinates get stid None and
+                   dist NaN.
+    '''
+    allowed_keys = ['mnet', 'elevation', 'state', 'max_dist', 'k_nrst']
+    if not set(args.keys()).issubset(allowed_keys):
+        print("bad keys in args")
+        return None
+    if ('k_nrst' in args) == ('max_dist' in args):
+        print("must specify exactly one of k_nrst or max_dist")
+        return None
+    if md_df is None:
+        md_df = load_stn_metadata(datadir)
+        if md_df is None:
+            return None
+    md_df = _filter_stns(md_df, args)
+    if md_df is None or md_df.empty:
+        print("No stations meet criteria")
+        return None
+    
+    index = GeoIndex(md_df['latitude'].values, md_df['longitude'].values)
+    stids = md_df['stid'].values
+    if 'k_nrst' in args:
+        dist, idx = index.query_knn(lat, lon, k=args['k_nrst'])
+        n, k = idx.shape
+        pt = np.repeat(np.arange(n), k)
+        rank = np.tile(np.arange(k), n)
+        idx, dist = idx.ravel(), dist.ravel()
+    else:
+        results = index.query_radius(lat, lon, args['max_dist'])
+        if not results:
+            return pd.DataFrame(columns=['pt', 'stid', 'dist', 'rank'])
+        pt = np.repeat(np.arange(len(results)),
+                       [len(r[0]) for r in results])
+        rank = np.concatenate([np.arange(len(r[0])) for r in results])
+        idx = np.concatenate([r[0] for r in results])
+        dist = np.concatenate([r[1] for r in results])
+    idx = idx.astype(np.int64)
+    stid = np.where(idx >= 0, stids[np.maximum(idx, 0)], None)
+    return pd.DataFrame({'pt': pt,
+                         'stid': stid,
+                         'dist': dist,
+                         'rank': rank})
+
             
-def process_stn(datadir, stnid, clean=True):
-    filepath = '{0}/{1}.csv'.format(datadir, stnid)
+def _convert_numeric(df):
+    '''
+    Coerce object columns to numbers, unparseable values becoming NaN.
+    Columns with no numeric values at all (e.g. Station_ID) are left alone.
+    '''
+    for col in df.columns:
+        if pd.api.types.is_string_dtype(df[col]):
+            values = pd.to_numeric(df[col], errors='coerce')
+            if not values.isnull().all():
+                df[col] = values
+    return df
+
+
+def read_stn_csv(filepath):
+    '''
+    Parse a gzipped Synoptic station CSV (multi-line header, units row) into
+    a DataFrame indexed by observation time
+    '''
     skiprows = [0,1,2,3,4,5,7]
     df = pd.read_csv(filepath, skiprows=skiprows, index_col=[1], 
                      parse_dates=[1], compression='gzip')
     if 'heat_index_set_1d' in df.columns:
         df = df.drop('heat_index_set_1d', axis=1)
-    df = df.convert_objects(convert_numeric=True)
+    return _convert_numeric(df)
+
+
+class StationStore(object):
+    '''
+    Columnar cache of parsed station CSVs
+
+    Each station's CSV is parsed once into a ColumnTable under storedir
+    (default <datadir>/store). The table records the size and mtime of the
+    CSV it was built from and is rebuilt whenever those change, so repeat
+    loads skip the gzip/CSV parsing entirely and only read the requested
+    columns and time range from memory-mapped column files.
+    
+    store = StationStore('wx_data/')
+    df = process_stn('wx_data/', 'BTAVAL01', store=store,
+                     columns=['air_temp_set_1'], start='2016-11-01')
+    '''
+    def __init__(self, datadir, storedir=None):
+        self.datadir = datadir
+        self.storedir = storedir or datadir + '/store'
+
+    def _source(self, stnid):
+        filepath = '{0}/{1}.csv'.format(self.datadir, stnid)
+        st = os.stat(filepath)
+        return filepath, {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+    def table(self, stnid):
+        '''
+        The up-to-date ColumnTable for a station, (re)building it if needed
+        '''
+        filepath, source = self._source(stnid)
+        tbl = ColumnTable(self.storedir + '/' + stnid)
+        if tbl.exists() and tbl.attrs.get('source') == source:
+            return tbl
+        tbl.clear()
+        with metrics.timer('stage_seconds', stage='store_build'):
+            tbl.append(read_stn_csv(filepath), attrs={'source': source})
+        return tbl
+
+    def load(self, stnid, columns=None, start=None, end=None):
+        return self.table(stnid).read(columns=columns, start=start, end=end)
+
+            
+def process_stn(datadir, stnid, clean=True, store=None, columns=None,
+                start=None, end=None):
+    '''
+    Load a station's observations as a DataFrame indexed by time.
+    
+    Parameters:
+    -----------
+    datadir (str) path to directory where station data is stored
+    stnid (str) station id
+    store (StationStore) optional columnar cache; without one the CSV is
+                         parsed on every call
+    columns (list) only return these columns
+    start, end (str or datetime) only return observations in [start, end]
+    '''
+    with metrics.timer('stage_seconds', stage='process_stn'):
+        df = _process_stn(datadir, stnid, store, columns, start, end)
+    metrics.inc('records', len(df), stage='process_stn')
     return df
 
+
+def _process_stn(datadir, stnid, store, columns, start, end):
+    if store is not None:
+        return store.load(stnid, columns=columns, start=start, end=end)
+    filepath = '{0}/{1}.csv'.format(datadir, stnid)
+    df = read_stn_csv(filepath)
+    if columns is not None:
+        df = df[columns]
+    if start is not None or end is not None:
+        df = df.loc[start:end]
+    return df
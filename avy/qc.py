@@ -0,0 +1,437 @@
+"""
+@author: ABerner
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from colstore import ColumnTable
+
+# one bit per check in the uint8 flag arrays
+flag_bits = {'range': 1,
+             'spike': 2,
+             'stuck': 4,
+             'rate': 8,
+             'gap': 16,
+             'interp': 32}
+
+# observations failing these are dropped (set to NaN) by apply_flags; gap
+# only marks the first observation after a dropout
+bad_flags = flag_bits['range'] | flag_bits['spike'] | flag_bits['stuck'] | \
+    flag_bits['rate']
+
+# limits per Synoptic variable (column name minus the _set_N[d] suffix), in
+# the API's default metric units. range: plausible [min, max]; spike: max
+# departure from the rolling median; rate: max change per hour; stuck: how
+# long a value may repeat exactly, except for the values in stuck_ok
+qc_limits = {'air_temp': {'range': (-50., 45.), 'spike': 10., 'rate': 10.,
+                          'stuck': '6h'},
+             'dew_point_temperature': {'range': (-60., 35.), 'spike': 10.,
+                                       'rate': 10., 'stuck': '6h'},
+             'relative_humidity': {'range': (0., 105.), 'rate': 50.,
+                                   'stuck': '12h', 'stuck_ok': (100.,)},
+             'wind_speed': {'range': (0., 75.), 'spike': 25., 'stuck': '12h',
+                            'stuck_ok': (0.,)},
+             'wind_gust': {'range': (0., 100.), 'stuck': '12h',
+                           'stuck_ok': (0.,)},
+             'wind_direction': {'range': (0., 360.), 'stuck': '24h'},
+             'snow_depth': {'range': (0., 10000.), 'spike': 250.,
+                            'rate': 250., 'stuck': '14D', 'stuck_ok': (0.,)},
+             'snow_interval': {'range': (0., 1000.)},
+             'precip_accum': {'range': (0., 1e5)},
+             'precip_accum_one_hour': {'range': (0., 150.)},
+             'solar_radiation': {'range': (0., 1500.), 'stuck': '12h',
+                                 'stuck_ok': (0.,)},
+             'pressure': {'range': (50000., 110000.), 'rate': 1000.,
+                          'stuck': '24h'},
+             'sea_level_pressure': {'range': (85000., 110000.),
+                                    'rate': 1000., 'stuck': '24h'}}
+
+
+def limits_for(column, limits=qc_limits):
+    '''
+    QC limits for a station column, e.g. air_temp_set_1 -> limits['air_temp']
+    '''
+    if '_set_' in column:
+        column = column[:column.rindex('_set_')]
+    return limits.get(column, {})
+
+
+def _ns(index):
+    index = pd.DatetimeIndex(index)
+    if hasattr(index, 'as_unit'):
+        index = index.as_unit('ns')
+    return index.asi8
+
+
+def _td(value):
+    return pd.Timedelta(value).value
+
+
+def _runs(change):
+    '''
+    Start positions and lengths of runs given a boolean "new run" array
+    '''
+    starts = np.flatnonzero(change)
+    lengths = np.diff(np.append(starts, len(change)))
+    return starts, lengths
+
+
+def qc_values(t, x, lim, spike_window='3h', max_gap='3h', max_interp='1h'):
+    '''
+    Run every check on one column
+
+    Checks are applied in order range -> spike -> stuck -> rate, each on the
+    observations that passed the previous ones, so a bad value does not
+    disturb the rolling median or the step changes around it. NaNs are
+    ignored by the checks.
+
+    Parameters:
+    -----------
+    t (array) observation times [units: int64 ns, ascending]
+    x (array) values, NaN for missing
+    lim (dict) limits for this variable (see qc_limits)
+    spike_window (str) width of the centered rolling median
+    max_gap (str) flag the first observation after a dropout longer than
+                  this; the rate check skips it and stuck runs end at it
+    max_interp (str) linearly fill missing and rejected values whose valid
+                     neighbours are at most this far apart
+
+    Returns:
+    --------
+    flags (array) uint8 flag bits per observation (see flag_bits)
+    clean (array) x with rejected values set to NaN and short gaps filled
+    '''
+    x = np.asarray(x, dtype=float)
+    flags = np.zeros(len(x), dtype=np.uint8)
+    iv = np.flatnonzero(~np.isnan(x))
+    tv, xv = t[iv], x[iv]
+
+    if len(iv) > 1:
+        gap = np.diff(tv) > _td(max_gap)
+        flags[iv[1:][gap]] |= flag_bits['gap']
+
+    if 'range' in lim:
+        lo, hi = lim['range']
+        bad = (xv < lo) | (xv > hi)
+        flags[iv[bad]] |= flag_bits['range']
+        iv, tv, xv = iv[~bad], tv[~bad], xv[~bad]
+
+    if 'spike' in lim and len(iv) > 2:
+        med = pd.Series(xv, index=pd.DatetimeIndex(tv.view('datetime64[ns]')))
+        med = med.rolling(spike_window, center=True, min_periods=3).median()
+        bad = np.abs(xv - med.values) > lim['spike']
+        flags[iv[bad]] |= flag_bits['spike']
+        iv, tv, xv = iv[~bad], tv[~bad], xv[~bad]
+
+    if 'stuck' in lim and len(iv) > 1:
+        starts, lengths = _runs(np.r_[True, (xv[1:] != xv[:-1]) |
+                                      (np.diff(tv) > _td(max_gap))])
+        ends = starts + lengths - 1
+        stuck = ((tv[ends] - tv[starts] >= _td(lim['stuck'])) &
+                 ~np.isin(xv[starts], lim.get('stuck_ok', ())))
+        bad = np.repeat(stuck, lengths)
+        flags[iv[bad]] |= flag_bits['stuck']
+        iv, tv, xv = iv[~bad], tv[~bad], xv[~bad]
+
+    if 'rate' in lim and len(iv) > 1:
+        dt = np.diff(tv)
+        hours = dt / 3.6e12
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.abs(np.diff(xv)) / hours
+        bad = (dt > 0) & (dt <= _td(max_gap)) & (rate > lim['rate'])
+        flags[iv[1:][bad]] |= flag_bits['rate']
+
+    clean = np.where(flags & bad_flags, np.nan, x)
+    return flags, _interpolate(t, clean, flags, max_interp)
+
+
+def _interpolate(t, clean, flags, max_interp):
+    good = np.flatnonzero(~np.isnan(clean))
+    miss = np.flatnonzero(np.isnan(clean))
+    if len(good) < 2 or len(miss) == 0:
+        return clean
+    k = np.searchsorted(good, miss)
+    inside = (k > 0) & (k < len(good))
+    miss, k = miss[inside], k[inside]
+    prev, nxt = good[k - 1], good[k]
+    span = t[nxt] - t[prev]
+    ok = span <= _td(max_interp)
+    miss, prev, nxt, span = miss[ok], prev[ok], nxt[ok], span[ok]
+    w = (t[miss] - t[prev]) / span
+    clean[miss] = clean[prev] + w * (clean[nxt] - clean[prev])
+    flags[miss] |= flag_bits['interp']
+    return clean
+
+
+def qc_frame(df, limits=qc_limits, spike_window='3h', max_gap='3h',
+             max_interp='1h'):
+    '''
+    QC every numeric column of a station frame (as returned by
+    processwx.process_stn)
+
+    Returns:
+    --------
+    clean (DataFrame) df with rejected values NaN'd and short gaps filled
+    flags (DataFrame) uint8 flag bits for the numeric columns, same index
+    '''
+    t = _ns(df.index)
+    clean = df.copy()
+    flags = {}
+    for col in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            continue
+        f, values = qc_values(t, df[col].values, limits_for(col, limits),
+                              spike_window, max_gap, max_interp)
+        flags[col] = f
+        clean[col] = values
+    return clean, pd.DataFrame(flags, index=df.index)
+
+
+def flag_masks(flags):
+    '''
+    Split a flag frame into one boolean frame per check
+    '''
+    return {name: (flags & bit).astype(bool)
+            for name, bit in flag_bits.items()}
+
+
+def apply_flags(df, flags, max_interp='1h'):
+    '''
+    Recreate qc_frame's cleaned output from raw data and cached flags
+    '''
+    t = _ns(df.index)
+    clean = df.copy()
+    for col in flags.columns:
+        f = flags[col].values.astype(np.uint8)
+        values = np.where(f & bad_flags, np.nan,
+                          df[col].values.astype(float))
+        filled = _interpolate(t, values.copy(), f.copy(), max_interp)
+        interp = (f & flag_bits['interp']).astype(bool)
+        clean[col] = np.where(interp, filled, values)
+    return clean
+
+
+def summarize_gaps(df, max_gap='3h'):
+    '''
+    Table of dropouts longer than max_gap per column, with the last valid
+    observation before (start) and first after (end) each one
+    '''
+    t = df.index
+    rows = []
+    for col in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            continue
+        iv = np.flatnonzero(df[col].notnull().values)
+        if len(iv) < 2:
+            continue
+        dt = np.diff(_ns(t[iv]))
+        gap = np.flatnonzero(dt > _td(max_gap))
+        rows.append(pd.DataFrame({'column': col,
+                                  'start': t[iv[gap]],
+                                  'end': t[iv[gap + 1]]}))
+    if not rows:
+        return pd.DataFrame(columns=['column', 'start', 'end', 'duration'])
+    gaps = pd.concat(rows, ignore_index=True)
+    gaps['duration'] = gaps['end'] - gaps['start']
+    return gaps
+
+
+class QCStream(object):
+    '''
+    Chunked QC with the same result as qc_frame on the whole history
+
+    Each pushed chunk is checked together with a margin of the data around
+    it, so rolling medians, stuck runs, step changes and interpolation see
+    the same neighbours they would in one pass. Rows are therefore emitted
+    with a lag of `overlap`; flush() emits the rest at the end. The time of
+    each column's last valid observation is carried across chunks, so the
+    gap flag after a dropout longer than the margin is still set.
+
+    stream = QCStream()
+    for chunk in tbl.iter_chunks(100000):
+        clean, flags = stream.push(chunk)
+    clean, flags = stream.flush()
+    '''
+    def __init__(self, limits=qc_limits, spike_window='3h', max_gap='3h',
+                 max_interp='1h'):
+        self.limits = limits
+        self.kwargs = {'spike_window': spike_window,
+                       'max_gap': max_gap,
+                       'max_interp': max_interp}
+        stuck = [pd.Timedelta(lim['stuck']) for lim in limits.values()
+                 if 'stuck' in lim]
+        checks = max([pd.Timedelta(spike_window)] + stuck)
+        self.overlap = (checks + max(pd.Timedelta(max_gap),
+                                     pd.Timedelta(max_interp))).value
+        self.buf = None
+        self.n_done = 0
+        # column -> time of its last valid observation dropped from buf
+        self.last_valid = {}
+
+    def push(self, chunk, final=False):
+        buf = chunk if self.buf is None else pd.concat([self.buf, chunk])
+        if buf.empty:
+            self.buf = buf
+            return qc_frame(buf, self.limits, **self.kwargs)
+        clean, flags = qc_frame(buf, self.limits, **self.kwargs)
+        t = _ns(buf.index)
+        self._flag_gaps(buf, flags, t)
+        end = len(buf) if final else \
+            int(np.searchsorted(t, t[-1] - self.overlap, 'right'))
+        end = max(end, self.n_done)
+        out = clean.iloc[self.n_done:end], flags.iloc[self.n_done:end]
+        if end > 0:
+            keep = min(int(np.searchsorted(t, t[end - 1] - self.overlap,
+                                           'left')), end - 1)
+        else:
+            keep = 0
+        for col in flags.columns:
+            iv = np.flatnonzero(buf[col].notnull().values[:keep])
+            if len(iv):
+                self.last_valid[col] = t[iv[-1]]
+        self.buf = buf.iloc[keep:]
+        self.n_done = end - keep
+        return out
+
+    def _flag_gaps(self, buf, flags, t):
+        '''
+        Gap flag on the first valid observation of each column in buf, when
+        its previous one has already been dropped from the buffer
+        '''
+        max_gap = _td(self.kwargs['max_gap'])
+        for col, last in self.last_valid.items():
+            if col not in flags.columns:
+                continue
+            iv = np.flatnonzero(buf[col].notnull().values)
+            if len(iv) and t[iv[0]] - last > max_gap:
+                f = flags[col].values.copy()
+                f[iv[0]] |= flag_bits['gap']
+                flags[col] = f
+
+    def flush(self):
+        if self.buf is None:
+            return None, None
+        return self.push(self.buf.iloc[:0], final=True)
+
+
+def config_fingerprint(limits=qc_limits, **kwargs):
+    # version 2: stuck runs end at dropouts longer than max_gap
+    params = dict(kwargs, limits=limits, version=2)
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str)
+                        .encode('utf-8')).hexdigest()
+
+
+class QCStore(object):
+    '''
+    Cached QC flags next to a StationStore
+
+    Flags for each station are computed once, in a stream over its
+    ColumnTable, and stored as a ColumnTable of uint8 flag columns under
+    <storedir>/qc/<stid>. They are recomputed when the station data or the
+    QC configuration changes. load() returns cleaned data by re-applying the
+    flags, which is much cheaper than re-running the checks.
+
+    qc = QCStore(StationStore('wx_data/'))
+    df = qc.load('BTAVAL01', columns=['air_temp_set_1'], start='2016-11-01')
+    masks = flag_masks(qc.flags('BTAVAL01'))
+    '''
+    def __init__(self, store, qcdir=None, limits=qc_limits, spike_window='3h',
+                 max_gap='3h', max_interp='1h', chunk_size=200000):
+        self.store = store
+        self.qcdir = qcdir or os.path.join(store.storedir, 'qc')
+        self.limits = limits
+        self.kwargs = {'spike_window': spike_window,
+                       'max_gap': max_gap,
+                       'max_interp': max_interp}
+        self.chunk_size = chunk_size
+        self.config = config_fingerprint(limits, **self.kwargs)
+
+    def table(self, stnid):
+        '''
+        The up-to-date flag table for a station, (re)computing it if needed
+        '''
+        src = self.store.table(stnid)
+        tbl = ColumnTable(self.qcdir + '/' + stnid)
+        if (tbl.exists() and tbl.attrs.get('source') == src.attrs['source']
+                and tbl.attrs.get('config') == self.config):
+            return tbl
+        tbl.clear()
+        attrs = {'source': src.attrs['source'], 'config': self.config}
+        stream = QCStream(self.limits, **self.kwargs)
+        for chunk in src.iter_chunks(self.chunk_size):
+            tbl.append(stream.push(chunk)[1], attrs=attrs)
+        tbl.append(stream.flush()[1], attrs=attrs)
+        return tbl
+
+    def flags(self, stnid, columns=None, start=None, end=None):
+        return self.table(stnid).read(columns=columns, start=start, end=end)
+
+    def load(self, stnid, columns=None, start=None, end=None):
+        '''
+        Cleaned observations of a station, like process_stn
+        '''
+        tbl = self.table(stnid)
+        # pad the window so values interpolated near its edges see the
+        # same neighbours as in the full history
+        pad = pd.Timedelta(self.kwargs['max_interp'])
+        lo = _pad_bound(start, -pad, 'start_time')
+        hi = _pad_bound(end, pad, 'end_time')
+        raw = self.store.load(stnid, columns=columns, start=lo, end=hi)
+        fcols = [c for c in raw.columns if c in tbl.columns]
+        flags = tbl.read(columns=fcols, start=lo, end=hi)
+        clean = apply_flags(raw, flags, self.kwargs['max_interp'])
+        return clean.loc[start:end]
+
+
+def _pad_bound(value, pad, edge):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            return getattr(pd.Period(value), edge) + pad
+        except ValueError:
+            pass
+    return pd.Timestamp(value) + pad
+
+
+def _qc_station(stnid, store, kwargs):
+    try:
+        flags = QCStore(store, **kwargs).flags(stnid)
+    except Exception as e:
+        # a truncated or malformed station file must not stop the others
+        metrics.inc('failures', stage='qc', station=stnid)
+        return stnid, {'error': '{0}: {1}'.format(type(e).__name__, e)}
+    counts = {name: int(mask.values.sum())
+              for name, mask in flag_masks(flags).items()}
+    counts['n_obs'] = int(flags.notnull().values.sum())
+    return stnid, counts
+
+
+def qc_stations(store, stids, n_jobs=1, **kwargs):
+    '''
+    Compute (or refresh) cached flags for many stations, in parallel with
+    n_jobs processes. kwargs are passed to QCStore. A station whose data
+    can't be read or checked is skipped, with the error in the summary.
+
+    Returns:
+    --------
+    summary (DataFrame) number of observations and flags per check, by
+                        station, and an error column for the failed ones
+    '''
+    if n_jobs == 1:
+        results = [_qc_station(stnid, store, kwargs) for stnid in stids]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_qc_station, stids,
+                                    [store] * len(stids),
+                                    [kwargs] * len(stids)))
+    summary = pd.DataFrame.from_dict(dict(results), orient='index')
+    counts = [c for c in summary.columns if c != 'error']
+    summary[counts] = summary[counts].astype('Int64')
+    return summary
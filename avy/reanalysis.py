@@ -0,0 +1,438 @@
+"""
+@author: ABerner
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+
+import metrics
+from colstore import ColumnTable
+from geo import haversine
+
+try:
+    import xarray as xr
+except ImportError:
+    xr = None
+
+_time_names = ('time', 'valid_time', 'Time')
+_lat_names = ('lat', 'latitude', 'y')
+_lon_names = ('lon', 'longitude', 'x')
+
+
+class MemmapGrid(object):
+    '''
+    Gridded (reanalysis) data stored as one memory-mapped float32 file per
+    variable, shaped time x lat x lon (NaN where missing)
+
+    A grid directory holds coords.json (start, freq and number of times,
+    the 1d lat and lon axes and the variable names) and <variable>.f32.
+    Time is the leading axis, so a time range of a lat/lon box is a set of
+    contiguous runs in the file and nothing else is read.
+
+    grid = MemmapGrid('reanalysis/narr')
+    block = grid.block('air_temp', slice(0, 744), slice(10, 14),
+                       slice(20, 24))
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'coords.json'), 'r') as fin:
+            self.coords = json.load(fin)
+        self.lat = np.asarray(self.coords['lat'], dtype=float)
+        self.lon = np.asarray(self.coords['lon'], dtype=float)
+        self.variables = list(self.coords['variables'])
+        self.times = pd.date_range(pd.Timestamp(self.coords['start']),
+                                   periods=self.coords['ntimes'],
+                                   freq=self.coords['freq'])
+        self._maps = {}
+
+    def _map(self, var):
+        if var not in self._maps:
+            shape = (self.coords['ntimes'], len(self.lat), len(self.lon))
+            self._maps[var] = np.memmap(
+                os.path.join(self.path, var + '.f32'), dtype=np.float32,
+                mode='r', shape=shape)
+        return self._maps[var]
+
+    def block(self, var, t, ys, xs):
+        '''
+        (time, lat, lon) array of var over slices of the three axes
+        '''
+        if not len(self.times):
+            return np.zeros((0, len(self.lat), len(self.lon)),
+                            np.float32)[:, ys, xs]
+        return np.asarray(self._map(var)[t, ys, xs])
+
+
+class XarrayGrid(object):
+    '''
+    Gridded data in any format xarray can open lazily (NetCDF, Zarr, ...)
+
+    The dataset is opened with dask chunks (or, for Zarr, the store's own
+    chunking), so block() only decodes the chunks overlapping the requested
+    time range and lat/lon box. Requires xarray and the engine for the
+    format (netCDF4/h5netcdf, zarr).
+
+    Parameters:
+    -----------
+    source (str or xarray.Dataset) file/store path or an open dataset
+    '''
+    def __init__(self, source):
+        if xr is None:
+            raise ImportError("xarray is required to read NetCDF/Zarr grids")
+        if isinstance(source, str):
+            if source.rstrip('/').endswith('.zarr'):
+                source = xr.open_zarr(source)
+            else:
+                source = xr.open_dataset(source, chunks={})
+        self.ds = source
+        self.tdim = _dim_name(source, _time_names)
+        self.ydim = _dim_name(source, _lat_names)
+        self.xdim = _dim_name(source, _lon_names)
+        self.lat = np.asarray(source[self.ydim].values, dtype=float)
+        self.lon = np.asarray(source[self.xdim].values, dtype=float)
+        self.variables = [v for v, da in source.data_vars.items()
+                          if set((self.tdim, self.ydim, self.xdim))
+                          <= set(da.dims)]
+        times = pd.DatetimeIndex(source[self.tdim].values)
+        self.times = times.tz_localize('UTC') if times.tz is None else \
+            times.tz_convert('UTC')
+
+    def block(self, var, t, ys, xs):
+        da = self.ds[var].isel({self.tdim: t, self.ydim: ys, self.xdim: xs})
+        extra = [d for d in da.dims
+                 if d not in (self.tdim, self.ydim, self.xdim)]
+        if extra:
+            # e.g. a length-1 level dimension
+            da = da.isel({d: 0 for d in extra})
+        return np.asarray(da.transpose(self.tdim, self.ydim,
+                                       self.xdim).values, dtype=np.float32)
+
+
+def _dim_name(ds, names):
+    for name in names:
+        if name in ds.dims or name in ds.coords:
+            return name
+    raise ValueError("none of {0} found in dataset dims {1}".format(
+        names, list(ds.dims)))
+
+
+def open_grid(path):
+    '''
+    A MemmapGrid for directories written by write_grid, else an XarrayGrid
+    '''
+    if os.path.isfile(os.path.join(path, 'coords.json')):
+        return MemmapGrid(path)
+    return XarrayGrid(path)
+
+
+def write_grid(path, grid, variables=None, chunk=744):
+    '''
+    Convert a grid (e.g. an XarrayGrid over a NetCDF archive) into the
+    MemmapGrid layout, chunk time steps at a time
+
+    The time axis must be regularly spaced.
+
+    Returns:
+    --------
+    grid (MemmapGrid)
+    '''
+    variables = list(grid.variables if variables is None else variables)
+    times = grid.times
+    freq = None
+    if len(times) > 1:
+        steps = np.diff(_times_ns(times))
+        if not np.all(steps == steps[0]):
+            raise ValueError("grid times are not regularly spaced")
+        freq = to_offset(pd.Timedelta(int(steps[0]), 'ns')).freqstr
+    os.makedirs(path, exist_ok=True)
+    ys, xs = slice(None), slice(None)
+    for var in variables:
+        tmp = os.path.join(path, var + '.f32.tmp')
+        with open(tmp, 'wb') as fout:
+            for lo in range(0, len(times), chunk):
+                t = slice(lo, min(lo + chunk, len(times)))
+                fout.write(grid.block(var, t, ys, xs)
+                           .astype('<f4').tobytes())
+        os.replace(tmp, os.path.join(path, var + '.f32'))
+    coords = {'start': times[0].isoformat() if len(times) else
+              '1970-01-01T00:00:00+00:00',
+              'freq': freq or '1h',
+              'ntimes': len(times),
+              'lat': [float(v) for v in grid.lat],
+              'lon': [float(v) for v in grid.lon],
+              'variables': variables}
+    tmp = os.path.join(path, 'coords.json.tmp')
+    with open(tmp, 'w') as fout:
+        json.dump(coords, fout)
+    os.replace(tmp, os.path.join(path, 'coords.json'))
+    return MemmapGrid(path)
+
+
+def _axis_position(axis, x):
+    '''
+    Fractional index of each x along a monotonic coordinate axis, and
+    whether it lies inside the axis
+    '''
+    n = len(axis)
+    if axis[-1] < axis[0]:
+        pos = (n - 1) - np.interp(x, axis[::-1], np.arange(n))
+        inside = (x <= axis[0]) & (x >= axis[-1])
+    else:
+        pos = np.interp(x, axis, np.arange(n))
+        inside = (x >= axis[0]) & (x <= axis[-1])
+    return pos, inside
+
+
+def grid_weights(lat, lon, stn_lat, stn_lon, method='bilinear', power=2):
+    '''
+    Interpolation weights from a regular lat/lon grid to points
+
+    Each point is interpolated from the four grid cells around it, by
+    bilinear weights in grid index space or by inverse distance (great
+    circle) to the cell centres. Points outside the grid get NaN weights.
+
+    Parameters:
+    -----------
+    lat, lon (array) 1d grid axes [units: degrees; lon in -180..180 or
+                     0..360]
+    stn_lat, stn_lon (array) point coordinates [units: degrees]
+    method (str) 'bilinear' or 'idw'
+    power (float) inverse distance power
+
+    Returns:
+    --------
+    iy, ix (ndarray) (points, 4) grid indices of the surrounding cells
+    w (ndarray) (points, 4) weights, summing to one for each point
+    '''
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    stn_lat = np.atleast_1d(np.asarray(stn_lat, dtype=float))
+    stn_lon = np.atleast_1d(np.asarray(stn_lon, dtype=float))
+    if lon.max() > 180:
+        stn_lon = np.mod(stn_lon, 360.)
+    py, in_y = _axis_position(lat, stn_lat)
+    px, in_x = _axis_position(lon, stn_lon)
+    y0 = np.clip(np.floor(py).astype(np.int64), 0, max(len(lat) - 2, 0))
+    x0 = np.clip(np.floor(px).astype(np.int64), 0, max(len(lon) - 2, 0))
+    y1 = np.minimum(y0 + 1, len(lat) - 1)
+    x1 = np.minimum(x0 + 1, len(lon) - 1)
+    iy = np.stack([y0, y0, y1, y1], axis=1)
+    ix = np.stack([x0, x1, x0, x1], axis=1)
+    if method == 'bilinear':
+        fy = (py - y0)[:, None]
+        fx = (px - x0)[:, None]
+        w = np.concatenate([(1 - fy) * (1 - fx), (1 - fy) * fx,
+                            fy * (1 - fx), fy * fx], axis=1)
+    elif method == 'idw':
+        d = haversine(stn_lat[:, None], stn_lon[:, None], lat[iy], lon[ix])
+        with np.errstate(divide='ignore'):
+            w = 1.0 / d ** power
+        exact = ~np.isfinite(w)
+        w[exact.any(axis=1)] = 0.
+        w[exact] = 1.
+    else:
+        raise ValueError("unknown interpolation method: {0}".format(method))
+    w = w / w.sum(axis=1, keepdims=True)
+    w[~(in_y & in_x)] = np.nan
+    return iy, ix, w
+
+
+class PointExtractor(object):
+    '''
+    Interpolated series of gridded variables at station locations
+
+    The grid cells needed by all the stations are grouped into tiles of
+    tile x tile cells, and for each time chunk only the bounding box of the
+    needed cells within each tile is read, so a continental grid is never
+    loaded to get a few dozen stations. The interpolation is one weighted
+    sum over a (time, station, 4) gather for all stations at once; missing
+    cells are left out and the remaining weights renormalized. Stations
+    outside the grid get all-NaN series; `outside` marks them, in the order
+    of `stations`.
+
+    md_df = processwx.select_stn('wx_data/', args, return_df=True)
+    ex = PointExtractor(open_grid('reanalysis/narr'), md_df,
+                        rename={'air': 'air_temp_set_1'})
+    frames = ex.frames('1990-01-01', '1990-12-31')  # stid -> DataFrame
+
+    Parameters:
+    -----------
+    grid (MemmapGrid or XarrayGrid) see open_grid
+    md_df (DataFrame) station metadata with stid (or a stid index), latitude
+                      and longitude columns
+    variables (list) grid variables to extract, default all
+    method (str) 'bilinear' or 'idw' (see grid_weights)
+    rename (dict) grid variable -> output column name, e.g. the Synoptic
+                  names used by process_stn
+    tile (int) tile size [units: grid cells]
+    '''
+    def __init__(self, grid, md_df, variables=None, method='bilinear',
+                 rename=None, tile=16, power=2):
+        self.grid = grid
+        md = md_df.copy()
+        md.columns = [c.lower() for c in md.columns]
+        if 'stid' not in md.columns:
+            md = md.reset_index()
+            md.columns = [c.lower() for c in md.columns]
+        self.stations = [str(s) for s in md['stid'].values]
+        self.variables = list(grid.variables if variables is None
+                              else variables)
+        rename = rename or {}
+        self.columns = [rename.get(v, v) for v in self.variables]
+        iy, ix, self.weights = grid_weights(
+            grid.lat, grid.lon, md['latitude'].values.astype(float),
+            md['longitude'].values.astype(float), method, power)
+        self.outside = np.isnan(self.weights).any(axis=1)
+        if self.outside.any():
+            metrics.inc('outside_grid', int(self.outside.sum()),
+                        stage='point_extract')
+            metrics.event('outside_grid', stations=[
+                s for s, o in zip(self.stations, self.outside) if o])
+        # distinct cells, and each station's four corners as cell positions
+        flat = iy * len(grid.lon) + ix
+        cells, self._corners = np.unique(flat, return_inverse=True)
+        self._corners = self._corners.reshape(flat.shape)
+        cy, cx = np.divmod(cells, len(grid.lon))
+        self._tiles = []
+        keys = (cy // tile) * (len(grid.lon) // tile + 1) + cx // tile
+        for key in np.unique(keys):
+            pos = np.flatnonzero(keys == key)
+            y0, y1 = cy[pos].min(), cy[pos].max() + 1
+            x0, x1 = cx[pos].min(), cx[pos].max() + 1
+            self._tiles.append((pos, slice(y0, y1), slice(x0, x1),
+                                cy[pos] - y0, cx[pos] - x0))
+        self.n_cells = len(cells)
+
+    def _cells(self, var, t):
+        '''
+        (time, cell) values of var at the distinct needed cells
+        '''
+        n = t.stop - t.start
+        out = np.empty((n, self.n_cells), dtype=np.float32)
+        for pos, ys, xs, ry, rx in self._tiles:
+            block = self.grid.block(var, t, ys, xs)
+            out[:, pos] = block[:, ry, rx]
+        return out
+
+    def _interpolate(self, cells):
+        vals = cells[:, self._corners]
+        w = np.broadcast_to(self.weights, vals.shape)
+        ok = np.isfinite(vals) & np.isfinite(w)
+        num = np.where(ok, vals * w, 0.).sum(axis=2)
+        den = np.where(ok, w, 0.).sum(axis=2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (num / den).astype(np.float32)
+
+    def _time_range(self, start, end):
+        times = _times_ns(self.grid.times)
+        lo = 0 if start is None else int(np.searchsorted(
+            times, _utc(pd.Timestamp(start)).value, 'left'))
+        hi = len(times) if end is None else int(np.searchsorted(
+            times, _utc(pd.Timestamp(end)).value, 'right'))
+        return lo, max(lo, hi)
+
+    def iter_chunks(self, start=None, end=None, chunk=744):
+        '''
+        Yield (times, values) for chunk time steps at a time, values being a
+        float32 (time, station, variable) array
+        '''
+        lo, hi = self._time_range(start, end)
+        for a in range(lo, hi, chunk):
+            t = slice(a, min(a + chunk, hi))
+            with metrics.timer('stage_seconds', stage='extract_grid'):
+                values = np.stack([self._interpolate(self._cells(var, t))
+                                   for var in self.variables], axis=2)
+            metrics.inc('records', values.shape[0] * values.shape[1],
+                        stage='extract_grid')
+            yield self.grid.times[t], values
+
+    def _frame(self, times, values, s):
+        df = pd.DataFrame(values[:, s, :], index=times, columns=self.columns)
+        df.index.name = 'Date_Time'
+        return df
+
+    def frames(self, start=None, end=None, chunk=744):
+        '''
+        Every station's series in [start, end] as a DataFrame indexed by UTC
+        time, as process_stn returns for observations
+
+        Returns:
+        --------
+        frames (dict) stid -> DataFrame
+        '''
+        parts = list(self.iter_chunks(start, end, chunk))
+        if parts:
+            times = parts[0][0].append([p[0] for p in parts[1:]])
+            values = np.concatenate([p[1] for p in parts], axis=0)
+        else:
+            times = self.grid.times[:0]
+            values = np.zeros((0, len(self.stations), len(self.variables)),
+                              np.float32)
+        return {stid: self._frame(times, values, s)
+                for s, stid in enumerate(self.stations)}
+
+    def write_store(self, storedir, start=None, end=None, chunk=744):
+        '''
+        Append every station's series to ColumnTables under storedir, one
+        time chunk at a time, so memory stays O(chunk x stations) over any
+        length of record. Each table resumes after its last stored time.
+
+        Returns:
+        --------
+        store (GridStore)
+        '''
+        store = GridStore(storedir)
+        last = [store.last_time(stid) for stid in self.stations]
+        if start is None and last and all(t is not None for t in last):
+            start = min(last) + pd.Timedelta(1, 'ns')
+        for times, values in self.iter_chunks(start, end, chunk):
+            for s, stid in enumerate(self.stations):
+                keep = slice(None) if last[s] is None else \
+                    times > last[s]
+                df = self._frame(times, values, s)[keep]
+                if not df.empty:
+                    store.table(stid).append(df)
+        return store
+
+
+def _utc(ts):
+    return ts.tz_localize('UTC') if ts.tzinfo is None else \
+        ts.tz_convert('UTC')
+
+
+def _times_ns(times):
+    '''
+    UTC times as int64 ns since epoch, whatever the index's unit
+    '''
+    return times.tz_convert('UTC').tz_localize(None).values \
+        .astype('datetime64[ns]').view(np.int64)
+
+
+class GridStore(object):
+    '''
+    Station-point series extracted from a grid (see
+    PointExtractor.write_store), with the same table/load interface as
+    processwx.StationStore, so it can be passed as the store of
+    process_stn, panel.build_panel, ...
+
+    store = GridStore('reanalysis/points')
+    df = process_stn(None, 'BTAVAL01', store=store, start='1990-01-01')
+    '''
+    def __init__(self, storedir):
+        self.storedir = storedir
+
+    def table(self, stnid):
+        return ColumnTable(self.storedir + '/' + stnid)
+
+    def last_time(self, stnid):
+        tbl = self.table(stnid)
+        if not len(tbl):
+            return None
+        idx = tbl.column(tbl.meta['index'])
+        return pd.Timestamp(int(idx[-1]), tz='UTC')
+
+    def load(self, stnid, columns=None, start=None, end=None):
+        return self.table(stnid).read(columns=columns, start=start, end=end)
@@ -0,0 +1,29 @@
+"""
+Column types of the BTAC event and observation tables, shared by the fetch
+and process code (so processing doesn't import the HTTP stack)
+
+@author: ABerner
+"""
+
+event_types = {'ID': float,
+               'affiliation': str,
+               'aspect': str,
+               'avy_trigger': str,
+               'depth': float,
+               'destructive_size': float,
+               'elevation': float,
+               'event_date': str,
+               'event_time': str,
+               'event_year': float,
+               'fatality': float,
+               'fldType': str,
+               'lat': float,
+               'lng': float,
+               'notes': str,
+               'observer': str,
+               'pathname': str,
+               'relative_size': float,
+               'slope_angle': str,
+               'zone': str}
+
+obs_types = {'obs_date': 'datetime'}
@@ -0,0 +1,269 @@
+"""
+@author: ABerner
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from common import batched, bounded_map
+from dataset import elev_labels
+from panel import Panel, _as_slice
+
+
+def season_of(dates, start_month=9):
+    '''
+    Winter season of each date, named by the year it starts in (the
+    2016-17 season is 2016); seasons start on the first of start_month
+    '''
+    dates = pd.DatetimeIndex(dates)
+    return np.where(dates.month >= start_month, dates.year, dates.year - 1)
+
+
+def daily_labels(hzrd_df, region='teton'):
+    '''
+    Hazard ratings of one region as one row per bulletin day
+
+    Returns:
+    --------
+    days (DatetimeIndex) bulletin dates (local midnight)
+    am_times (DatetimeIndex) morning issuance times (local)
+    labels (ndarray) int8 (day, am/pm, band) with bands ordered atl, tl, btl;
+                     days without both ratings are dropped
+    '''
+    hz = hzrd_df[hzrd_df['region'] == region]
+    bands = elev_labels[::-1]
+    hz = hz[bands].sort_index()
+    pm = hz.index.hour >= 12
+    am_df = hz[~pm]
+    pm_df = hz[pm]
+    am_df = am_df[~am_df.index.normalize().duplicated(keep='last')]
+    pm_df = pm_df[~pm_df.index.normalize().duplicated(keep='last')]
+    pm_df.index = pm_df.index.normalize()
+    am_times = am_df.index
+    am_df.index = am_df.index.normalize()
+    joined = am_df.join(pm_df, how='inner', lsuffix='_am', rsuffix='_pm')
+    joined = joined.dropna()
+    am_times = pd.DatetimeIndex(
+        am_times[am_df.index.isin(joined.index)])
+    labels = np.stack([joined[[b + '_am' for b in bands]].values,
+                       joined[[b + '_pm' for b in bands]].values],
+                      axis=1).astype(np.int8)
+    return joined.index, am_times, labels
+
+
+class WindowDataset(object):
+    '''
+    Lazy (lookback window, hazard label) samples for sequence models
+
+    One sample per bulletin day of a region: the input is the `lookback`
+    of panel rows (time x station x variable) that ended before that day's
+    morning issuance, the target the day's am and pm ratings per elevation
+    band. Windows are never materialized for the whole dataset: a
+    sliding_window_view over the memory-mapped panel gives every window as
+    a view, and a batch only gathers the rows it needs, so memory stays
+    O(batch_size * lookback) however long the lookback or the record.
+    Batches of evenly spaced days (e.g. consecutive days, unshuffled) are
+    returned as views with no copy at all.
+
+    panel = Panel('panels/wy')
+    ds = WindowDataset(panel, hzrd_df, region='teton', lookback='30D')
+    train, val = ds.split(val=[2016])
+    for x, mask, y in train.batches(64, balance=True, workers=4):
+        ...  # x: (64, 720, stations, variables), y: (64, 2, 3)
+
+    Parameters:
+    -----------
+    panel (Panel or str) weather panel (see panel.build_panel)
+    hzrd_df (DataFrame) output of processbtac.process_btac_nowcast
+    lookback (str) window length, a multiple of the panel freq
+    stations, variables (list) subset of the panel, default all
+    tz (str) time zone of the hazard issuance times
+    min_coverage (float) drop samples whose window has a smaller observed
+                         fraction than this
+    '''
+    def __init__(self, panel, hzrd_df=None, region='teton', lookback='14D',
+                 stations=None, variables=None, tz='US/Mountain',
+                 min_coverage=0.0, _samples=None):
+        if isinstance(panel, str):
+            panel = Panel(panel)
+        self.panel = panel
+        self.region = region
+        self.lookback = lookback
+        self.tz = tz
+        self.length = int(pd.Timedelta(lookback) / panel.step)
+        if isinstance(stations, str):
+            stations = [stations]
+        if isinstance(variables, str):
+            variables = [variables]
+        self._stations = Panel._axis(panel.stations, stations)
+        self._variables = Panel._axis(panel.variables, variables)
+        self.stations = _labels(panel.stations, self._stations)
+        self.variables = _labels(panel.variables, self._variables)
+        # (n_windows, lookback, station, variable) views over the memmaps
+        self._x = self._windows(panel.values)
+        self._m = self._windows(panel.mask)
+        if _samples is not None:
+            self.days, self.ends, self.labels = _samples
+            return
+        days, am_times, labels = daily_labels(hzrd_df, region)
+        utc = am_times.tz_localize(tz, ambiguous='NaT',
+                                   nonexistent='shift_forward') \
+            .tz_convert('UTC')
+        ok = ~utc.isnull()
+        # one past the last grid cell entirely before the issuance time, so
+        # no observation made after the forecast leaks into its input; not
+        # clipped, so issuances beyond the panel's end are dropped rather
+        # than paired with its last (stale) window
+        ends = np.array([(t - panel.step - panel.start) // panel.step + 1
+                         if good else -1 for t, good in zip(utc, ok)],
+                        dtype=np.int64)
+        ok &= ends >= self.length
+        ok &= ends <= panel.coords['ntimes']
+        days, ends, labels = days[ok], ends[ok], labels[ok]
+        if min_coverage > 0 and len(ends):
+            cov = np.array([self._m[e - self.length].mean() for e in ends])
+            keep = cov >= min_coverage
+            days, ends, labels = days[keep], ends[keep], labels[keep]
+        self.days = days
+        self.ends = ends
+        self.labels = labels
+
+    def _windows(self, arr):
+        if arr.shape[0] < self.length or self.length < 1:
+            return np.zeros((0, self.length) + arr.shape[1:], arr.dtype)
+        view = sliding_window_view(arr, self.length, axis=0)
+        view = np.moveaxis(view, -1, 1)
+        if isinstance(self._stations, slice) or \
+                isinstance(self._variables, slice):
+            # slicing keeps views; index arrays are applied per batch
+            view = view[:, :, _slice_or_all(self._stations),
+                        _slice_or_all(self._variables)]
+        return view
+
+    def __len__(self):
+        return len(self.ends)
+
+    @property
+    def seasons(self):
+        return season_of(self.days)
+
+    def _subset(self, idx):
+        return WindowDataset(self.panel, region=self.region,
+                             lookback=self.lookback,
+                             stations=_names(self.panel.stations,
+                                             self._stations),
+                             variables=_names(self.panel.variables,
+                                              self._variables),
+                             tz=self.tz,
+                             _samples=(self.days[idx], self.ends[idx],
+                                       self.labels[idx]))
+
+    def split(self, val=(), test=()):
+        '''
+        Season-aware split: whole seasons (see season_of) go to validation
+        or test, so autocorrelated days of one winter never straddle the
+        train/test boundary. Returns (train, val) or (train, val, test).
+        '''
+        seasons = self.seasons
+        is_val = np.isin(seasons, list(val))
+        is_test = np.isin(seasons, list(test))
+        out = [self._subset(np.flatnonzero(~is_val & ~is_test)),
+               self._subset(np.flatnonzero(is_val))]
+        if len(test):
+            out.append(self._subset(np.flatnonzero(is_test)))
+        return tuple(out)
+
+    def classes(self, band=None):
+        '''
+        Class of each sample for balancing: the highest rating of the day
+        (am or pm), over all bands or just one ('atl', 'tl' or 'btl')
+        '''
+        y = self.labels
+        if band is not None:
+            y = y[:, :, elev_labels[::-1].index(band)]
+        return y.reshape(len(y), -1).max(axis=1)
+
+    def sample_weights(self, band=None):
+        '''
+        Weights that make every class equally likely to be drawn
+        '''
+        cls = self.classes(band)
+        _, inverse, counts = np.unique(cls, return_inverse=True,
+                                       return_counts=True)
+        w = 1.0 / counts[inverse]
+        return w / w.sum()
+
+    def batch(self, idx):
+        '''
+        Inputs, mask and labels for the samples idx (a list or slice of
+        sample positions); views when the windows are evenly spaced
+
+        Returns:
+        --------
+        x (ndarray) float32 (batch, lookback, station, variable)
+        mask (ndarray) bool, same shape, True where observed
+        y (ndarray) int8 (batch, am/pm, band) with bands atl, tl, btl
+        '''
+        starts = self.ends[idx] - self.length
+        key = _as_slice(np.atleast_1d(starts))
+        x, m = self._x[key], self._m[key]
+        if not isinstance(self._stations, slice):
+            x, m = x[:, :, self._stations], m[:, :, self._stations]
+        if not isinstance(self._variables, slice):
+            x, m = x[..., self._variables], m[..., self._variables]
+        return x, m, self.labels[idx]
+
+    def indices(self, shuffle=False, balance=False, band=None, seed=None):
+        '''
+        Sample order for one epoch: in date order, shuffled, or drawn with
+        replacement so that every class is equally represented
+        '''
+        n = len(self)
+        rng = np.random.default_rng(seed)
+        if balance:
+            return rng.choice(n, size=n, replace=True,
+                              p=self.sample_weights(band))
+        if shuffle:
+            return rng.permutation(n)
+        return np.arange(n)
+
+    def batches(self, batch_size=32, shuffle=False, balance=False, band=None,
+                seed=None, workers=0, prefetch=2):
+        '''
+        Yield (x, mask, y) batches for one epoch (see batch and indices).
+        With workers > 0, batches are gathered on a thread pool, up to
+        prefetch * workers ahead of the consumer, and yielded in order.
+        '''
+        order = self.indices(shuffle, balance, band, seed)
+        groups = (np.asarray(b) for b in batched(order, batch_size))
+        if workers < 1:
+            for idx in groups:
+                yield self.batch(idx)
+            return
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for out in bounded_map(pool, self._gather, groups,
+                                   max_pending=prefetch * workers):
+                yield out
+
+    def _gather(self, idx):
+        # read the pages now, in the worker, rather than in the consumer
+        x, m, y = self.batch(idx)
+        return np.array(x), np.array(m), y
+
+
+def _slice_or_all(key):
+    return key if isinstance(key, slice) else slice(None)
+
+
+def _labels(labels, key):
+    if isinstance(key, slice):
+        return labels[key]
+    return [labels[i] for i in key]
+
+
+def _names(labels, key):
+    if isinstance(key, slice) and key == slice(None):
+        return None
+    return _labels(labels, key)
@@ -0,0 +1,1352 @@
+"""
+Offline benchmark suite for the avy fetch and process code
+
+Runs against a local StubServer and synthetic data (see synthetic.py), so no
+network access or API token is needed. Each case is timed `repeat` times and
+the best time kept. Results are appended to a JSON lines history, and every
+case is compared with the median of its last few runs at the same scale on
+the same machine; with --check the exit status is 1 if any case got slower
+than --threshold. Correctness checks (e.g. that the bulletin engines agree)
+run first, and the exit status is 1 whenever one of them fails.
+
+python benchmarks/run.py --scale small
+python benchmarks/run.py --scale medium --only nowcast,stn --check
+
+@author: ABerner
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(os.path.dirname(here), 'avy'))
+
+import synthetic
+from stubserver import StubServer
+
+scales = {'small': {'n_pages': 60, 'n_bulletins': 100, 'n_stations': 4,
+                    'stn_years': 1, 'n_meta': 500, 'n_queries': 50},
+          'medium': {'n_pages': 300, 'n_bulletins': 1000, 'n_stations': 12,
+                     'stn_years': 3, 'n_meta': 5000, 'n_queries': 500},
+          'large': {'n_pages': 1500, 'n_bulletins': 5000, 'n_stations': 50,
+                    'stn_years': 10, 'n_meta': 50000, 'n_queries': 5000}}
+
+cases = []
+checks = []
+
+
+def check(group):
+    '''
+    Register a correctness check. The decorated function takes the same
+    context as a case and raises AssertionError (with a message saying what
+    differed) when the check fails.
+    '''
+    def register(func):
+        checks.append((group, func))
+        return func
+    return register
+
+
+def case(group):
+    '''
+    Register a benchmark. The decorated function does its setup and returns
+    (run, n_items, extra): run() is the timed call, n_items what it
+    processes (for a rate) and extra a callable returning additional
+    metrics after the runs, or None.
+    '''
+    def register(func):
+        cases.append((group, func))
+        return func
+    return register
+
+
+def _season(n_days, start='2016-11-01'):
+    return pd.date_range(start, periods=n_days, freq='D')
+
+
+def _fresh_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+@case('fetch')
+def fetch_pages_serial(ctx):
+    from common import DataFetcher
+    urls = ['{0}/viewTeton?data_date={1:%Y-%m-%d}'
+            '&template=teton_print.tpl.php'.format(ctx['srv'].url, d)
+            for d in _season(ctx['n_pages'] // 4)]
+    fetcher = DataFetcher(sleep_interval=0)
+    out = os.path.join(ctx['workdir'], 'pages_serial.json.gz')
+    return lambda: fetcher.fetch_pages(urls, out), len(urls), None
+
+
+@case('fetch')
+def fetch_pages_concurrent(ctx):
+    from common import DataFetcher
+    urls = ['{0}/viewTeton?data_date={1:%Y-%m-%d}'
+            '&template=teton_print.tpl.php'.format(ctx['srv'].url, d)
+            for d in _season(ctx['n_pages'])]
+    fetcher = DataFetcher(sleep_interval=0, max_workers=8)
+    out = os.path.join(ctx['workdir'], 'pages.json.gz')
+    return lambda: fetcher.fetch_pages(urls, out), len(urls), None
+
+
+@case('fetch')
+def fetch_pages_throttled(ctx):
+    '''
+    Client-side rate limit just under a throttling server's limit: measures
+    the limiter's throughput and counts the 429s it fails to avoid
+    '''
+    from common import DataFetcher
+    srv = StubServer(latency=ctx['latency'], rate=20, burst=4).start()
+    ctx['cleanup'].append(srv.stop)
+    urls = ['{0}/viewTeton?data_date={1:%Y-%m-%d}'
+            '&template=teton_print.tpl.php'.format(srv.url, d)
+            for d in _season(ctx['n_pages'] // 2)]
+    fetcher = DataFetcher(max_workers=8, rate=18, burst=4)
+    out = os.path.join(ctx['workdir'], 'pages_throttled.json.gz')
+    return (lambda: fetcher.fetch_pages(urls, out), len(urls),
+            lambda: {'throttled': srv.stats.get('throttled', 0)})
+
+
+@case('fetch')
+def fetch_mnet_ts(ctx):
+    import fetchwx
+    srv = ctx['srv']
+    fetcher = fetchwx.MwFetcher(token='bench', api_url=srv.api_url)
+    outdir = os.path.join(ctx['workdir'], 'mnet') + '/'
+    years = ctx['stn_years']
+    end = (2017 + years, 1, 1, 0, 0)
+
+    # the stub does not throttle; time the downloads, not the rate limit
+    def run():
+        _fresh_dir(outdir)
+        fetchwx.fetch_mnet_ts([48], {'state': ('WY',)}, outdir,
+                              start_date=(2017, 1, 1), end_date=end,
+                              max_workers=4, window_days=365, rate=None,
+                              fetcher=fetcher)
+    # items: station-years downloaded
+    return run, srv.n_stations * years, None
+
+
+@check('fetch')
+def cache_hides_token(ctx):
+    '''
+    ResponseCache never writes the Synoptic API token to disk, in the keys,
+    the metadata or the bodies
+    '''
+    import fetchwx
+    from httpcache import ResponseCache
+    cachedir = os.path.join(ctx['workdir'], 'token_cache')
+    token = 'SECRET123'
+    fetcher = fetchwx.MwFetcher(token=token, api_url=ctx['srv'].api_url,
+                                cache=ResponseCache(cachedir))
+    fetcher.fetch_networks()
+    fetcher.fetch_stn_metadata([48], {'state': ('WY',)})
+    names, found = [], []
+    for root, _, files in os.walk(cachedir):
+        for name in files:
+            names.append(name)
+            with open(os.path.join(root, name), 'rb') as fin:
+                if token.encode('utf-8') in fin.read() or token in name:
+                    found.append(name)
+    assert names, 'nothing was cached'
+    assert not found, 'token written to {0}'.format(', '.join(found))
+
+
+@check('fetch')
+def retry_policy_against_stub(ctx):
+    '''
+    RetryPolicy retries 429/5xx and connection errors but not 404s or
+    programming errors, waits at least the server's Retry-After (also from a
+    throttling server), and its circuit breaker opens after
+    failure_threshold failures, stays open (no requests reach the host),
+    lets one trial through once reset_timeout has passed and reopens or
+    closes on its outcome
+    '''
+    import requests
+    from urllib.parse import urlsplit
+    from common import CircuitOpenError, RetryError, RetryPolicy
+    srv = StubServer().start()
+    ctx['cleanup'].append(srv.stop)
+    host = urlsplit(srv.url).netloc
+    session = requests.Session()
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        time.sleep(seconds)
+
+    def get(path, policy, expect=None):
+        '''
+        (requests that reached the server, waits, error) for one call
+        '''
+        del waits[:]
+        before = srv.stats.get('requests', 0)
+        error = None
+        try:
+            policy.call(session.get, (srv.url + path,), {'timeout': 5},
+                        host=host)
+        except (RetryError, requests.ConnectionError, ValueError) as e:
+            error = type(e).__name__
+        n = srv.stats.get('requests', 0) - before
+        return n, list(waits), error
+
+    policy = RetryPolicy(max_retries=2, initial_wait=0.01, max_wait=0.02,
+                         failure_threshold=100, sleep=sleep)
+    for path, attempts, error in (('/status/200', 1, None),
+                                  ('/status/404', 1, None),
+                                  ('/status/503', 3, 'RetryError'),
+                                  ('/status/429', 3, 'RetryError')):
+        n, w, e = get(path, policy)
+        assert (n, len(w), e) == (attempts, attempts - 1, error), \
+            '{0}: {1} requests, {2} waits, error {3}; expected {4}, {5}, ' \
+            '{6}'.format(path, n, len(w), e, attempts, attempts - 1, error)
+        assert all(0.01 <= x <= 0.02 for x in w), \
+            '{0}: waits {1} outside [initial_wait, max_wait]'.format(path, w)
+    n, w, e = get('/status/429?retry_after=0.3', policy)
+    assert n == 3 and e == 'RetryError' and len(w) == 2 and \
+        all(x >= 0.3 for x in w), \
+        'Retry-After 0.3 on 429: {0} requests, waits {1}'.format(n, w)
+    n, w, e = get('/status/503?retry_after=0.3', policy)
+    assert n == 3 and len(w) == 2 and all(x >= 0.3 for x in w), \
+        'Retry-After 0.3 on 503: {0} requests, waits {1}'.format(n, w)
+
+    calls = []
+
+    def broken(*args):
+        calls.append(args)
+        raise ValueError('bug')
+    try:
+        policy.call(broken, host=host)
+    except ValueError:
+        pass
+    assert len(calls) == 1, 'a ValueError was retried {0} times'.format(
+        len(calls) - 1)
+    dead = StubServer().start()
+    dead_url = dead.url
+    dead.stop()
+    del waits[:]
+    try:
+        policy.call(session.get, (dead_url,), {'timeout': 5})
+        assert False, 'no error from a closed port'
+    except requests.ConnectionError:
+        pass
+    assert len(waits) == 2, 'connection error retried {0} times, ' \
+        'expected 2'.format(len(waits))
+
+    # a throttling server's own 429 carries Retry-After: 1
+    slow = StubServer(rate=0.5, burst=1).start()
+    ctx['cleanup'].append(slow.stop)
+    del waits[:]
+    for _ in range(2):
+        r = policy.call(session.get, (slow.url + '/status/200',),
+                        {'timeout': 5}, host=urlsplit(slow.url).netloc)
+        assert r.status_code == 200, 'throttled call ended with {0}'.format(
+            r.status_code)
+    assert waits and all(x >= 1 for x in waits) and \
+        slow.stats.get('throttled', 0) == len(waits), \
+        'throttled: waits {0} for {1} 429s'.format(
+            waits, slow.stats.get('throttled', 0))
+
+    reset = 0.3
+    policy = RetryPolicy(max_retries=0, initial_wait=0.01, max_wait=0.02,
+                         failure_threshold=2, reset_timeout=reset,
+                         wait_open=False, sleep=sleep)
+    breaker = policy.breaker(host)
+    for i in range(2):
+        assert breaker.state == 'closed', \
+            'open after {0} failures, threshold 2'.format(i)
+        n, w, e = get('/status/503', policy)
+        assert (n, e) == (1, 'RetryError'), \
+            'max_retries=0: {0} requests, error {1}'.format(n, e)
+    assert breaker.state == 'open', 'still {0} after 2 failures'.format(
+        breaker.state)
+    for _ in range(3):
+        n, w, e = get('/status/200', policy)
+        assert (n, e) == (0, 'CircuitOpenError'), \
+            'open circuit: {0} requests reached the host, error {1}'.format(
+                n, e)
+    time.sleep(reset)
+    n, w, e = get('/status/503', policy)
+    assert n == 1 and breaker.state == 'open', \
+        'half-open trial: {0} requests, then {1}'.format(n, breaker.state)
+    n, w, e = get('/status/200', policy)
+    assert (n, e) == (0, 'CircuitOpenError'), \
+        'reopened circuit let {0} requests through'.format(n)
+    policy.wait_open = True
+    n, w, e = get('/status/200', policy)
+    assert n == 1 and e is None and breaker.state == 'closed', \
+        'waiting out the circuit: {0} requests, error {1}, then {2}'.format(
+            n, e, breaker.state)
+    assert w and 0 < sum(w) <= reset * 1.5, \
+        'waited {0} for a {1}s reset_timeout'.format(w, reset)
+
+
+@check('fetch')
+def stn_appends_match_single_fetch(ctx):
+    '''
+    A station CSV grown by update_stn_csv (one gzip member per update) or
+    downloaded by fetch_stns_windowed in date windows, fresh and as an
+    update, reads the same as one request for the whole period: no rows
+    duplicated or lost at window edges, also off the observation grid and
+    from a record start. The windowed download keeps to its default rate.
+    '''
+    import fetchwx
+    from processwx import read_stn_csv
+    srv = ctx['srv']
+    fetcher = fetchwx.MwFetcher(token='bench', api_url=srv.api_url)
+    start, mid, end = (2017, 1, 1, 0, 0), (2017, 3, 1, 0, 0), \
+        (2017, 3, 20, 0, 0)
+    stids = ['SYN0001', 'SYN0002']
+    first = pd.Timestamp('2017-01-05 12:07')
+
+    def single(stid, until):
+        outdir = _fresh_dir(os.path.join(ctx['workdir'], 'stn_single')) + \
+            '/'
+        fetchwx.update_stn_csv(fetcher, stid, outdir, start, until)
+        return read_stn_csv(outdir + stid + '.csv')
+
+    def compare(outdir, until, how):
+        for stid in stids:
+            df = read_stn_csv(outdir + stid + '.csv')
+            expected = single(stid, until)
+            if how != 'appended' and stid == 'SYN0002':
+                expected = expected[expected.index >= first.tz_localize(
+                    expected.index.tz)]
+            assert df.index.is_unique, '{0} {1}: {2} duplicate rows'.format(
+                how, stid, int(df.index.duplicated().sum()))
+            pd.testing.assert_frame_equal(df, expected,
+                                          obj='{0} {1}'.format(how, stid))
+
+    windows = fetchwx.date_windows(start, mid, 9)
+    for (_, a), (b, _) in zip(windows[:-1], windows[1:]):
+        gap = pd.Timestamp(*b) - pd.Timestamp(*a)
+        assert gap == pd.Timedelta(minutes=1), \
+            'date_windows {0} then {1}'.format(a, b)
+    assert windows[0][0] == start and windows[-1][1] == mid, \
+        'date_windows cover {0} to {1}'.format(windows[0][0],
+                                               windows[-1][1])
+
+    outdir = _fresh_dir(os.path.join(ctx['workdir'], 'stn_appended')) + '/'
+    for stid in stids:
+        for until in ((2017, 1, 20, 7, 30), (2017, 2, 10, 0, 5), mid):
+            fetchwx.update_stn_csv(fetcher, stid, outdir, start, until)
+        members = fetchwx.read_manifest(outdir, stid)['members']
+        assert members == 3, '{0} has {1} gzip members, expected 3'.format(
+            stid, members)
+    compare(outdir, mid, 'appended')
+
+    outdir = _fresh_dir(os.path.join(ctx['workdir'], 'stn_windowed')) + '/'
+    rec_start = {'SYN0001': pd.Timestamp('2000-01-01'), 'SYN0002': first}
+    fetchwx.fetch_stns_windowed(fetcher, stids, outdir, start, mid,
+                                rec_start=rec_start, max_workers=4,
+                                window_days=9, rate=None)
+    compare(outdir, mid, 'windowed')
+    before = srv.stats.get('requests', 0)
+    t0 = time.monotonic()
+    fetchwx.fetch_stns_windowed(fetcher, stids, outdir, start, end,
+                                rec_start=rec_start, max_workers=4,
+                                window_days=9)
+    elapsed = time.monotonic() - t0
+    n = srv.stats.get('requests', 0) - before
+    compare(outdir, end, 'windowed update')
+    assert n > 2 and elapsed >= 0.9 * (n - 1) / 2., \
+        '{0} requests in {1:.2f} s with the default rate of 2/s'.format(
+            n, elapsed)
+
+
+def _bulletin_file(ctx):
+    path = os.path.join(ctx['workdir'], 'bulletins.json.gz')
+    if not os.path.isfile(path):
+        from common import GzipJsonFile
+        days = _season(ctx['n_bulletins'], start='2005-11-01')
+        with GzipJsonFile(path, 'w', index=True) as fout:
+            for line in synthetic.fetched_bulletins(days):
+                fout.write(line, status=line['status'])
+    return path
+
+
+@case('nowcast')
+def nowcast_bs4(ctx):
+    from processbtac import process_btac_nowcast
+    infile = _bulletin_file(ctx)
+    out = os.path.join(ctx['workdir'], 'nowcast_bs4.csv.gz')
+    return (lambda: process_btac_nowcast(infile, out, engine='bs4'),
+            ctx['n_bulletins'], None)
+
+
+@case('nowcast')
+def nowcast_fast(ctx):
+    from processbtac import process_btac_nowcast
+    infile = _bulletin_file(ctx)
+    out = os.path.join(ctx['workdir'], 'nowcast_fast.csv.gz')
+    return (lambda: process_btac_nowcast(infile, out, engine='fast'),
+            ctx['n_bulletins'], None)
+
+
+@case('nowcast')
+def nowcast_fast_parallel(ctx):
+    from processbtac import process_btac_nowcast
+    infile = _bulletin_file(ctx)
+    out = os.path.join(ctx['workdir'], 'nowcast_par.csv.gz')
+    return (lambda: process_btac_nowcast(infile, out, engine='fast',
+                                         n_jobs=4),
+            ctx['n_bulletins'], None)
+
+
+@case('nowcast')
+def nowcast_graphics(ctx):
+    '''
+    Continental Divide bulletins, whose ratings are danger icons: the
+    images are decoded once in setup (as the pipeline's image stage
+    would), so this times parsing with the decoded table, for comparison
+    with nowcast_fast
+    '''
+    from common import GzipJsonFile
+    from hazardimg import decode_bulletin_images
+    from processbtac import process_btac_nowcast
+    infile = os.path.join(ctx['workdir'], 'bulletins_tog.json.gz')
+    days = _season(ctx['n_bulletins'], start='2005-11-01')
+    with GzipJsonFile(infile, 'w', index=True) as fout:
+        for line in synthetic.fetched_bulletins(days, region='tog',
+                                                base_url=ctx['srv'].url):
+            fout.write(line, status=line['status'])
+    graphics = decode_bulletin_images(
+        infile, os.path.join(ctx['workdir'], 'hazard_images'), rate=None)
+    out = os.path.join(ctx['workdir'], 'nowcast_tog.csv.gz')
+    return (lambda: process_btac_nowcast(infile, out, engine='fast',
+                                         graphics=graphics),
+            ctx['n_bulletins'], lambda: {'images': len(graphics)})
+
+
+@check('nowcast')
+def nowcast_engines_agree(ctx):
+    '''
+    The fast and bs4 bulletin engines extract the same rows, for Teton
+    bulletins and for bulletins rated by danger icons
+    '''
+    from common import GzipJsonFile
+    from hazardimg import decode_bulletin_images
+    from processbtac import compare_nowcast_engines
+    mismatches = compare_nowcast_engines(_bulletin_file(ctx))
+    infile = os.path.join(ctx['workdir'], 'bulletins_check_tog.json.gz')
+    days = _season(min(ctx['n_bulletins'], 100), start='2005-11-01')
+    with GzipJsonFile(infile, 'w', index=True) as fout:
+        for line in synthetic.fetched_bulletins(days, region='tog',
+                                                base_url=ctx['srv'].url):
+            fout.write(line, status=line['status'])
+    graphics = decode_bulletin_images(
+        infile, os.path.join(ctx['workdir'], 'hazard_images'), rate=None)
+    mismatches += compare_nowcast_engines(infile, graphics=graphics)
+    assert not mismatches, '{0} bulletins differ between engines, e.g. ' \
+        '{1}'.format(len(mismatches), mismatches[0][0])
+
+
+@check('nowcast')
+def nowcast_incremental_matches_full(ctx):
+    '''
+    Incremental nowcast runs over an archive fetched in parts (including a
+    part dated before what is already processed) give the same output as
+    one full run, and bulletins skipped for want of a decoded graphic are
+    picked up once the graphics table has it
+    '''
+    from common import GzipJsonFile
+    from hazardimg import decode_bulletin_images
+    from processbtac import process_btac_nowcast
+
+    def read(path):
+        return pd.read_csv(path, index_col=0, parse_dates=[0],
+                           compression='gzip')
+
+    def archive(name, region):
+        days = _season(min(ctx['n_bulletins'], 100), start='2005-11-01')
+        lines = list(synthetic.fetched_bulletins(days, region=region,
+                                                 base_url=ctx['srv'].url))
+        n = len(lines)
+        parts = [lines[:n * 2 // 5], lines[n * 7 // 10:],
+                 lines[n * 2 // 5:n * 7 // 10]]
+        full = os.path.join(ctx['workdir'], name + '_full.json.gz')
+        with GzipJsonFile(full, 'w', index=True) as fout:
+            for line in lines:
+                fout.write(line, status=line['status'])
+        return full, parts
+
+    def append(path, lines):
+        with GzipJsonFile(path, 'a', index=True) as fout:
+            for line in lines:
+                fout.write(line, status=line['status'])
+
+    full, parts = archive('incr_teton', 'teton')
+    infile = os.path.join(ctx['workdir'], 'incr_teton.json.gz')
+    out = os.path.join(ctx['workdir'], 'incr_teton.csv.gz')
+    for part in parts:
+        append(infile, part)
+        process_btac_nowcast(infile, out, engine='fast', incremental=True)
+    expected = os.path.join(ctx['workdir'], 'incr_teton_full.csv.gz')
+    process_btac_nowcast(full, expected, engine='fast')
+    pd.testing.assert_frame_equal(read(out), read(expected))
+
+    full, parts = archive('incr_tog', 'tog')
+    graphics = decode_bulletin_images(
+        full, os.path.join(ctx['workdir'], 'hazard_images'), rate=None)
+    # one icon not decoded yet: the bulletins showing it are skipped
+    partial = dict(graphics)
+    del partial[sorted(partial)[0]]
+    infile = os.path.join(ctx['workdir'], 'incr_tog.json.gz')
+    out = os.path.join(ctx['workdir'], 'incr_tog.csv.gz')
+    for part in parts:
+        append(infile, part)
+        process_btac_nowcast(infile, out, engine='fast', incremental=True,
+                             graphics=partial)
+    expected = os.path.join(ctx['workdir'], 'incr_tog_full.csv.gz')
+    process_btac_nowcast(full, expected, engine='fast', graphics=graphics)
+    assert len(read(out)) < len(read(expected)), \
+        'no bulletin was skipped with the partial graphics table'
+    process_btac_nowcast(infile, out, engine='fast', incremental=True,
+                         graphics=graphics)
+    pd.testing.assert_frame_equal(read(out), read(expected))
+
+
+@check('nowcast')
+def icons_ignore_outlines(ctx):
+    '''
+    Icons with thick dark borders and black labels decode to their fill
+    level: the near-black Extreme colour of outlines and text must not
+    outvote the fill
+    '''
+    from hazardimg import decode_image
+    for border, label in ((1, None), (4, 'MOD'), (6, 'CONSIDERABLE')):
+        for level in range(1, 6):
+            got = decode_image(synthetic.hazard_icon(level, border=border,
+                                                     label=label))['level']
+            assert got == level, 'level {0} icon with a {1}px border and ' \
+                'label {2!r} decoded as {3}'.format(level, border, label,
+                                                    got)
+
+
+@check('dataset')
+def dataset_no_lookahead(ctx):
+    '''
+    build_dataset only uses weather observed up to each issuance time: an
+    observation minutes after the 7am bulletin must not reach its row
+    '''
+    from dataset import build_dataset
+    hzrd_df = pd.DataFrame({'region': ['teton'], 'atl': [3], 'tl': [2],
+                            'btl': [1]},
+                           index=pd.DatetimeIndex(['2017-01-05 07:00']))
+    events_df = pd.DataFrame({'event_date': ['2017-01-05'],
+                              'elevation': [8000.], 'fatality': [0.],
+                              'zone': ['Teton']})
+    # 07:00 US/Mountain is 14:00 UTC
+    obs = pd.DataFrame({'air_temp_set_1': [-4., -6., 10.]},
+                       index=pd.DatetimeIndex(['2017-01-05 13:20',
+                                               '2017-01-05 13:50',
+                                               '2017-01-05 14:10'],
+                                              tz='UTC'))
+    df = build_dataset(hzrd_df, events_df, {'SYN': obs})
+    value = df['SYN_air_temp_set_1'].iloc[0]
+    assert value == -5., 'issuance row has {0}, expected -5.0 from the ' \
+        'observations before 14:00 UTC'.format(value)
+
+
+@check('qc')
+def qc_stream_matches_frame(ctx):
+    '''
+    QCStream over chunks gives the same flags and cleaned values as
+    qc_frame on the whole series, including across a dropout in one column
+    longer than the stream's overlap (after which the value resumes
+    unchanged)
+    '''
+    from qc import QCStream, qc_frame
+    r = np.random.default_rng(0)
+    t = pd.date_range('2017-01-01', periods=60 * 96, freq='15min', tz='UTC')
+    n = len(t)
+    air = 5 * np.sin(np.arange(n) / 40.) + r.normal(0, 0.3, n)
+    air[r.random(n) < 0.01] = np.nan
+    air[100] = 80.
+    snow = 1000 + np.cumsum(r.normal(0, 0.2, n)).round(0)
+    snow[2000:3700] = np.nan
+    snow[3700:3750] = snow[1999]
+    snow[4500:4900] = snow[4500]
+    wind = np.abs(r.normal(5, 2, n))
+    wind[::97] = np.nan
+    df = pd.DataFrame({'air_temp_set_1': air, 'snow_depth_set_1': snow,
+                       'wind_speed_set_1': wind}, index=t)
+    clean, flags = qc_frame(df)
+    for size in (500, 2777):
+        stream = QCStream()
+        parts = [stream.push(df.iloc[lo:lo + size])
+                 for lo in range(0, n, size)]
+        parts.append(stream.flush())
+        s_clean = pd.concat([p[0] for p in parts])
+        s_flags = pd.concat([p[1] for p in parts])
+        diff = (s_flags != flags).any(axis=1)
+        assert not diff.any(), '{0} rows flagged differently in chunks ' \
+            'of {1}, first at {2}'.format(int(diff.sum()), size,
+                                          diff.idxmax())
+        pd.testing.assert_frame_equal(s_clean, clean)
+
+
+@check('pipeline')
+def pipeline_fetch_wx_qc(ctx):
+    '''
+    The fetch_wx and qc stages run back to back on the stub server's
+    stations, QC sees only the station CSVs, not the metadata file
+    fetch_mnet_ts writes next to them, and a changed download parameter
+    makes the download and everything after it stale
+    '''
+    import fetchwx
+    from pipeline import build_pipeline
+    config = os.path.join(ctx['workdir'], 'synoptic_config.yml')
+    with open(config, 'w') as fout:
+        fout.write('SynopticAPI:\n  token: bench\n')
+    fetchwx.load_config(config)
+    datadir = _fresh_dir(os.path.join(ctx['workdir'], 'pipeline'))
+    cfg = {'datadir': datadir,
+           'wx': {'networks': [48],
+                  'args': {'state': ['WY']},
+                  'start_date': [2017, 1, 1],
+                  'end_date': [2017, 2, 1, 0, 0],
+                  'api_url': ctx['srv'].api_url}}
+    pipe = build_pipeline(cfg)
+    status = pipe.run()
+    assert status == {'fetch_wx': 'ran', 'qc': 'ran'}, \
+        'stage status {0}'.format(status)
+    qcdir = os.path.join(datadir, 'wx_store', 'qc')
+    stids = sorted(os.listdir(qcdir))
+    assert len(stids) == ctx['srv'].n_stations and \
+        not any('metadata' in s for s in stids), \
+        'QC ran on {0}'.format(', '.join(stids))
+    plan = build_pipeline(cfg).plan()
+    assert plan == {'fetch_wx': None, 'qc': None}, \
+        'stale after a run: {0}'.format(plan)
+    cfg['wx']['end_date'] = [2017, 3, 1, 0, 0]
+    plan = build_pipeline(cfg).plan()
+    assert plan == {'fetch_wx': 'params changed', 'qc': 'upstream stale'}, \
+        'after changing end_date: {0}'.format(plan)
+
+
+def _stn_dir(ctx):
+    datadir = os.path.join(ctx['workdir'], 'stn')
+    if not os.path.isdir(datadir):
+        import gzip
+        os.makedirs(datadir)
+        end = '{0}-01-01'.format(2010 + ctx['stn_years'])
+        with gzip.open(os.path.join(datadir, 'SYN0000.csv'), 'wt') as fout:
+            fout.write(synthetic.stn_csv('SYN0000', '2010-01-01', end))
+    return datadir
+
+
+def _stn_rows(ctx):
+    return ctx['stn_years'] * 365 * 96
+
+
+@case('stn')
+def process_stn_csv(ctx):
+    from processwx import process_stn
+    datadir = _stn_dir(ctx)
+    return lambda: process_stn(datadir, 'SYN0000'), _stn_rows(ctx), None
+
+
+@case('stn')
+def process_stn_store_build(ctx):
+    from processwx import StationStore, process_stn
+    datadir = _stn_dir(ctx)
+    storedir = os.path.join(ctx['workdir'], 'store_build')
+
+    def run():
+        shutil.rmtree(storedir, ignore_errors=True)
+        process_stn(datadir, 'SYN0000',
+                    store=StationStore(datadir, storedir=storedir))
+    return run, _stn_rows(ctx), None
+
+
+@case('stn')
+def process_stn_store_load(ctx):
+    from processwx import StationStore, process_stn
+    datadir = _stn_dir(ctx)
+    store = StationStore(datadir, storedir=os.path.join(ctx['workdir'],
+                                                        'store'))
+    store.table('SYN0000')
+    return (lambda: process_stn(datadir, 'SYN0000', store=store),
+            _stn_rows(ctx), None)
+
+
+@case('stn')
+def process_stn_store_slice(ctx):
+    from processwx import StationStore, process_stn
+    datadir = _stn_dir(ctx)
+    store = StationStore(datadir, storedir=os.path.join(ctx['workdir'],
+                                                        'store'))
+    store.table('SYN0000')
+    return (lambda: process_stn(datadir, 'SYN0000', store=store,
+                                columns=['air_temp_set_1'],
+                                start='2010-12', end='2010-12'),
+            31 * 96, None)
+
+
+@check('stn')
+def stn_stream_matches_read_csv(ctx):
+    '''
+    parse_stn_csv_stream (a multi-station body in chunks that split rows,
+    parsed in blocks) and stn_json_to_frames (the same data as Synoptic
+    JSON) give the frame read_stn_csv reads from each station's CSV file:
+    columns, dtypes, index and NaNs, including a sensor that is blank in
+    every row
+    '''
+    import csv
+    import gzip
+    from fetchwx import parse_stn_csv_stream, stn_json_to_frames
+    from processwx import read_stn_csv
+    datadir = _fresh_dir(os.path.join(ctx['workdir'], 'stn_stream'))
+    bodies = {'SYN0001': synthetic.stn_csv('SYN0001', '2017-01-01',
+                                           '2017-01-09'),
+              'SYN0002': synthetic.stn_csv('SYN0002', '2017-01-03',
+                                           '2017-01-05')}
+    # SYN0002 has no wind direction sensor
+    rows = list(csv.reader(io.StringIO(bodies['SYN0002'])))
+    blank = rows[6].index('wind_direction_set_1')
+    for row in rows[8:]:
+        row[blank] = ''
+    lines = ['\n'.join(','.join(r) for r in rows[:6])] + \
+        [','.join(r) for r in rows[6:]]
+    bodies['SYN0002'] = '\n'.join(lines) + '\n'
+    expected = {}
+    stations = []
+    for stid, body in bodies.items():
+        path = os.path.join(datadir, stid + '.csv')
+        with gzip.open(path, 'wt') as fout:
+            fout.write(body)
+        expected[stid] = read_stn_csv(path)
+        rows = list(csv.reader(io.StringIO(body)))
+        obs = {'date_time': [r[1] for r in rows[8:]]}
+        for j, col in enumerate(rows[6][2:], 2):
+            obs[col] = [float(r[j]) if r[j] else None for r in rows[8:]]
+        stations.append({'STID': stid, 'OBSERVATIONS': obs})
+    body = ''.join(bodies.values()).encode('utf-8')
+    chunks = [body[i:i + 997] for i in range(0, len(body), 997)]
+    parsed = {'stream': parse_stn_csv_stream(chunks, block_lines=37),
+              'json': stn_json_to_frames(
+                  json.loads(json.dumps({'STATION': stations})))}
+    for how, frames in parsed.items():
+        assert sorted(frames) == sorted(expected), \
+            '{0} parsed stations {1}'.format(how, sorted(frames))
+        for stid, df in expected.items():
+            # read_csv may parse times at another resolution than ns
+            pd.testing.assert_frame_equal(frames[stid], df,
+                                          check_index_type=False,
+                                          obj='{0} {1}'.format(how, stid))
+            assert str(frames[stid].index.tz) == str(df.index.tz), \
+                '{0} {1}: index tz {2}'.format(how, stid,
+                                               frames[stid].index.tz)
+
+
+def _write_stn_csvs(datadir, spans, until=None):
+    '''
+    Gzipped synthetic station CSVs {stid: (start, end)} in datadir, with
+    only the observations before `until` if given
+    '''
+    import gzip
+    os.makedirs(datadir, exist_ok=True)
+    for stid, (start, end) in spans.items():
+        lines = synthetic.stn_csv(stid, start, end).splitlines(True)
+        if until is not None:
+            cut = pd.Timestamp(until, tz='UTC')
+            lines = lines[:8] + [ln for ln in lines[8:] if pd.Timestamp(
+                ln.split(',')[1]) < cut]
+        with gzip.open(os.path.join(datadir, stid + '.csv'), 'wt') as fout:
+            fout.writelines(lines)
+    return datadir
+
+
+@check('panel')
+def panel_update_matches_build(ctx):
+    '''
+    build_panel bins each cell to the mean of its observations (as a
+    pandas resample would), and a panel built on part of the data then
+    brought up to date with update_panel equals one built on all of it
+    '''
+    from panel import build_panel, update_panel
+    from processwx import StationStore
+    spans = {'SYNA': ('2017-01-01', '2017-01-20'),
+             'SYNB': ('2017-01-03', '2017-01-12')}
+    variables = ['air_temp_set_1', 'snow_depth_set_1', 'no_such_column']
+    full_dir = _write_stn_csvs(os.path.join(ctx['workdir'], 'panel_full'),
+                               spans)
+    full_store = StationStore(full_dir)
+    full = build_panel(os.path.join(ctx['workdir'], 'panel_a'), full_store,
+                       list(spans), variables, freq='1h')
+    df = full_store.load('SYNA', columns=variables[:2])
+    expected = df.resample('1h').mean()
+    got = full.frame('SYNA').iloc[:len(expected)]
+    np.testing.assert_allclose(got[variables[:2]].values, expected.values,
+                               rtol=1e-6, err_msg='binned means differ')
+    assert got['no_such_column'].isnull().all()
+
+    part_dir = os.path.join(ctx['workdir'], 'panel_part')
+    _write_stn_csvs(part_dir, spans, until='2017-01-08 10:30')
+    path = os.path.join(ctx['workdir'], 'panel_b')
+    build_panel(path, StationStore(part_dir), list(spans), variables,
+                freq='1h')
+    _write_stn_csvs(part_dir, spans)
+    updated = update_panel(path, StationStore(part_dir))
+    assert updated.coords == full.coords, 'coords differ'
+    np.testing.assert_array_equal(np.array(updated.values),
+                                  np.array(full.values))
+    np.testing.assert_array_equal(np.array(updated.mask),
+                                  np.array(full.mask))
+
+
+@check('windows')
+def windows_match_loop(ctx):
+    '''
+    WindowDataset samples equal a naive loop over the bulletin days: the
+    window is the lookback of panel cells that ended by the morning
+    issuance, the labels the day's am and pm ratings; days issued after
+    the panel ends have no sample. Season splits
+    partition the samples, and prefetched batches come out in the same
+    order as unprefetched ones.
+    '''
+    from panel import build_panel
+    from processwx import StationStore
+    from windows import WindowDataset
+    spans = {'SYNA': ('2017-08-01', '2017-09-20'),
+             'SYNB': ('2017-08-05', '2017-09-20')}
+    datadir = _write_stn_csvs(os.path.join(ctx['workdir'], 'windows'),
+                              spans)
+    panel = build_panel(os.path.join(ctx['workdir'], 'windows_panel'),
+                        StationStore(datadir), list(spans),
+                        ['air_temp_set_1', 'snow_depth_set_1'], freq='1h')
+    r = np.random.default_rng(0)
+    # bulletins continue ten days past the end of the weather
+    days = pd.date_range('2017-07-30', '2017-09-30', freq='D')
+    times = days.append(days + pd.Timedelta(hours=6)) + \
+        pd.Timedelta(hours=9)
+    hzrd_df = pd.DataFrame({'region': 'teton',
+                            'atl': r.integers(1, 5, len(times)),
+                            'tl': r.integers(1, 5, len(times)),
+                            'btl': r.integers(1, 5, len(times))},
+                           index=times).sort_index()
+    # drop one afternoon: that day has no complete label
+    hzrd_df = hzrd_df.drop(pd.Timestamp('2017-08-20 15:00'))
+
+    stations = ['SYNB', 'SYNA']
+    ds = WindowDataset(panel, hzrd_df, lookback='3D', stations=stations)
+    values = np.array(panel.values)[:, [1, 0]]
+    cell_end = panel.times + panel.step
+    exp_days, exp_x, exp_y = [], [], []
+    for day in days:
+        if day == pd.Timestamp('2017-08-20'):
+            continue
+        issued = (day + pd.Timedelta(hours=9)).tz_localize('US/Mountain')
+        end = int((cell_end <= issued).sum())
+        if end < ds.length or issued >= cell_end[-1] + panel.step:
+            # too early, or the panel ends before the cell that ended at
+            # the issuance
+            continue
+        am = hzrd_df.loc[day + pd.Timedelta(hours=9)]
+        pm = hzrd_df.loc[day + pd.Timedelta(hours=15)]
+        exp_days.append(day)
+        exp_x.append(values[end - ds.length:end])
+        exp_y.append([[row[b] for b in ('atl', 'tl', 'btl')]
+                      for row in (am, pm)])
+    assert list(ds.days) == exp_days, 'sample days differ'
+    assert ds.days[-1] < days[-5], 'days after the panel end were kept'
+    x, _, y = ds.batch(np.arange(len(ds)))
+    np.testing.assert_array_equal(x, np.array(exp_x))
+    np.testing.assert_array_equal(y, np.array(exp_y))
+
+    train, val = ds.split(val=[2017])
+    assert len(train) + len(val) == len(ds) and \
+        (train.seasons == 2016).all() and (val.seasons == 2017).all(), \
+        'split does not partition the samples by season'
+    np.testing.assert_array_equal(val.batch(np.arange(len(val)))[0],
+                                  x[len(train):])
+    plain = list(ds.batches(7, shuffle=True, seed=1))
+    ahead = list(ds.batches(7, shuffle=True, seed=1, workers=3))
+    assert len(plain) == len(ahead), 'prefetch changed the batch count'
+    for a, b in zip(plain, ahead):
+        for u, v in zip(a, b):
+            np.testing.assert_array_equal(u, v)
+
+
+@check('events')
+def event_index_matches_filter(ctx):
+    '''
+    EventIndex queries (date range, zones, bands, radius), near_stations
+    and join_stations give the same rows as brute-force filters over the
+    whole table, with unlocated and zoneless events mixed in
+    '''
+    from dataset import elevation_band
+    from eventindex import EventIndex
+    from geo import haversine
+    df = pd.DataFrame(synthetic.events('2016-11-01', '2017-03-31',
+                                       per_day=3)['data'])
+    df = df[['ID', 'event_date', 'event_time', 'zone', 'elevation', 'lat',
+             'lng', 'fatality']]
+    df.loc[df.index % 17 == 0, 'lat'] = None
+    df.loc[df.index % 23 == 0, 'zone'] = None
+    idx = EventIndex.from_events(df)
+
+    ref = df.assign(date=pd.to_datetime(df['event_date']),
+                    band=elevation_band(pd.to_numeric(df['elevation']))
+                    .astype(object),
+                    lat=pd.to_numeric(df['lat']),
+                    lng=pd.to_numeric(df['lng']))
+    ref = ref.iloc[np.argsort(ref['date'].values, kind='stable')]
+    queries = [{'start': '2016-12-10', 'end': '2017-01-20'},
+               {'start': '2017-01-01', 'zones': ['Teton', 'Greys River']},
+               {'end': '2017-02-01', 'bands': ['atl', 'btl']},
+               {'zones': ['Togwotee'], 'bands': ['tl']},
+               {'start': '2016-12-01', 'end': '2017-02-28', 'lat': 43.8,
+                'lon': -110.7, 'r_km': 15},
+               {'zones': ['Teton'], 'bands': ['atl'], 'lat': 43.5,
+                'lon': -111.0, 'r_km': 25}]
+    for q in queries:
+        keep = np.ones(len(ref), dtype=bool)
+        if 'start' in q:
+            keep &= ref['date'] >= q['start']
+        if 'end' in q:
+            keep &= ref['date'] <= q['end']
+        if 'zones' in q:
+            keep &= ref['zone'].isin(q['zones'])
+        if 'bands' in q:
+            keep &= ref['band'].isin(q['bands'])
+        dist = haversine(ref['lat'].values, ref['lng'].values,
+                         q.get('lat'), q.get('lon')) if 'r_km' in q else None
+        if dist is not None:
+            keep &= dist <= q['r_km']
+        got = idx.query(**q)
+        assert list(got['ID']) == list(ref['ID'][keep]), \
+            'query {0} returned {1} rows, brute force {2}'.format(
+                q, len(got), int(keep.sum()))
+        if dist is not None:
+            np.testing.assert_allclose(got['dist'].values, dist[keep])
+
+    md_df = pd.DataFrame({'stid': ['S1', 'S2', 'S3'],
+                          'latitude': [43.6, 43.9, 45.0],
+                          'longitude': [-110.9, -110.5, -110.0]})
+    pairs = idx.near_stations(md_df, 20, start='2016-12-15',
+                              end='2017-02-15')
+    rows = np.argsort(pd.to_datetime(df['event_date']).values,
+                      kind='stable')
+    expected = []
+    for s, st in md_df.iterrows():
+        d = haversine(ref['lat'].values, ref['lng'].values,
+                      st['latitude'], st['longitude'])
+        ok = (d <= 20) & (ref['date'] >= '2016-12-15').values & \
+            (ref['date'] <= '2017-02-15').values
+        expected += [(int(r), st['stid']) for r in np.flatnonzero(ok)]
+    assert sorted(zip(pairs['row'], pairs['stid'])) == sorted(expected), \
+        'near_stations found {0} pairs, brute force {1}'.format(
+            len(pairs), len(expected))
+    assert (idx.df['ID'].values[pairs['row']] ==
+            df['ID'].values[rows[pairs['row']]]).all()
+
+    r = np.random.default_rng(0)
+    wx_frames = {}
+    for stid in ('S1', 'S2'):
+        t = pd.date_range('2016-12-14', '2017-02-17', freq='20min',
+                          tz='UTC')
+        t = t[r.random(len(t)) < 0.3]
+        wx_frames[stid] = pd.DataFrame({'air_temp_set_1':
+                                        r.normal(-5, 3, len(t))}, index=t)
+    times = pd.Series(idx.dates + pd.to_timedelta(
+        idx.df['event_time'].values + ':00'))
+    joined = idx.join_stations(pairs, wx_frames, tolerance='2h',
+                               times=times)
+    for i, pair in pairs.iterrows():
+        wx = wx_frames.get(pair['stid'])
+        t = times[pair['row']].tz_localize('US/Mountain').tz_convert('UTC')
+        value = np.nan
+        if wx is not None:
+            before = wx[(wx.index <= t) &
+                        (wx.index >= t - pd.Timedelta('2h'))]
+            if len(before):
+                value = before['air_temp_set_1'].iloc[-1]
+        got = joined['air_temp_set_1'].iloc[i]
+        assert (np.isnan(value) and np.isnan(got)) or value == got, \
+            'pair {0} joined {1}, expected {2}'.format(i, got, value)
+
+
+@check('reanalysis')
+def grid_bilinear_exact(ctx):
+    '''
+    Bilinear extraction reproduces a field that is bilinear in lat and lon
+    exactly at any station inside the grid (on a descending lat axis with
+    0..360 longitudes, across tiles and time chunks), both methods return
+    the node value at a grid node, stations outside get NaN, and a store
+    written in two parts holds the same series as frames()
+    '''
+    from reanalysis import PointExtractor, grid_weights, open_grid
+    path = _fresh_dir(os.path.join(ctx['workdir'], 'grid'))
+    lat = np.arange(49., 39., -0.5)
+    lon = np.arange(240., 258., 0.75)
+    times = pd.date_range('2017-01-01', periods=50, freq='3h', tz='UTC')
+    tt, yy, xx = np.meshgrid(np.arange(len(times)), lat, lon - 360.,
+                             indexing='ij')
+
+    def field(t, y, x):
+        return 2. + 0.5 * t + 3. * y - 1.5 * x + 0.25 * y * x
+
+    field(tt, yy, xx).astype('<f4').tofile(os.path.join(path, 'air.f32'))
+    with open(os.path.join(path, 'coords.json'), 'w') as fout:
+        json.dump({'start': times[0].isoformat(), 'freq': '3h',
+                   'ntimes': len(times), 'lat': list(lat), 'lon': list(lon),
+                   'variables': ['air']}, fout)
+    grid = open_grid(path)
+
+    r = np.random.default_rng(0)
+    n = 40
+    md_df = pd.DataFrame({'stid': ['P{0}'.format(i) for i in range(n + 2)],
+                          'latitude': np.append(r.uniform(39.5, 48.5, n),
+                                                [lat[3], 52.]),
+                          'longitude': np.append(r.uniform(-119.5, -103, n),
+                                                 [lon[5] - 360., -110.])})
+    for method in ('bilinear', 'idw'):
+        _, _, w = grid_weights(lat, lon, md_df['latitude'],
+                               md_df['longitude'], method)
+        np.testing.assert_allclose(w[:-1].sum(axis=1), 1.)
+        assert np.isnan(w[-1]).all(), 'outside station has weights'
+        frames = PointExtractor(grid, md_df, method=method, tile=4,
+                                rename={'air': 'air_temp_set_1'}) \
+            .frames(chunk=7)
+        node = frames['P{0}'.format(n)]['air_temp_set_1'].values
+        np.testing.assert_allclose(
+            node, field(np.arange(len(times)), lat[3], lon[5] - 360.),
+            rtol=1e-5, err_msg=method + ' misses the grid node value')
+        assert frames['P{0}'.format(n + 1)].isnull().all().all()
+    ex = PointExtractor(grid, md_df, tile=4)
+    assert list(np.flatnonzero(ex.outside)) == [n + 1], \
+        'stations marked outside: {0}'.format(
+            [ex.stations[i] for i in np.flatnonzero(ex.outside)])
+    frames = ex.frames(chunk=7)
+    t = np.arange(len(times))
+    for i in range(n):
+        st = md_df.iloc[i]
+        np.testing.assert_allclose(
+            frames[st['stid']]['air'].values,
+            field(t, st['latitude'], st['longitude']), rtol=1e-5,
+            err_msg='bilinear value differs at ' + st['stid'])
+
+    storedir = os.path.join(ctx['workdir'], 'grid_points')
+    ex.write_store(storedir, end=times[20], chunk=6)
+    store = ex.write_store(storedir, chunk=6)
+    for stid, df in frames.items():
+        # the stored index is ns, the grid's may be another unit
+        pd.testing.assert_frame_equal(store.load(stid), df,
+                                      check_index_type=False,
+                                      check_freq=False)
+
+
+@check('ensemble')
+def ensemble_matches_windows(ctx):
+    '''
+    EnsembleEngine features, computed from the shared history tail and a
+    sliding view of the members, equal each reduction recomputed over the
+    explicit window of history + forecast (with gaps in both, and a
+    history shorter than the windows), and evaluate_ensemble gives the
+    same bands sharded over processes as the engine in one batch
+    '''
+    from ensemble import EnsembleEngine, LinearHazardModel, \
+        evaluate_ensemble
+    r = np.random.default_rng(0)
+    variables = ['air_temp_set_1', 'snow_depth_set_1']
+    features = [('air_temp_set_1', how, w)
+                for how in ('sum', 'mean', 'max', 'min', 'delta')
+                for w in ('1h', '3h', '10h')] + \
+        [('snow_depth_set_1', 'delta', '6h')]
+    stations = [2, 0]
+    n_fc = 12
+    members = r.normal(0, 3, (5, n_fc, 3, 2)).astype(np.float32)
+    members[r.random(members.shape) < 0.15] = np.nan
+
+    def naive(series, how, n, t0, t):
+        lo = t0 + t - n + 1
+        win = series[max(lo, 0):t0 + t + 1]
+        if how == 'delta':
+            return win[-1] - win[0] if lo >= 0 else np.nan
+        if np.isnan(win).all():
+            return np.nan
+        return {'sum': np.nansum, 'mean': np.nanmean, 'max': np.nanmax,
+                'min': np.nanmin}[how](win)
+
+    model = LinearHazardModel().fit(
+        r.normal(0, 1, (50, len(stations) * len(features))),
+        r.integers(1, 5, (50, 3)))
+    for n_hist in (30, 4):
+        history = r.normal(0, 3, (n_hist, 3, 2)).astype(np.float32)
+        history[r.random(history.shape) < 0.15] = np.nan
+        engine = EnsembleEngine(model, variables, features,
+                                stations=stations)
+        mem = members[:, :, stations]
+        X = engine.features_of(engine.tail(history), mem)
+        for i, (var, how, w) in enumerate(features):
+            v = variables.index(var)
+            n = int(pd.Timedelta(w) / pd.Timedelta('1h'))
+            for m in range(len(mem)):
+                for s, stn in enumerate(stations):
+                    series = np.concatenate([history[:, stn, v],
+                                             mem[m, :, s, v]])
+                    expected = [naive(series, how, n, n_hist, t)
+                                for t in range(n_fc)]
+                    np.testing.assert_allclose(
+                        X[m, :, s, i], expected, rtol=1e-5, atol=1e-5,
+                        err_msg='{0} {1} over {2}, member {3}, {4} rows '
+                        'of history'.format(how, var, w, m, n_hist))
+
+        times = pd.date_range('2017-01-02', periods=n_fc, freq='1h')
+        direct = EnsembleEngine.percentiles(
+            engine.predict(history, members), times)
+        bands = evaluate_ensemble(history, members, {'teton': engine},
+                                  times=times, n_jobs=2, n_shards=3)
+        pd.testing.assert_frame_equal(bands['teton'], direct)
+
+
+def _meta_dir(ctx):
+    datadir = os.path.join(ctx['workdir'], 'meta')
+    if not os.path.isdir(datadir):
+        os.makedirs(datadir)
+        synthetic.write_stn_metadata(datadir, ctx['n_meta'])
+    return datadir
+
+
+def _query_points(ctx):
+    r = np.random.default_rng(0)
+    return (r.uniform(38, 48, ctx['n_queries']),
+            r.uniform(-123, -105, ctx['n_queries']))
+
+
+@case('select')
+def select_stn_loop(ctx):
+    from processwx import select_stn
+    datadir = _meta_dir(ctx)
+    lat, lon = _query_points(ctx)
+    n = min(len(lat), 50)
+
+    def run():
+        for i in range(n):
+            select_stn(datadir, {'k_nrst': 3, 'lat_lon': (lat[i], lon[i])})
+    return run, n, None
+
+
+@case('select')
+def nearest_stns_batch(ctx):
+    from processwx import load_stn_metadata, nearest_stns
+    datadir = _meta_dir(ctx)
+    md_df = load_stn_metadata(datadir)
+    lat, lon = _query_points(ctx)
+    return (lambda: nearest_stns(datadir, lat, lon, {'k_nrst': 3},
+                                 md_df=md_df),
+            len(lat), None)
+
+
+@case('select')
+def nearest_stns_radius(ctx):
+    from processwx import load_stn_metadata, nearest_stns
+    datadir = _meta_dir(ctx)
+    md_df = load_stn_metadata(datadir)
+    lat, lon = _query_points(ctx)
+    return (lambda: nearest_stns(datadir, lat, lon, {'max_dist': 50},
+                                 md_df=md_df),
+            len(lat), None)
+
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             cwd=here, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def read_history(filename):
+    if not os.path.isfile(filename):
+        return []
+    runs = []
+    with open(filename, 'r') as fin:
+        for line in fin:
+            try:
+                runs.append(json.loads(line))
+            except ValueError:
+                continue
+    return runs
+
+
+def baseline(history, scale, host, name, window=5):
+    '''
+    Median time of a case over its last `window` runs at this scale/host
+    '''
+    times = [run['results'][name]['seconds'] for run in history
+             if run['scale'] == scale and run['host'] == host and
+             name in run['results']]
+    if not times:
+        return None
+    return float(np.median(times[-window:]))
+
+
+def _selected(group, name, only):
+    return not only or any(s in group or s in name for s in only)
+
+
+def run_checks(ctx, only=None, verbose=False):
+    '''
+    Run the correctness checks and return the names of those that failed
+    '''
+    failed = []
+    for group, func in checks:
+        name = func.__name__
+        if not _selected(group, name, only):
+            continue
+        out = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(sys.stdout if verbose else out):
+                func(ctx)
+            print('{0:<26} ok'.format(name))
+        except Exception as e:
+            failed.append(name)
+            print('{0:<26} FAILED {1}: {2}'.format(name, type(e).__name__,
+                                                   e))
+    return failed
+
+
+def run_suite(scale='small', repeat=3, only=None, latency=0.02,
+              verbose=False):
+    '''
+    Run the checks and benchmark cases (all, or those whose group or name
+    contains one of the strings in `only`)
+
+    Returns:
+    --------
+    results (dict) {name: metrics} of the cases
+    failed (list) names of the failed checks
+    '''
+    ctx = dict(scales[scale], latency=latency, cleanup=[])
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='avy_bench_')
+    ctx['workdir'] = workdir
+    srv = StubServer(latency=latency,
+                     n_stations=ctx['n_stations']).start()
+    ctx['srv'] = srv
+    try:
+        failed = run_checks(ctx, only, verbose)
+        for group, func in cases:
+            name = func.__name__
+            if not _selected(group, name, only):
+                continue
+            out = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(sys.stdout if verbose
+                                                else out):
+                    run, n_items, extra = func(ctx)
+                    times = []
+                    for _ in range(repeat):
+                        t0 = time.perf_counter()
+                        run()
+                        times.append(time.perf_counter() - t0)
+                best = min(times)
+                results[name] = {'group': group,
+                                 'seconds': best,
+                                 'items': n_items,
+                                 'rate': n_items / best if best else None}
+                if extra is not None:
+                    results[name].update(extra())
+            except Exception as e:
+                results[name] = {'group': group,
+                                 'error': '{0}: {1}'.format(
+                                     type(e).__name__, e)}
+            print_result(name, results[name])
+    finally:
+        for stop in ctx['cleanup']:
+            stop()
+        srv.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results, failed
+
+
+def print_result(name, res, base=None):
+    if 'error' in res:
+        print('{0:<26} ERROR {1}'.format(name, res['error']))
+        return
+    line = '{0:<26} {1:9.4f} s {2:12.1f} items/s'.format(
+        name, res['seconds'], res['rate'] or 0)
+    if base:
+        line += '  {0:+6.1f}% vs {1:.4f} s'.format(
+            100 * (res['seconds'] / base - 1), base)
+    print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', choices=sorted(scales), default='small')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', default=None,
+                        help='comma separated groups or case names')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='stub server response delay [s]')
+    parser.add_argument('--history',
+                        default=os.path.join(here, 'results.jsonl'))
+    parser.add_argument('--no-save', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='slowdown vs baseline counted as a regression')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with status 1 on regressions')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    only = args.only.split(',') if args.only else None
+    results, failed = run_suite(args.scale, args.repeat, only, args.latency,
+                        args.verbose)
+
+    host = platform.node()
+    history = read_history(args.history)
+    regressions = []
+    print('\ncompared with the median of recent runs:')
+    for name, res in results.items():
+        base = baseline(history, args.scale, host, name)
+        print_result(name, res, base)
+        if base and 'seconds' in res and \
+                res['seconds'] > base * (1 + args.threshold):
+            regressions.append(name)
+
+    if not args.no_save:
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'commit': git_commit(),
+                  'scale': args.scale,
+                  'host': host,
+                  'python': platform.python_version(),
+                  'repeat': args.repeat,
+                  'latency': args.latency,
+                  'results': results,
+                  'failed_checks': failed}
+        with open(args.history, 'a') as fout:
+            fout.write(json.dumps(record) + '\n')
+
+    status = 0
+    if regressions:
+        print('\nregressions: ' + ', '.join(regressions))
+        if args.check:
+            status = 1
+    if failed:
+        print('\nfailed checks: ' + ', '.join(failed))
+        status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
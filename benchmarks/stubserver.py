@@ -0,0 +1,218 @@
+"""
+Local HTTP server standing in for jhavalanche.org and the Synoptic API, so
+fetch benchmarks run offline and repeatably.
+
+Every response is delayed by `latency` seconds (plus optional jitter), and
+with `rate` set the server answers requests beyond rate/s (bursts up to
+`burst`) with 429 Too Many Requests and a Retry-After header, like a
+throttling API would. /status/<code> answers with that status (and a
+Retry-After header when given ?retry_after=), for exercising retry logic.
+
+with StubServer(latency=0.05) as srv:
+    fetcher.fetch_pages([srv.url + '/viewTeton?data_date=2017-01-01'], out)
+
+@author: ABerner
+"""
+import http.server
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+
+import synthetic
+
+
+class _Throttle(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+def _date(s, fmt):
+    return time.strftime('%Y-%m-%d', time.strptime(s, fmt))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', content_type='text/html',
+               headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _serve(self):
+        srv = self.server.stub
+        srv.count('requests')
+        if srv.latency or srv.jitter:
+            time.sleep(srv.latency + random.random() * srv.jitter)
+        if not srv.throttle.allow():
+            srv.count('throttled')
+            return self._reply(429, 'Too Many Requests',
+                               headers={'Retry-After': '1'})
+        parts = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        form = {}
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            form = {k: v[0] for k, v in
+                    parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        headers = None
+        try:
+            status, body, ctype = self.route(parts.path, query, form)
+        except (KeyError, ValueError) as e:
+            status, body, ctype = 400, 'bad request: {0}'.format(e), \
+                'text/plain'
+        if parts.path.startswith('/status/') and 'retry_after' in query:
+            headers = {'Retry-After': query['retry_after']}
+        srv.count('bytes', len(body))
+        self._reply(status, body, ctype, headers)
+
+    do_GET = _serve
+    do_POST = _serve
+    do_HEAD = _serve
+
+    def route(self, path, query, form):
+        srv = self.server.stub
+        if path.startswith('/v2/'):
+            return self.route_synoptic(path[len('/v2/'):], query)
+        if path.startswith('/status/'):
+            status = int(path[len('/status/'):])
+            return status, 'status {0}'.format(status), 'text/plain'
+        if path == '/observations/viewObs':
+            return 200, '', 'text/html'
+        if path == '/lib/obs_xml.php':
+            start = _date(form['start_date'], '%m/%d/%Y')
+            end = _date(form['end_date'], '%m/%d/%Y')
+            return 200, synthetic.obs_xml(start, end, srv.obs_per_day,
+                                          srv.seed), 'text/xml'
+        if path == '/lib/avy_events.php':
+            start = _date(query['start'], '%m/%d/%Y')
+            end = _date(query['end'], '%m/%d/%Y')
+            return 200, json.dumps(synthetic.events(start, end,
+                                                    srv.events_per_day,
+                                                    srv.seed)), \
+                'application/json'
+        if path.startswith('/images/danger_'):
+            level = int(path[len('/images/danger_'):].split('.')[0])
+            return 200, synthetic.hazard_icon(level), 'image/gif'
+        if path.startswith('/view'):
+            region = 'teton'
+            if path == '/viewOther':
+                region = {'tog': 'tog', 'greay': 'grey'}[query['area']]
+            return 200, synthetic.bulletin(query['data_date'], region,
+                                           srv.seed), 'text/html'
+        return 404, 'not found', 'text/plain'
+
+    def route_synoptic(self, path, query):
+        srv = self.server.stub
+        if path == 'networks':
+            return 200, json.dumps(synthetic.networks()), 'application/json'
+        if path == 'stations/metadata':
+            nets = [int(n) for n in query.get('network', '48').split(',')]
+            return 200, json.dumps(synthetic.stn_metadata(
+                nets, srv.n_stations, seed=srv.seed)), 'application/json'
+        if path == 'stations/timeseries':
+            if query.get('output', 'JSON') != 'CSV':
+                err = {'SUMMARY': {'RESPONSE_CODE': -1,
+                                   'RESPONSE MESSAGE': 'stub serves CSV only'}}
+                return 200, json.dumps(err), 'application/json'
+            start = time.strptime(query['start'], '%Y%m%d%H%M')
+            end = time.strptime(query['end'], '%Y%m%d%H%M')
+            body = ''.join(synthetic.stn_csv(
+                stid, time.strftime('%Y-%m-%d %H:%M', start),
+                time.strftime('%Y-%m-%d %H:%M', end), srv.stn_freq, srv.seed)
+                for stid in query['stid'].split(','))
+            return 200, body, 'text/csv'
+        return 404, 'not found', 'text/plain'
+
+
+class StubServer(object):
+    '''
+    Threaded stub server on a free local port
+
+    Parameters:
+    -----------
+    latency (float) delay added to every response [units: s]
+    jitter (float) extra uniform random delay up to this much [units: s]
+    rate (float) requests/s served before answering 429, None for no limit
+    burst (int) requests allowed back to back before throttling kicks in
+    n_stations (int) stations in the synthetic Synoptic metadata
+    stn_freq (str) observation interval of synthetic station timeseries
+    obs_per_day, events_per_day (int) density of synthetic BTAC data
+    '''
+    def __init__(self, latency=0.0, jitter=0.0, rate=None, burst=1,
+                 n_stations=10, stn_freq='15min', obs_per_day=3,
+                 events_per_day=2, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle = _Throttle(rate, burst)
+        self.n_stations = n_stations
+        self.stn_freq = stn_freq
+        self.obs_per_day = obs_per_day
+        self.events_per_day = events_per_day
+        self.seed = seed
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._httpd = None
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    @property
+    def api_url(self):
+        return self.url + '/v2/'
+
+    def start(self):
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.stub = self
+        threading.Thread(target=self._httpd.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,288 @@
+"""
+Synthetic stand-ins for the data served by jhavalanche.org and the Synoptic
+API, generated deterministically from a seed so benchmark runs are
+comparable.
+
+@author: ABerner
+"""
+import datetime
+import io
+import random
+import zlib
+
+import numpy as np
+import pandas as pd
+
+hazard_words = ['Low', 'Moderate', 'Considerable', 'High', 'Extreme']
+region_titles = {'teton': 'Teton Area',
+                 'tog': 'Continental Divide Area',
+                 'grey': 'Greys River Area'}
+zones = ['Teton', 'Togwotee', 'Greys River', 'Snake River', 'Wind River']
+
+
+def _seed(*parts):
+    return zlib.crc32('|'.join(str(p) for p in parts).encode('utf-8'))
+
+
+def bulletin(day, region='teton', seed=0, pad_chars=20000):
+    '''
+    Advisory page in the layout processbtac expects: a
+    forecast-headline-box div with the region and date, and a third
+    mtnWeather table with one row per elevation band (am and pm ratings),
+    padded with discussion text to a realistic size. Teton ratings are
+    text; the other regions only show a danger icon per rating (see
+    hazard_icon).
+    '''
+    r = random.Random(_seed(day, region, seed))
+    bands = ['Above Treeline', 'Near Treeline', 'Below Treeline']
+    if region == 'teton':
+        cell = '<td><img src="/images/danger.gif"> {0}</td>'
+    else:
+        cell = '<td><img src="/images/danger_{1}.gif"></td>'
+    rows = ''
+    for band in bands:
+        am, pm = r.choice(hazard_words), r.choice(hazard_words)
+        rows += '<tr><td>{0}</td>{1}{2}</tr>'.format(
+            band, cell.format(am, hazard_words.index(am) + 1),
+            cell.format(pm, hazard_words.index(pm) + 1))
+    words = ['wind', 'slab', 'snowpack', 'persistent', 'weak', 'layer',
+             'ridgeline', 'loading', 'cornice', 'storm']
+    n_words = pad_chars // 8
+    discussion = ' '.join(r.choice(words) for _ in range(n_words))
+    date = '{0:%m/%d/%Y}'.format(pd.Timestamp(day))
+    return ('<html><head><title>Avalanche Forecast</title></head><body>'
+            '<div id="content"><div class="forecast-headline-box">'
+            '<h2>{0} Forecast</h2><p>Issued for {1}</p></div>'
+            '<table class="mtnWeather"><tr><td>Temp</td><td>20</td></tr>'
+            '</table>'
+            '<table class="mtnWeather"><tr><td>Wind</td><td>SW 15</td></tr>'
+            '</table>'
+            '<table class="mtnWeather">{2}</table>'
+            '<div class="discussion"><p>{3}</p></div>'
+            '</div></body></html>').format(region_titles[region], date,
+                                           rows, discussion)
+
+
+def hazard_icon(level, size=(48, 32), border=1, label=None):
+    '''
+    GIF danger icon: a rectangle in the danger scale colour of level on a
+    white background with a dark outline border pixels wide, and optionally
+    a black text label (needs Pillow)
+    '''
+    from PIL import Image, ImageDraw
+    colors = {1: (80, 184, 72), 2: (255, 242, 0), 3: (247, 148, 30),
+              4: (237, 28, 36), 5: (35, 31, 32)}
+    img = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([4, 4, size[0] - 5, size[1] - 5], fill=colors[level],
+                   outline=(60, 60, 60), width=border)
+    if label:
+        draw.text((border + 6, border + 5), label, fill=(0, 0, 0))
+    out = io.BytesIO()
+    img.save(out, format='GIF')
+    return out.getvalue()
+
+
+def _days(start, end):
+    return pd.date_range(pd.Timestamp(start), pd.Timestamp(end), freq='D')
+
+
+def obs_markers(start, end, per_day=3, seed=0):
+    '''
+    Observation markers between two dates, as attribute dicts
+    '''
+    r = np.random.default_rng(_seed('obs', start, end, seed))
+    days = _days(start, end)
+    n = len(days) * per_day
+    dates = days[r.integers(0, len(days), n)] if len(days) else days
+    return [{'obs_date': '{0:%Y-%m-%d}'.format(d),
+             'obs_id': '{0:%Y%m%d}{1:05}'.format(d, i),
+             'zone': zones[i % len(zones)],
+             'lat': '{0:.5f}'.format(43.3 + r.random()),
+             'lng': '{0:.5f}'.format(-111.2 + r.random()),
+             'observer': 'observer {0}'.format(i % 40),
+             'snowpack': 'stable' if r.random() < 0.7 else 'unstable'}
+            for i, d in enumerate(dates)]
+
+
+def obs_xml(start, end, per_day=3, seed=0):
+    def attrs(m):
+        return ' '.join('{0}="{1}"'.format(k, v) for k, v in m.items())
+    markers = ''.join('<marker {0} />\n'.format(attrs(m))
+                      for m in obs_markers(start, end, per_day, seed))
+    return '<?xml version="1.0"?>\n<markers>\n{0}</markers>\n\n'.format(
+        markers)
+
+
+def events(start, end, per_day=2, seed=0):
+    '''
+    Avalanche events between two dates, with the fields in
+    schema.event_types (plus the numbered duplicate keys the real
+    endpoint returns)
+    '''
+    r = np.random.default_rng(_seed('events', start, end, seed))
+    days = _days(start, end)
+    n = len(days) * per_day
+    out = []
+    for i in range(n):
+        d = days[r.integers(0, len(days))]
+        evt = {'ID': str(i),
+               'affiliation': 'BTAC',
+               'aspect': ['N', 'NE', 'E', 'SE', 'S', 'SW', 'W', 'NW'][i % 8],
+               'avy_trigger': ['N', 'AS', 'SS', 'AE'][i % 4],
+               'depth': '{0:.1f}'.format(r.gamma(2, 12)),
+               'destructive_size': str(r.integers(1, 4)),
+               'elevation': str(int(r.uniform(6000, 11000))),
+               'event_date': '{0:%Y-%m-%d}'.format(d),
+               'event_time': '{0:02}:00'.format(r.integers(6, 18)),
+               'event_year': str(d.year),
+               'fatality': '1' if r.random() < 0.01 else '0',
+               'fldType': 'SS',
+               'lat': '{0:.5f}'.format(43.3 + r.random()),
+               'lng': '{0:.5f}'.format(-111.2 + r.random()),
+               'notes': 'synthetic event',
+               'observer': 'observer {0}'.format(i % 40),
+               'pathname': 'path {0}'.format(i % 500),
+               'relative_size': str(r.integers(1, 5)),
+               'slope_angle': str(r.integers(25, 50)),
+               'zone': zones[i % len(zones)]}
+        for j, v in enumerate(list(evt.values())):
+            evt[str(j)] = v
+        out.append(evt)
+    return {'data': out}
+
+
+def stn_ids(n_stations):
+    return ['SYN{0:04}'.format(i) for i in range(n_stations)]
+
+
+def stn_metadata(networks, n_stations, rec_start='2000-01-01', seed=0):
+    '''
+    Synoptic stations/metadata response for n_stations stations scattered
+    over the western US
+    '''
+    r = np.random.default_rng(_seed('meta', seed))
+    networks = list(networks) or [48]
+    stations = []
+    for i, stid in enumerate(stn_ids(n_stations)):
+        stations.append({'STID': stid,
+                         'MNET_ID': str(networks[i % len(networks)]),
+                         'NAME': 'Synthetic {0}'.format(i),
+                         'LATITUDE': '{0:.4f}'.format(r.uniform(37, 49)),
+                         'LONGITUDE': '{0:.4f}'.format(r.uniform(-124, -104)),
+                         'ELEVATION': '{0:.0f}'.format(r.uniform(3000, 11000)),
+                         'STATE': ['WY', 'ID', 'MT', 'WA', 'OR'][i % 5],
+                         'PERIOD_OF_RECORD': {
+                             'start': '{0}T00:00:00Z'.format(rec_start),
+                             'end': '2030-01-01T00:00:00Z'}})
+    return {'STATION': stations,
+            'SUMMARY': {'RESPONSE_CODE': 1, 'NUMBER_OF_OBJECTS': n_stations}}
+
+
+def networks():
+    return {'MNET': [{'ID': '25', 'SHORTNAME': 'SNOTEL'},
+                     {'ID': '37', 'SHORTNAME': 'NWAC'},
+                     {'ID': '48', 'SHORTNAME': 'BTAVAL'}],
+            'SUMMARY': {'RESPONSE_CODE': 1}}
+
+
+stn_columns = ['air_temp_set_1', 'relative_humidity_set_1',
+               'wind_speed_set_1', 'wind_direction_set_1',
+               'snow_depth_set_1', 'heat_index_set_1d']
+stn_units = ['Celsius', '%', 'm/s', 'Degrees', 'Millimeters', 'Celsius']
+
+
+def _noise(stid, times, column, seed):
+    '''
+    Uniform [0, 1) values that depend only on the station, column, seed and
+    observation time (a splitmix64 hash of each timestamp), so overlapping
+    requests for different windows agree on the rows they share
+    '''
+    x = times.asi8.astype(np.uint64) + np.uint64(_seed(stid, column, seed))
+    x = (x + np.uint64(0x9E3779B97F4A7C15)) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> np.uint64(31))
+    return (x >> np.uint64(11)).astype(np.float64) / 2. ** 53
+
+
+def _normal(stid, times, column, seed):
+    u1 = _noise(stid, times, column + '/1', seed)
+    u2 = _noise(stid, times, column + '/2', seed)
+    return np.sqrt(-2 * np.log1p(-u1)) * np.cos(2 * np.pi * u2)
+
+
+def stn_csv(stid, start, end, freq='15min', seed=0):
+    '''
+    Synoptic stations/timeseries CSV body for one station: six comment lines,
+    the column names and a units row, then one row per observation time
+    (multiples of freq) in [start, end]. About 1% of temperatures are blank, as dropouts. Each
+    row depends only on the station and its time, like the real API, so
+    responses for overlapping windows agree.
+    '''
+    # observations fall on the station's fixed grid, whatever the window
+    times = pd.date_range(pd.Timestamp(start).ceil(freq), pd.Timestamp(end),
+                          freq=freq)
+    times = times.as_unit('ns') if hasattr(times, 'as_unit') else times
+    n = len(times)
+
+    def u(column):
+        return _noise(stid, times, column, seed)
+
+    hours = (times.hour.values + times.minute.values / 60.)
+    days = times.dayofyear.values
+    temp = (-5 + 8 * np.sin((hours - 9) / 24 * 2 * np.pi) +
+            1.5 * _normal(stid, times, 'temp', seed)).round(1).astype(str)
+    temp[u('dropout') < 0.01] = ''
+    cols = [temp,
+            (20 + 80 * u('rh')).round(0).astype(str),
+            # gamma(2, 2): twice the sum of two unit exponentials
+            (-2 * (np.log1p(-u('wind1')) +
+                   np.log1p(-u('wind2')))).round(2).astype(str),
+            (360 * u('dir')).round(0).astype(str),
+            (1000 + 300 * np.sin(days / 365. * 2 * np.pi) +
+             2 * _normal(stid, times, 'snow', seed)).round(0).astype(str),
+            np.full(n, '', dtype=object)]
+    stamps = times.strftime('%Y-%m-%dT%H:%M:%SZ')
+    header = ('# STATION: {0}\n# STATION NAME: Synthetic\n'
+              '# LATITUDE: 43.5\n# LONGITUDE: -110.8\n'
+              '# ELEVATION [ft]: 9000\n# STATE: WY\n').format(stid)
+    header += 'Station_ID,Date_Time,' + ','.join(stn_columns) + '\n'
+    header += ',,' + ','.join(stn_units) + '\n'
+    rows = [','.join(vals) for vals in zip([stid] * n, stamps, *cols)]
+    return header + '\n'.join(rows) + ('\n' if rows else '')
+
+
+def fetched_bulletins(days, region='teton', seed=0,
+                      base_url='http://www.jhavalanche.org'):
+    '''
+    Records as written by DataFetcher.fetch_pages for the advisory urls
+    fetchbtac.fetch_btac_advisory builds
+    '''
+    url = base_url + {
+        'teton': '/viewTeton?data_date={0:%Y-%m-%d}'
+                 '&template=teton_print.tpl.php',
+        'tog': '/viewOther?area=tog&data_date={0:%Y-%m-%d}',
+        'grey': '/viewOther?area=greay&data_date={0:%Y-%m-%d}'}[region]
+    now = datetime.datetime(2020, 1, 1).strftime('%Y-%m-%dT%H:%M:%SZ')
+    for day in days:
+        yield {'url': url.format(pd.Timestamp(day)),
+               'time': now,
+               'status': 200,
+               'content': bulletin(day, region, seed)}
+
+
+def write_stn_metadata(datadir, n_stations, networks=(48,), seed=0):
+    '''
+    Station metadata CSV laid out like the one fetchwx.fetch_mnet_ts writes
+    '''
+    md = pd.DataFrame(stn_metadata(networks, n_stations, seed=seed)['STATION'])
+    md['REC_START'] = md['PERIOD_OF_RECORD'].apply(lambda x: x['start'])
+    md['REC_END'] = md['PERIOD_OF_RECORD'].apply(lambda x: x['end'])
+    for col in ['LATITUDE', 'LONGITUDE', 'ELEVATION', 'MNET_ID']:
+        md[col] = pd.to_numeric(md[col])
+    md = md[['STID', 'MNET_ID', 'NAME', 'LATITUDE', 'LONGITUDE', 'ELEVATION',
+             'STATE', 'REC_START', 'REC_END']]
+    md.to_csv(datadir + '/stn_metadata_MNETIDs_' +
+              '_'.join(str(n) for n in networks) + '.csv',
+              compression='gzip')
+    return md